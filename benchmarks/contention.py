@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Lock contention benchmark for LegacyChatServer.
+
+Runs send_message / get_messages / update_status traffic from N threads
+straight into process_request (no sockets) and reports throughput for
+each thread count. --global-lock wraps every request in one shared lock,
+which is how the server behaved before per-user records.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from serveropensource import LegacyChatServer
+
+def run(thread_count, seconds, global_lock, file_kb):
+    server = LegacyChatServer("127.0.0.1", 0)
+    for i in range(thread_count):
+        server.process_request({"action": "signup", "username": f"sender{i}", "password": "pw"})
+        server.process_request({"action": "signup", "username": f"recipient{i}", "password": "pw"})
+    process = server.process_request
+    if global_lock:
+        big_lock = threading.Lock()
+        def process(request):
+            with big_lock:
+                return server.process_request(request)
+    filedata = "A" * (file_kb * 1024)
+    counts = [0] * thread_count
+    stop = threading.Event()
+
+    def worker(i):
+        sender, recipient = f"sender{i}", f"recipient{i}"
+        n = 0
+        while not stop.is_set():
+            process({"action": "send_message", "sender": sender, "recipient": recipient, "message": "hi"})
+            if file_kb and n % 50 == 0:
+                process({"action": "send_file", "sender": sender, "recipient": recipient,
+                         "filename": "f.bin", "filedata": filedata})
+            if n % 10 == 0:
+                process({"action": "get_messages", "username": recipient})
+                process({"action": "update_status", "username": sender, "status": "online"})
+            n += 1
+        counts[i] = n
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return sum(counts) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", default="1,2,4,8,16,32", help="comma-separated sender thread counts")
+    parser.add_argument("--seconds", type=float, default=3.0, help="duration of each run")
+    parser.add_argument("--file-kb", type=int, default=0, help="also send a file of this size every 50 messages")
+    parser.add_argument("--global-lock", action="store_true", help="serialize all requests on one lock")
+    args = parser.parse_args()
+    print("threads  sends/s  (global lock)" if args.global_lock else "threads  sends/s")
+    for thread_count in [int(n) for n in args.threads.split(",")]:
+        rate = run(thread_count, args.seconds, args.global_lock, args.file_kb)
+        print(f"{thread_count:7d}  {rate:9.0f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Per-request dispatch overhead micro-benchmark for LegacyChatServer.
+
+Times requests straight into process_request and handle_payload (no
+sockets) and prints nanoseconds per request for:
+  - a heartbeat, the cheapest handler, so the time is dispatch itself,
+  - a request rejected by field validation and an unknown action,
+  - the same heartbeat with --plugins extra actions registered, which
+    should cost the same: lookups do not grow with the table,
+  - handle_payload (decode, dispatch, encode) for get_buddy_statuses and
+    for a get_messages reply of --page messages, once per JSON codec installed.
+Run it before and after touching dispatch or adding actions.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import serveropensource
+from serveropensource import JSON_CODECS, LegacyChatServer, action
+
+def per_call(function, argument, seconds):
+    """Nanoseconds per call of function(argument), best of three runs of about seconds/3 each."""
+    count = 1000
+    while True:
+        started = time.perf_counter()
+        for _ in range(count):
+            function(argument)
+        elapsed = time.perf_counter() - started
+        if elapsed > seconds / 10:
+            break
+        count *= 4
+    count = max(int(count * seconds / 3 / elapsed), 1)
+    best = None
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(count):
+            function(argument)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / count * 1e9
+
+def make_server(buddies, page):
+    server = LegacyChatServer("127.0.0.1", 0)
+    server.process_request({"action": "signup", "username": "bench", "password": "pw"})
+    for i in range(buddies):
+        server.process_request({"action": "signup", "username": "buddy{}".format(i), "password": "pw"})
+        server.process_request({"action": "add_buddy", "username": "bench", "buddy_username": "buddy{}".format(i),
+                                "buddy_name": "Buddy {}".format(i)})
+    for i in range(page):
+        server.process_request({"action": "send_message", "sender": "buddy0", "recipient": "bench",
+                                "message": "benchmark message number {}".format(i)})
+    return server
+
+def register_plugins(count):
+    for i in range(count):
+        @action("plugin_{}".format(i), {"username": str})
+        def plugin(server, request):
+            return {"status": "success"}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=1.0, help="measuring time per scenario")
+    parser.add_argument("--buddies", type=int, default=20, help="buddies in the get_buddy_statuses reply")
+    parser.add_argument("--page", type=int, default=50, help="messages in the get_messages reply")
+    parser.add_argument("--plugins", type=int, default=1000, help="extra actions registered for the table-size run")
+    options = parser.parse_args()
+
+    server = make_server(options.buddies, options.page)
+    process = lambda request: server.process_request(request)
+    rows = [
+        ("process_request heartbeat", per_call(process, {"action": "heartbeat"}, options.seconds)),
+        ("process_request missing field", per_call(process, {"action": "update_status", "username": "bench"},
+                                                   options.seconds)),
+        ("process_request unknown action", per_call(process, {"action": "no_such_action"}, options.seconds)),
+    ]
+    register_plugins(options.plugins)
+    rows.append(("heartbeat, {} plugin actions".format(options.plugins),
+                 per_call(process, {"action": "heartbeat"}, options.seconds)))
+    rows.append(("process_request plugin action", per_call(process, {"action": "plugin_0", "username": "bench"},
+                                                           options.seconds)))
+
+    statuses = b'{"action": "get_buddy_statuses", "username": "bench", "id": 1}'
+    # since=0 without ack leaves the mailbox alone, so every call returns the same page.
+    messages = b'{"action": "get_messages", "username": "bench", "since": 0, "limit": %d, "id": 2}' % options.page
+    for codec_class in JSON_CODECS:
+        try:
+            server.codec = codec_class()
+        except ImportError:
+            rows.append(("{} codec".format(codec_class.name), None))
+            continue
+        rows.append(("handle_payload get_buddy_statuses ({})".format(codec_class.name),
+                     per_call(server.handle_payload, statuses, options.seconds)))
+        rows.append(("handle_payload get_messages x{} ({})".format(options.page, codec_class.name),
+                     per_call(server.handle_payload, messages, options.seconds)))
+
+    print("{} registered actions, codecs tried: {}".format(
+        len(serveropensource.ACTIONS), ", ".join(codec.name for codec in JSON_CODECS)))
+    print()
+    print("{:<48} {:>12}".format("scenario", "ns/request"))
+    for name, nanoseconds in rows:
+        if nanoseconds is None:
+            print("{:<48} {:>12}".format(name, "not installed"))
+        else:
+            print("{:<48} {:>12.0f}".format(name, nanoseconds))
+
+if __name__ == "__main__":
+    main()
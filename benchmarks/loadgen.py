@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+"""
+Headless load generator for the LegacyChat server protocol.
+
+Simulates many clients on one asyncio loop, each with its own persistent
+connection speaking the real protocol (signup, login, add_buddy,
+send_message, get_messages polling, send_file, update_status, ...).
+Reports throughput and p50/p95/p99 latency per action, bytes on the wire,
+plus the server's resident memory over time and CPU time when it runs on
+this machine.
+
+Examples:
+    # start a local threaded server and drive 2000 clients for 30s
+    python benchmarks/loadgen.py --spawn threaded --clients 2000 --duration 30
+
+    # drive an already running server, custom mix, binary framing
+    python benchmarks/loadgen.py --port 12345 --server-pid 4242 --binary \\
+        --mix send_message=6,get_messages=3,update_status=1
+
+    # wire bytes vs CPU with and without deflate, on compressible files
+    python benchmarks/loadgen.py --spawn async --mix files --file-content text --binary
+    python benchmarks/loadgen.py --spawn async --mix files --file-content text --compress
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import signal
+import struct
+import subprocess
+import sys
+import time
+import zlib
+
+FRAME_HEADER = struct.Struct(">I")
+COMPRESSED_FLAG = 0x80000000
+COMPRESSION_THRESHOLD = 1024
+
+# Scenario presets: action -> relative weight.
+MIXES = {
+    "chat": {"send_message": 50, "get_messages": 30, "get_buddy_statuses": 10, "update_status": 5, "login": 5},
+    "presence": {"get_buddy_statuses": 60, "update_status": 30, "get_messages": 10},
+    "files": {"send_file": 20, "file_upload": 20, "send_message": 30, "get_messages": 30},
+    "polling": {"get_messages": 100},
+}
+
+class BenchClient:
+    """One simulated user with a persistent connection and id-matched replies."""
+    def __init__(self, name, options, stats):
+        self.name = name
+        self.options = options
+        self.stats = stats
+        self.next_id = 0
+        self.pending = {}
+        self.last_seq = 0
+        self.buddies = []
+        self.reader = None
+        self.writer = None
+        self.framing = "line"
+        self.compression = None
+        # closed: set once read_loop has ended; later requests fail at once instead of waiting forever
+        self.closed = False
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.options.host, self.options.port,
+                                                                 limit=256 * 1024 * 1024)
+        if self.options.binary or self.options.compress:
+            request = {"action": "negotiate", "framing": "binary"}
+            if self.options.compress:
+                request["compression"] = "deflate"
+            self.writer.write((json.dumps(request) + "\n").encode("utf-8"))
+            reply = json.loads(await self.reader.readline())
+            if reply.get("status") == "success":
+                self.framing = "binary"
+                self.compression = reply.get("compression")
+        asyncio.get_running_loop().create_task(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            while True:
+                if self.framing == "binary":
+                    header = await self.reader.readexactly(FRAME_HEADER.size)
+                    (length,) = FRAME_HEADER.unpack(header)
+                    payload = await self.reader.readexactly(length & ~COMPRESSED_FLAG)
+                    self.stats.bytes_in += FRAME_HEADER.size + len(payload)
+                    if length & COMPRESSED_FLAG:
+                        payload = zlib.decompress(payload)
+                else:
+                    payload = await self.reader.readline()
+                    if not payload:
+                        break
+                    self.stats.bytes_in += len(payload)
+                response = json.loads(payload)
+                future = self.pending.pop(response.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+                elif response.get("push") == "message":
+                    self.stats.pushes += 1
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, zlib.error):
+            pass
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_result({"status": "error", "message": "Connection lost"})
+            self.pending.clear()
+
+    async def request(self, request):
+        """Sends one request and records its latency under its action name."""
+        if self.closed:
+            response = {"status": "error", "message": "Connection lost"}
+            self.stats.record(request["action"], 0.0, False)
+            return response
+        self.next_id += 1
+        request["id"] = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        payload = json.dumps(request).encode("utf-8")
+        if self.framing == "binary":
+            length = len(payload)
+            if self.compression == "deflate" and length >= COMPRESSION_THRESHOLD:
+                compressed = zlib.compress(payload, self.options.compress_level)
+                if len(compressed) < length:
+                    payload, length = compressed, len(compressed) | COMPRESSED_FLAG
+            data = FRAME_HEADER.pack(length) + payload
+        else:
+            data = payload + b"\n"
+        self.stats.bytes_out += len(data)
+        started = time.perf_counter()
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        except ConnectionError:
+            self.pending.pop(request["id"], None)
+            if not future.done():
+                future.set_result({"status": "error", "message": "Connection lost"})
+        response = await future
+        self.stats.record(request["action"], time.perf_counter() - started, response.get("status") == "success")
+        return response
+
+    async def setup(self):
+        await self.connect()
+        await self.request({"action": "signup", "username": self.name, "password": "pw"})
+
+    async def add_buddies(self, all_names):
+        others = [name for name in all_names if name != self.name]
+        self.buddies = random.sample(others, min(self.options.buddies, len(others)))
+        for buddy in self.buddies:
+            await self.request({"action": "add_buddy", "username": self.name, "buddy_username": buddy,
+                                "buddy_name": buddy})
+
+    async def run(self, deadline, actions, weights, filedata):
+        while time.monotonic() < deadline and not self.closed:
+            if self.options.think:
+                await asyncio.sleep(random.expovariate(1000.0 / self.options.think))
+            action = random.choices(actions, weights)[0]
+            await getattr(self, "do_" + action)(filedata)
+
+    async def do_send_message(self, filedata):
+        recipient = random.choice(self.buddies) if self.buddies else self.name
+        await self.request({"action": "send_message", "sender": self.name, "recipient": recipient,
+                            "message": "x" * self.options.message_size})
+
+    async def do_get_messages(self, filedata):
+        res = await self.request({"action": "get_messages", "username": self.name, "since": self.last_seq,
+                                  "ack": self.last_seq})
+        self.last_seq = res.get("last_seq", self.last_seq)
+
+    async def do_update_status(self, filedata):
+        await self.request({"action": "update_status", "username": self.name,
+                            "status": random.choice(["online", "away", "busy"])})
+
+    async def do_get_buddy_statuses(self, filedata):
+        await self.request({"action": "get_buddy_statuses", "username": self.name})
+
+    async def do_login(self, filedata):
+        await self.request({"action": "login", "username": self.name, "password": "pw"})
+
+    async def do_send_file(self, filedata):
+        recipient = random.choice(self.buddies) if self.buddies else self.name
+        await self.request({"action": "send_file", "sender": self.name, "recipient": recipient,
+                            "filename": "bench.bin", "filedata": filedata})
+
+    async def do_file_upload(self, filedata):
+        """Chunked upload: file_begin, one file_chunk, file_commit."""
+        recipient = random.choice(self.buddies) if self.buddies else self.name
+        size = len(base64.b64decode(filedata))
+        res = await self.request({"action": "file_begin", "sender": self.name, "recipient": recipient,
+                                  "filename": "bench.bin", "size": size})
+        if res.get("status") != "success":
+            return
+        await self.request({"action": "file_chunk", "upload_id": res["upload_id"], "offset": 0, "data": filedata})
+        await self.request({"action": "file_commit", "upload_id": res["upload_id"]})
+
+class Stats:
+    def __init__(self):
+        # latencies: action -> list of seconds
+        self.latencies = {}
+        self.errors = {}
+        self.pushes = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.recording = False
+
+    def record(self, action, seconds, ok):
+        if not self.recording:
+            return
+        self.latencies.setdefault(action, []).append(seconds)
+        if not ok:
+            self.errors[action] = self.errors.get(action, 0) + 1
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+def rss_kb(pid):
+    """Resident memory of a process and all its descendants, from /proc."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open("/proc/{}/status".format(current)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            for task in os.listdir("/proc/{}/task".format(current)):
+                with open("/proc/{}/task/{}/children".format(current, task)) as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return total
+
+def cpu_seconds(pid):
+    """User plus system CPU time of a process and all its descendants, from /proc."""
+    total = 0
+    pending = [pid]
+    ticks = os.sysconf("SC_CLK_TCK")
+    while pending:
+        current = pending.pop()
+        try:
+            with open("/proc/{}/stat".format(current)) as f:
+                # Fields after the parenthesised command name; utime and stime are 14 and 15.
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+            for task in os.listdir("/proc/{}/task".format(current)):
+                with open("/proc/{}/task/{}/children".format(current, task)) as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            continue
+    return total / ticks
+
+def file_content(kind, size):
+    """Random bytes do not compress at all; text is closer to what people actually send."""
+    if kind == "random":
+        return os.urandom(size)
+    words = [b"the", b"message", b"server", b"buddy", b"status", b"online", b"file", b"report",
+             b"meeting", b"tomorrow", b"thanks", b"lunch", b"update", b"draft", b"chat", b"legacy"]
+    rng = random.Random(size)
+    lines = []
+    length = 0
+    while length < size:
+        line = b" ".join(rng.choice(words) for _ in range(rng.randint(4, 14))) + b"\n"
+        lines.append(line)
+        length += len(line)
+    return b"".join(lines)[:size]
+
+async def sample_memory(pid, samples, interval):
+    started = time.monotonic()
+    while True:
+        samples.append((time.monotonic() - started, rss_kb(pid)))
+        await asyncio.sleep(interval)
+
+def parse_mix(text):
+    if text in MIXES:
+        return MIXES[text]
+    mix = {}
+    for part in text.split(","):
+        action, weight = part.split("=")
+        mix[action.strip()] = float(weight)
+    return mix
+
+def spawn_server(mode, port, workers):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    if mode == "cluster":
+        code = "import serveropensource as s; s.ClusterServer('127.0.0.1', {}, {}).start()".format(port, workers)
+    else:
+        code = "import serveropensource as s; s.LegacyChatServer('127.0.0.1', {}).start({!r})".format(port, mode)
+    return subprocess.Popen([sys.executable, "-c", code], cwd=root, stdout=subprocess.DEVNULL)
+
+async def main_async(options):
+    stats = Stats()
+    mix = parse_mix(options.mix)
+    unknown = [action for action in mix if not hasattr(BenchClient, "do_" + action)]
+    if unknown:
+        raise SystemExit("Unknown actions in mix: {}".format(", ".join(unknown)))
+    actions, weights = list(mix), list(mix.values())
+    filedata = base64.b64encode(file_content(options.file_content, options.file_kb * 1024)).decode("ascii")
+    prefix = "bench{}_".format(int(time.time() * 1000) % 10 ** 8)
+    names = [prefix + str(i) for i in range(options.clients)]
+    clients = [BenchClient(name, options, stats) for name in names]
+
+    samples = []
+    sampler = None
+    if options.server_pid:
+        sampler = asyncio.get_running_loop().create_task(sample_memory(options.server_pid, samples, options.sample_every))
+
+    print("Connecting {} clients...".format(len(clients)))
+    step = options.ramp / max(len(clients), 1)
+    setups = []
+    for client in clients:
+        setups.append(asyncio.get_running_loop().create_task(client.setup()))
+        if step:
+            await asyncio.sleep(step)
+    await asyncio.gather(*setups)
+    await asyncio.gather(*(client.add_buddies(names) for client in clients))
+
+    print("Running '{}' for {}s...".format(options.mix, options.duration))
+    stats.recording = True
+    bytes_in, bytes_out = stats.bytes_in, stats.bytes_out
+    cpu_client = time.process_time()
+    cpu_server = cpu_seconds(options.server_pid) if options.server_pid else None
+    started = time.monotonic()
+    deadline = started + options.duration
+    await asyncio.gather(*(client.run(deadline, actions, weights, filedata) for client in clients))
+    elapsed = time.monotonic() - started
+    cpu_client = time.process_time() - cpu_client
+    if cpu_server is not None:
+        cpu_server = cpu_seconds(options.server_pid) - cpu_server
+    stats.recording = False
+    if sampler is not None:
+        sampler.cancel()
+
+    total = sum(len(values) for values in stats.latencies.values())
+    print()
+    print("{:<20} {:>9} {:>9} {:>7} {:>9} {:>9} {:>9}".format(
+        "action", "requests", "req/s", "errors", "p50 ms", "p95 ms", "p99 ms"))
+    for action in sorted(stats.latencies):
+        values = sorted(stats.latencies[action])
+        print("{:<20} {:>9} {:>9.0f} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            action, len(values), len(values) / elapsed, stats.errors.get(action, 0),
+            percentile(values, 0.50) * 1000, percentile(values, 0.95) * 1000, percentile(values, 0.99) * 1000))
+    print("{:<20} {:>9} {:>9.0f}".format("total", total, total / elapsed))
+    print("pushed messages received: {}".format(stats.pushes))
+    wire = stats.bytes_out - bytes_out + stats.bytes_in - bytes_in
+    print("bytes sent: {:.1f} MB, received: {:.1f} MB ({}, {:.0f} bytes/request)".format(
+        (stats.bytes_out - bytes_out) / 1e6, (stats.bytes_in - bytes_in) / 1e6,
+        "deflate" if options.compress else "uncompressed", wire / max(total, 1)))
+    print("cpu: loadgen {:.2f}s ({:.0f} us/request)".format(cpu_client, cpu_client * 1e6 / max(total, 1)), end="")
+    if cpu_server is not None:
+        print(", server {:.2f}s ({:.0f} us/request)".format(cpu_server, cpu_server * 1e6 / max(total, 1)), end="")
+    print()
+    if samples:
+        print()
+        print("server memory (RSS):")
+        for offset, kb in samples:
+            print("  {:7.1f}s  {:8.1f} MB".format(offset, kb / 1024))
+        print("  peak      {:8.1f} MB".format(max(kb for offset, kb in samples) / 1024))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--clients", type=int, default=500, help="number of simulated users")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of measured traffic")
+    parser.add_argument("--mix", default="chat",
+                        help="preset ({}) or action=weight,... list".format(", ".join(MIXES)))
+    parser.add_argument("--think", type=float, default=100.0, help="mean pause between a client's requests in ms")
+    parser.add_argument("--buddies", type=int, default=10, help="buddies added per client")
+    parser.add_argument("--message-size", type=int, default=64, help="characters per chat message")
+    parser.add_argument("--file-kb", type=int, default=64, help="size of files sent by send_file/file_upload")
+    parser.add_argument("--ramp", type=float, default=2.0, help="seconds over which to open connections")
+    parser.add_argument("--binary", action="store_true", help="negotiate length-prefixed binary framing")
+    parser.add_argument("--compress", action="store_true", help="also negotiate deflate compression (implies --binary)")
+    parser.add_argument("--compress-level", type=int, default=6, help="zlib level for frames this side compresses")
+    parser.add_argument("--file-content", choices=["random", "text"], default="random",
+                        help="contents of benchmark files; random data does not compress")
+    parser.add_argument("--server-pid", type=int, help="sample this process's RSS (and its children's)")
+    parser.add_argument("--sample-every", type=float, default=1.0, help="memory sampling interval in seconds")
+    parser.add_argument("--spawn", choices=["threaded", "async", "cluster"],
+                        help="start a local server in this mode for the run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes for --spawn cluster")
+    options = parser.parse_args()
+    server = None
+    if options.spawn:
+        server = spawn_server(options.spawn, options.port, options.workers)
+        options.server_pid = server.pid
+        time.sleep(1.5)
+    try:
+        asyncio.run(main_async(options))
+    finally:
+        if server is not None:
+            # Ctrl+C, so the server runs its cleanup and removes its scratch directory.
+            server.send_signal(signal.SIGINT)
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Deterministic replay of captured LegacyChat traffic.
+
+Re-drives a capture recorded by the server (capture_path, or the capture
+prompt when starting it) against a server, one connection per captured
+connection, and reports p50/p95/p99 latency per action plus replies that
+differ from the captured ones. Server-generated file and upload ids are
+mapped from captured to live values as replies come in, so uploads and
+fetches keep working.
+
+Replays run in captured real time by default. --speed N compresses the
+gaps between requests N times. --speed max sends each connection's next
+request as soon as its previous reply arrives. Replaying a capture only
+makes sense against a server in the state the capture began from: a fresh
+one when the capture started with the server, or a copy of the data dir.
+
+Examples:
+    # record on the current build, then replay at 10x against a fresh one
+    python benchmarks/replay.py traffic.cap --spawn async --speed 10
+
+    # compare two builds at max speed: save the first run, diff the second against it
+    python benchmarks/replay.py traffic.cap --spawn threaded --speed max --output before.cap
+    python benchmarks/replay.py traffic.cap --spawn threaded --speed max --baseline before.cap
+
+    # cluster captures are one file per worker
+    python benchmarks/replay.py traffic.cap.0 traffic.cap.1 --port 12345
+"""
+import argparse
+import asyncio
+import collections
+import gzip
+import json
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from serveropensource import CAPTURE_MAGIC, CAPTURE_RECORD, COMPRESSED_FLAG, COMPRESSION_THRESHOLD, FRAME_HEADER
+from loadgen import cpu_seconds, percentile, spawn_server
+
+# Reply fields that differ between runs by design; they are left out of response diffs.
+IGNORED_FIELDS = {"id", "time", "uptime", "file_id", "upload_id", "epoch"}
+# Server-generated ids that later requests refer back to; replay rewrites them to the live values.
+MAPPED_FIELDS = ("file_id", "upload_id", "epoch")
+# Admin replies describe the server itself rather than the workload.
+UNCOMPARED_ACTIONS = {"stats", "profile"}
+
+class CapturedConnection:
+    def __init__(self, opened, opening):
+        self.opened = opened
+        # opening: {"framing", "compression"} the connection had before its first request
+        self.opening = opening
+        # requests: [micros, payload, reply payload or None]
+        self.requests = []
+        self.closed = None
+
+def read_capture(path):
+    """Yields (kind, connection id, micros, payload); a capture cut short by a killed server ends early."""
+    with gzip.open(path, "rb") as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise SystemExit("{} is not a LegacyChat capture".format(path))
+        try:
+            while True:
+                header = f.read(CAPTURE_RECORD.size)
+                if len(header) < CAPTURE_RECORD.size:
+                    return
+                kind, capture_id, micros, length = CAPTURE_RECORD.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length:
+                    return
+                yield kind, capture_id, micros, payload
+        except EOFError:
+            return
+
+def load_connections(paths):
+    """Merges capture files into one list of connections in the order they opened."""
+    connections = {}
+    for index, path in enumerate(paths):
+        for kind, capture_id, micros, payload in read_capture(path):
+            key = (index, capture_id)
+            if kind == b"O":
+                connections[key] = CapturedConnection(micros, json.loads(payload))
+                continue
+            conn = connections.get(key)
+            if conn is None:
+                continue
+            if kind == b"Q":
+                conn.requests.append([micros, payload, None])
+            elif kind == b"R" and conn.requests:
+                conn.requests[-1][2] = payload
+            elif kind == b"C":
+                conn.closed = micros
+    return [connections[key] for key in sorted(connections, key=lambda key: (connections[key].opened, key))]
+
+def strip_ignored(value):
+    if isinstance(value, dict):
+        return {key: strip_ignored(item) for key, item in value.items() if key not in IGNORED_FIELDS}
+    if isinstance(value, list):
+        return [strip_ignored(item) for item in value]
+    return value
+
+def first_difference(expected, actual, path=""):
+    """Path of the first place two replies differ, or None when they match."""
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        for key in sorted(set(expected) | set(actual)):
+            if key not in expected or key not in actual:
+                return "{}.{}".format(path, key)
+            found = first_difference(expected[key], actual[key], "{}.{}".format(path, key))
+            if found:
+                return found
+        return None
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return "{}[len {} != {}]".format(path, len(expected), len(actual))
+        for index, (left, right) in enumerate(zip(expected, actual)):
+            found = first_difference(left, right, "{}[{}]".format(path, index))
+            if found:
+                return found
+        return None
+    return None if expected == actual else path or "."
+
+class Stats:
+    def __init__(self):
+        # latencies: action -> list of seconds
+        self.latencies = {}
+        self.errors = collections.Counter()
+        self.diffs = collections.Counter()
+        self.compared = collections.Counter()
+        # examples: (action, path, expected, actual) for the first few diffs
+        self.examples = []
+
+    def record(self, action, seconds, ok):
+        self.latencies.setdefault(action, []).append(seconds)
+        if not ok:
+            self.errors[action] += 1
+
+class CaptureWriter:
+    """Writes what a replay sent and got back in the capture format, so a later run can diff against it."""
+    def __init__(self, path):
+        self.file = gzip.open(path, "wb", compresslevel=1)
+        self.file.write(CAPTURE_MAGIC)
+
+    def write(self, kind, capture_id, payload=b"", micros=None):
+        if micros is None:
+            micros = int(time.time() * 1000000)
+        self.file.write(CAPTURE_RECORD.pack(kind, capture_id, micros, len(payload)))
+        self.file.write(payload)
+
+    def close(self):
+        self.file.close()
+
+class Replayer:
+    """Re-drives one captured connection; replies come back in request order, pushes aside."""
+    def __init__(self, number, captured, baseline, clock, options, stats, id_map, output):
+        self.number = number
+        self.captured = captured
+        self.baseline = baseline
+        self.clock = clock
+        self.options = options
+        self.stats = stats
+        self.id_map = id_map
+        self.output = output
+        self.framing = "line"
+        self.compression = None
+        self.reader = None
+        self.writer = None
+        # pending: (action, request index, sent at, future) in send order
+        self.pending = collections.deque()
+
+    async def run(self):
+        await self.clock.wait(self.captured.opened)
+        self.reader, self.writer = await asyncio.open_connection(self.options.host, self.options.port,
+                                                                 limit=256 * 1024 * 1024)
+        if self.output is not None:
+            self.output.write(b"O", self.number, json.dumps(self.captured.opening).encode("utf-8"),
+                              self.captured.opened)
+        if self.captured.opening.get("framing") == "binary":
+            # Captured on a cluster worker, after the master handled negotiate.
+            await self.negotiate(self.captured.opening)
+        read_task = asyncio.get_running_loop().create_task(self.read_loop())
+        try:
+            for index, (micros, payload, recorded) in enumerate(self.captured.requests):
+                await self.clock.wait(micros)
+                try:
+                    request = json.loads(payload)
+                except ValueError:
+                    continue
+                if not isinstance(request, dict):
+                    continue
+                if self.pending and any(field in request and request[field] not in self.id_map
+                                        for field in MAPPED_FIELDS):
+                    # The captured client had this id from an earlier reply, so it waited for that reply.
+                    await asyncio.gather(*(entry[3] for entry in list(self.pending)))
+                future = self.send(index, request)
+                # The reply to negotiate comes back in the old framing; read_loop switches after it.
+                if self.clock.speed is None or request.get("action") == "negotiate":
+                    await future
+            if self.pending:
+                await asyncio.gather(*(entry[3] for entry in list(self.pending)))
+            if self.captured.closed is not None:
+                await self.clock.wait(self.captured.closed)
+        finally:
+            if self.output is not None:
+                self.output.write(b"C", self.number)
+            self.writer.close()
+            read_task.cancel()
+
+    async def negotiate(self, opening):
+        request = {"action": "negotiate", "framing": opening["framing"]}
+        if opening.get("compression"):
+            request["compression"] = opening["compression"]
+        self.writer.write((json.dumps(request) + "\n").encode("utf-8"))
+        reply = json.loads(await self.reader.readline())
+        if reply.get("status") == "success":
+            self.framing = reply["framing"]
+            self.compression = reply.get("compression")
+
+    def send(self, index, request):
+        for field in MAPPED_FIELDS:
+            if request.get(field) in self.id_map:
+                request[field] = self.id_map[request[field]]
+        body = payload = json.dumps(request).encode("utf-8")
+        if self.framing == "binary":
+            length = len(payload)
+            if self.compression == "deflate" and length >= COMPRESSION_THRESHOLD:
+                compressed = zlib.compress(payload)
+                if len(compressed) < length:
+                    payload, length = compressed, len(compressed) | COMPRESSED_FLAG
+            data = FRAME_HEADER.pack(length) + payload
+        else:
+            data = payload + b"\n"
+        future = asyncio.get_running_loop().create_future()
+        action = request.get("action")
+        self.pending.append((action, index, time.perf_counter(), future))
+        if self.output is not None:
+            self.output.write(b"Q", self.number, body)
+        self.writer.write(data)
+        return future
+
+    async def read_loop(self):
+        try:
+            while True:
+                if self.framing == "binary":
+                    header = await self.reader.readexactly(FRAME_HEADER.size)
+                    (length,) = FRAME_HEADER.unpack(header)
+                    payload = await self.reader.readexactly(length & ~COMPRESSED_FLAG)
+                    if length & COMPRESSED_FLAG:
+                        payload = zlib.decompress(payload)
+                else:
+                    payload = await self.reader.readline()
+                    if not payload:
+                        break
+                reply = json.loads(payload)
+                if "push" in reply or not self.pending:
+                    continue
+                action, index, sent, future = self.pending.popleft()
+                self.stats.record(action, time.perf_counter() - sent, reply.get("status") == "success")
+                if self.output is not None:
+                    self.output.write(b"R", self.number, payload)
+                self.compare(action, index, reply)
+                if action == "negotiate" and reply.get("status") == "success":
+                    self.framing = reply["framing"]
+                    self.compression = reply.get("compression")
+                future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            while self.pending:
+                action, index, sent, future = self.pending.popleft()
+                self.stats.record(action, time.perf_counter() - sent, False)
+                if not future.done():
+                    future.set_result({"status": "error", "message": "Connection lost"})
+
+    def compare(self, action, index, reply):
+        # Ids in later requests are the captured ones, so they are learned from the captured reply.
+        captured = self.captured.requests[index][2]
+        if captured is not None:
+            self.learn_ids(json.loads(captured), reply)
+        expected = None
+        if self.baseline is not None and index < len(self.baseline.requests):
+            expected = self.baseline.requests[index][2]
+        if expected is None or action in UNCOMPARED_ACTIONS:
+            return
+        expected = json.loads(expected)
+        self.stats.compared[action] += 1
+        path = first_difference(strip_ignored(expected), strip_ignored(reply))
+        if path is not None:
+            self.stats.diffs[action] += 1
+            if len(self.stats.examples) < self.options.show_diffs:
+                self.stats.examples.append((action, path, expected, reply))
+
+    def learn_ids(self, expected, actual):
+        """Maps captured file/upload ids and epochs to the ones this server handed out for the same reply."""
+        if isinstance(expected, dict) and isinstance(actual, dict):
+            for key, value in expected.items():
+                if key in MAPPED_FIELDS and isinstance(value, str) and isinstance(actual.get(key), str):
+                    self.id_map[value] = actual[key]
+                elif key in actual:
+                    self.learn_ids(value, actual[key])
+        elif isinstance(expected, list) and isinstance(actual, list):
+            for left, right in zip(expected, actual):
+                self.learn_ids(left, right)
+
+class Clock:
+    """Maps captured timestamps onto the replay's timeline at the chosen speed (None: no waiting)."""
+    def __init__(self, first_micros, speed):
+        self.first = first_micros
+        self.speed = speed
+        self.started = time.monotonic()
+
+    async def wait(self, micros):
+        if self.speed is None:
+            return
+        delay = self.started + (micros - self.first) / 1e6 / self.speed - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def main_async(options):
+    connections = load_connections(options.capture)
+    if not connections:
+        raise SystemExit("No connections in capture")
+    baseline = connections
+    if options.baseline:
+        baseline = load_connections(options.baseline)
+        if len(baseline) != len(connections):
+            print("Baseline has {} connections, capture has {}; comparing the first {}".format(
+                len(baseline), len(connections), min(len(baseline), len(connections))))
+    requests = sum(len(conn.requests) for conn in connections)
+    first = connections[0].opened
+    last = max(max([conn.opened, conn.closed or 0] + [entry[0] for entry in conn.requests]) for conn in connections)
+    print("Replaying {} requests on {} connections ({:.1f}s captured) at {}...".format(
+        requests, len(connections), (last - first) / 1e6,
+        "max speed" if options.speed is None else "{:g}x".format(options.speed)))
+
+    stats = Stats()
+    id_map = {}
+    output = CaptureWriter(options.output) if options.output else None
+    clock = Clock(first, options.speed)
+    cpu_client = time.process_time()
+    cpu_server = cpu_seconds(options.server_pid) if options.server_pid else None
+    replayers = [Replayer(number + 1, conn, baseline[number] if number < len(baseline) else None,
+                          clock, options, stats, id_map, output)
+                 for number, conn in enumerate(connections)]
+    results = await asyncio.gather(*(replayer.run() for replayer in replayers), return_exceptions=True)
+    elapsed = time.monotonic() - clock.started
+    cpu_client = time.process_time() - cpu_client
+    if cpu_server is not None:
+        cpu_server = cpu_seconds(options.server_pid) - cpu_server
+    if output is not None:
+        output.close()
+    failed = [result for result in results if isinstance(result, Exception)]
+
+    total = sum(len(values) for values in stats.latencies.values())
+    print()
+    print("{:<20} {:>9} {:>9} {:>7} {:>7} {:>9} {:>9} {:>9}".format(
+        "action", "requests", "req/s", "errors", "diffs", "p50 ms", "p95 ms", "p99 ms"))
+    for action in sorted(stats.latencies, key=str):
+        values = sorted(stats.latencies[action])
+        diffs = "{}/{}".format(stats.diffs[action], stats.compared[action]) if stats.compared[action] else "-"
+        print("{:<20} {:>9} {:>9.0f} {:>7} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            str(action), len(values), len(values) / elapsed, stats.errors[action], diffs,
+            percentile(values, 0.50) * 1000, percentile(values, 0.95) * 1000, percentile(values, 0.99) * 1000))
+    print("{:<20} {:>9} {:>9.0f} {:>7} {:>7}".format("total", total, total / elapsed, sum(stats.errors.values()),
+                                                     sum(stats.diffs.values())))
+    print("elapsed: {:.1f}s, cpu: replay {:.2f}s".format(elapsed, cpu_client), end="")
+    if cpu_server is not None:
+        print(", server {:.2f}s ({:.0f} us/request)".format(cpu_server, cpu_server * 1e6 / max(total, 1)), end="")
+    print()
+    if failed:
+        print("{} connections failed, e.g. {!r}".format(len(failed), failed[0]))
+    if stats.examples:
+        print()
+        print("first differing replies:")
+        for action, path, expected, actual in stats.examples:
+            print("  {} at {}".format(action, path))
+            print("    expected {}".format(json.dumps(expected)[:200]))
+            print("    got      {}".format(json.dumps(actual)[:200]))
+
+def parse_speed(text):
+    if text == "max":
+        return None
+    speed = float(text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("capture", nargs="+", help="capture file(s); a cluster writes one per worker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--speed", type=parse_speed, default=1.0,
+                        help="time compression factor, or 'max' to send each request as soon as the last is answered")
+    parser.add_argument("--baseline", nargs="+",
+                        help="diff replies against this capture (e.g. an earlier --output) instead of the captured ones")
+    parser.add_argument("--output", help="write what was sent and received here, as a capture")
+    parser.add_argument("--show-diffs", type=int, default=5, help="differing replies to print")
+    parser.add_argument("--server-pid", type=int, help="report this process's CPU time (and its children's)")
+    parser.add_argument("--spawn", choices=["threaded", "async", "cluster"],
+                        help="start a fresh local server in this mode for the replay")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes for --spawn cluster")
+    options = parser.parse_args()
+    server = None
+    if options.spawn:
+        server = spawn_server(options.spawn, options.port, options.workers)
+        options.server_pid = server.pid
+        time.sleep(1.5)
+    try:
+        asyncio.run(main_async(options))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+if __name__ == "__main__":
+    main()
@@ -7,29 +7,679 @@ import json
 import time
 import base64
 import os
+import struct
+import zlib
+import queue
+import sqlite3
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Default server details
 SERVER_IP = "127.0.0.1"
 SERVER_PORT = 12345
+# Bytes per file_chunk / file_fetch request.
+FILE_CHUNK_SIZE = 256 * 1024
+# Binary framing: 4-byte big-endian payload length, then the JSON payload.
+FRAME_HEADER = struct.Struct(">I")
+# Negotiated compression: a length word with COMPRESSED_FLAG set is followed by a zlib stream.
+# Requests under COMPRESSION_THRESHOLD bytes are not worth the CPU and go out as they are.
+COMPRESSED_FLAG = 0x80000000
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+# Heartbeats keep the session from being closed as idle; the server's reply can change the interval.
+HEARTBEAT_MS = 30000
+# Background threads that run network calls for the UI, and how often (ms) the UI collects their results.
+IO_WORKERS = 4
+UI_DRAIN_MS = 20
+# Chat windows: lines received within one frame are inserted together; each window keeps at most
+# MAX_SCROLLBACK_LINES in the widget, and trimmed lines (up to ARCHIVE_LINES) come back a page at a time on scroll-up.
+CHAT_FRAME_MS = 16
+MAX_SCROLLBACK_LINES = 1000
+HISTORY_PAGE_LINES = 200
+ARCHIVE_LINES = 20000
+# Server-side history: messages fetched per get_history page, hits per search_messages page.
+SERVER_HISTORY_PAGE = 50
+SEARCH_PAGE = 20
+# Local cache of conversations, buddies and sync cursors: one SQLite file per server and user.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".legacychat")
+# Messages per get_history page when catching a cached conversation up with the server.
+SYNC_PAGE = 500
 
-def send_request(request):
+class ClientSession:
     """
-    Opens a new socket connection, sends JSON (terminated by a newline),
-    and waits for a JSON reply.
+    Keeps one connection to the server open and sends every request over it.
+    Requests are tagged with an "id" that the server echoes back, so a
+    background reader can hand each reply to the caller waiting for it.
+    A dropped connection is re-established on the next request.
+    With framing="binary" the session negotiates length-prefixed frames on
+    connect and quietly stays on newline-delimited JSON if the server refuses.
+    compression="deflate" also asks for large frames to be compressed both ways.
     """
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((SERVER_IP, SERVER_PORT))
-            s.sendall((json.dumps(request) + "\n").encode("utf-8"))
-            data = ""
-            while "\n" not in data:
-                chunk = s.recv(4096).decode("utf-8")
-                if not chunk:
+    def __init__(self, host=None, port=None, timeout=30, framing="line", compression=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.framing = framing
+        self.compression = compression
+        self.sock = None
+        # sock_framing / sock_compression: what was actually negotiated on self.sock
+        self.sock_framing = "line"
+        self.sock_compression = None
+        self.next_id = 0
+        # pending: request id -> [threading.Event, response, socket it was sent on]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        # subscription: {'username', 'callback', 'last_seq', 'epoch', 'on_reset', 'syncing', 'held', 'lock'}
+        # while pushes are wanted
+        self.subscription = None
+
+    def connect(self):
+        with self.lock:
+            if self.sock is not None:
+                return self.sock
+            host = self.host or SERVER_IP
+            port = self.port or SERVER_PORT
+            sock = socket.create_connection((host, port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                framing, compression = self.negotiate(sock)
+            except (OSError, ValueError):
+                sock.close()
+                raise OSError("Could not negotiate with server")
+            sock.settimeout(None)
+            self.sock = sock
+            self.sock_framing = framing
+            self.sock_compression = compression
+        threading.Thread(target=self.read_loop, args=(sock, framing), daemon=True).start()
+        return sock
+
+    def negotiate(self, sock):
+        """Asks for binary frames (and compression) before anything else is sent; returns (framing, compression)."""
+        if self.framing != "binary":
+            return "line", None
+        request = {"action": "negotiate", "framing": "binary"}
+        if self.compression:
+            request["compression"] = self.compression
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(1)
+            if not chunk:
+                raise OSError("Connection closed during negotiation")
+            data += chunk
+        reply = json.loads(data)
+        if reply.get("status") == "success":
+            # Older servers leave compression out of the reply.
+            return "binary", reply.get("compression")
+        return "line", None
+
+    def encode(self, request, framing, compression=None):
+        payload = json.dumps(request).encode("utf-8")
+        if framing == "binary":
+            if compression == "deflate" and len(payload) >= COMPRESSION_THRESHOLD:
+                compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+                if len(compressed) < len(payload):
+                    return FRAME_HEADER.pack(len(compressed) | COMPRESSED_FLAG) + compressed
+            return FRAME_HEADER.pack(len(payload)) + payload
+        return payload + b"\n"
+
+    def close(self):
+        with self.lock:
+            sock = self.sock
+        if sock is not None:
+            self.disconnect(sock)
+
+    def disconnect(self, sock):
+        """Drops the given connection and fails every request still waiting on it."""
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+            pending = [slot for slot in self.pending.values() if slot[2] is sock]
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for slot in pending:
+            slot[0].set()
+
+    def read_loop(self, sock, framing):
+        buffer = bytearray()
+        chunk = memoryview(bytearray(65536))
+        try:
+            while True:
+                count = sock.recv_into(chunk)
+                if not count:
                     break
-                data += chunk
-            return json.loads(data.strip())
-    except Exception as e:
-        return {"status": "error", "message": str(e)}
+                start = len(buffer)
+                buffer += chunk[:count]
+                if framing == "binary":
+                    while len(buffer) >= FRAME_HEADER.size:
+                        (length,) = FRAME_HEADER.unpack_from(buffer)
+                        end = FRAME_HEADER.size + (length & ~COMPRESSED_FLAG)
+                        if len(buffer) < end:
+                            break
+                        payload = bytes(memoryview(buffer)[FRAME_HEADER.size:end])
+                        # Deleting from the front of a bytearray does not copy the rest.
+                        del buffer[:end]
+                        if length & COMPRESSED_FLAG:
+                            payload = zlib.decompress(payload)
+                        self.dispatch(json.loads(payload))
+                    continue
+                newline = buffer.find(b"\n", start)
+                while newline >= 0:
+                    line = bytes(memoryview(buffer)[:newline])
+                    del buffer[:newline + 1]
+                    if line.strip():
+                        self.dispatch(json.loads(line))
+                    newline = buffer.find(b"\n")
+        except (OSError, ValueError, zlib.error):
+            pass
+        finally:
+            self.disconnect(sock)
+            if self.subscription is not None:
+                threading.Thread(target=self.restore_subscription, daemon=True).start()
+
+    def dispatch(self, response):
+        if "id" not in response:
+            if response.get("push") == "message":
+                self.receive_pushed(response["message"])
+            return
+        with self.lock:
+            slot = self.pending.get(response.get("id"))
+        if slot is not None:
+            slot[1] = response
+            slot[0].set()
+
+    def request(self, request):
+        """Sends one request and blocks until its reply arrives."""
+        return self.pipeline([request])[0]
+
+    def pipeline(self, requests):
+        """
+        Writes several requests back to back without waiting for replies in between,
+        then collects the replies in request order.
+        """
+        for attempt in range(2):
+            try:
+                sock = self.connect()
+            except OSError as e:
+                return [{"status": "error", "message": str(e)} for request in requests]
+            with self.lock:
+                slots = {}
+                for request in requests:
+                    self.next_id += 1
+                    slots[self.next_id] = [threading.Event(), None, sock]
+                self.pending.update(slots)
+                framing = self.sock_framing
+                compression = self.sock_compression
+            try:
+                payload = b"".join(self.encode(dict(request, id=request_id), framing, compression)
+                                   for request, request_id in zip(requests, slots))
+                try:
+                    with self.send_lock:
+                        sock.sendall(payload)
+                except OSError:
+                    # Stale connection: reconnect and resend once.
+                    self.disconnect(sock)
+                    continue
+                deadline = time.monotonic() + self.timeout
+                responses = []
+                for slot in slots.values():
+                    if not slot[0].wait(max(deadline - time.monotonic(), 0)):
+                        responses.append({"status": "error", "message": "Request timed out"})
+                    elif slot[1] is None:
+                        responses.append({"status": "error", "message": "Connection to server lost"})
+                    else:
+                        slot[1].pop("id", None)
+                        responses.append(slot[1])
+                return responses
+            finally:
+                with self.lock:
+                    for request_id in slots:
+                        self.pending.pop(request_id, None)
+        return [{"status": "error", "message": "Could not reach server"} for request in requests]
+
+    def send_nowait(self, request):
+        """Sends a request without an id, for fire-and-forget calls like ack; the reply is dropped."""
+        try:
+            sock = self.connect()
+            with self.lock:
+                framing = self.sock_framing
+                compression = self.sock_compression
+            with self.send_lock:
+                sock.sendall(self.encode(request, framing, compression))
+        except OSError:
+            pass
+
+    def batch(self, requests):
+        """Runs several requests in one server round-trip; returns their replies in order."""
+        res = self.request({"action": "batch", "requests": requests})
+        if res.get("status") != "success":
+            return [res for request in requests]
+        return res["results"]
+
+    def subscribe(self, username, on_messages, last_seq=0, epoch=None, on_reset=None):
+        """
+        Asks the server to push new messages over this session.
+        on_messages is called with lists of messages, each exactly once and in
+        sequence order, and everything handed over is acked. last_seq resumes
+        after a sequence number handed over by an earlier session of server epoch
+        epoch. Should the server's mailbox have started over since (a new epoch),
+        on_reset is called with the new epoch before its messages are handed over.
+        """
+        self.subscription = {"username": username, "callback": on_messages, "last_seq": last_seq,
+                             "epoch": epoch, "on_reset": on_reset,
+                             "syncing": True, "held": [], "lock": threading.Lock()}
+        res = self.resubscribe()
+        if res.get("status") != "success":
+            self.subscription = None
+        return res
+
+    def resubscribe(self):
+        """
+        Subscribes (again) from the last seen sequence number and pages through the backlog.
+        Pushes that race with the paging are held back and replayed afterwards.
+        """
+        subscription = self.subscription
+        with subscription["lock"]:
+            subscription["syncing"] = True
+        request = {"action": "subscribe", "username": subscription["username"], "since": subscription["last_seq"]}
+        page = self.request(self.with_epoch(subscription, request))
+        res = page
+        if page.get("reset"):
+            # The server's mailbox was started over; its sequence numbers begin again at 1.
+            with subscription["lock"]:
+                subscription["last_seq"] = 0
+            if subscription["on_reset"] is not None:
+                subscription["on_reset"](page.get("epoch"))
+        if page.get("epoch") is not None:
+            subscription["epoch"] = page["epoch"]
+        while page.get("status") == "success":
+            with subscription["lock"]:
+                self.accept(subscription, page.get("messages", []))
+            if not page.get("more"):
+                with subscription["lock"]:
+                    held, subscription["held"] = subscription["held"], []
+                    subscription["syncing"] = False
+                    self.accept(subscription, held)
+                return res
+            request = {"action": "get_messages", "username": subscription["username"],
+                       "since": subscription["last_seq"]}
+            page = self.request(self.with_epoch(subscription, request))
+        return page
+
+    @staticmethod
+    def with_epoch(subscription, request):
+        """Tags a request carrying sequence numbers with the epoch they belong to, once it is known."""
+        if subscription["epoch"] is not None:
+            request["epoch"] = subscription["epoch"]
+        return request
+
+    def receive_pushed(self, msg):
+        subscription = self.subscription
+        if subscription is None:
+            return
+        with subscription["lock"]:
+            if subscription["syncing"]:
+                subscription["held"].append(msg)
+            else:
+                self.accept(subscription, [msg])
+
+    def accept(self, subscription, messages):
+        """Hands over messages newer than the last one seen and acks them. Caller holds the subscription lock."""
+        fresh = [msg for msg in messages if msg.get("seq", 0) > subscription["last_seq"]]
+        if not fresh:
+            return
+        subscription["last_seq"] = fresh[-1]["seq"]
+        subscription["callback"](fresh)
+        self.send_nowait(self.with_epoch(subscription, {"action": "ack", "username": subscription["username"],
+                                                        "seq": subscription["last_seq"]}))
+
+    def restore_subscription(self):
+        """Reconnects after the server dropped us and subscribes again, backing off between tries."""
+        delay = 1
+        while self.subscription is not None:
+            if self.resubscribe().get("status") == "success":
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+
+session = ClientSession(framing="binary", compression="deflate")
+
+def send_request(request):
+    """
+    Sends a JSON request over the shared persistent session
+    and waits for the matching JSON reply.
+    """
+    return session.request(request)
+
+def upload_file(sender, recipient, file_path):
+    """
+    Uploads a file in chunks so it never has to fit in memory.
+    After a failed chunk, asks the server how much it has and resumes from there.
+    """
+    size = os.path.getsize(file_path)
+    res = send_request({
+        "action": "file_begin",
+        "sender": sender,
+        "recipient": recipient,
+        "filename": os.path.basename(file_path),
+        "size": size
+    })
+    if res.get("status") != "success":
+        return res
+    upload_id = res["upload_id"]
+    offset = res["offset"]
+    retries = 0
+    with open(file_path, "rb") as f:
+        while offset < size:
+            f.seek(offset)
+            chunk = f.read(FILE_CHUNK_SIZE)
+            res = send_request({
+                "action": "file_chunk",
+                "upload_id": upload_id,
+                "offset": offset,
+                "data": base64.b64encode(chunk).decode("ascii")
+            })
+            if res.get("status") == "success":
+                offset = res["offset"]
+                retries = 0
+                continue
+            retries += 1
+            if retries > 5:
+                return res
+            time.sleep(retries)
+            status = send_request({"action": "file_status", "upload_id": upload_id})
+            if status.get("status") == "success":
+                offset = status["offset"]
+    return send_request({"action": "file_commit", "upload_id": upload_id})
+
+def download_file(file_id, save_path):
+    """Streams a file from the server to save_path one chunk at a time."""
+    offset = 0
+    with open(save_path, "wb") as f:
+        while True:
+            res = send_request({
+                "action": "file_fetch",
+                "file_id": file_id,
+                "offset": offset,
+                "length": FILE_CHUNK_SIZE
+            })
+            if res.get("status") != "success":
+                return res
+            data = base64.b64decode(res["data"])
+            f.write(data)
+            offset += len(data)
+            if res.get("eof"):
+                return {"status": "success"}
+
+def conversation_key(conversation):
+    """The cache key of {"with": buddy_username} or {"group": group_name}: "with:<buddy>" or "group:<name>"."""
+    (kind, name), = conversation.items()
+    return f"{kind}:{name}"
+
+class HistoryCache:
+    """
+    A local SQLite copy of the user's conversations, buddy list, statuses and sync
+    cursors, so a restarted client can draw everything at once and then only ask
+    the server for what changed.
+
+    Each conversation caches one unbroken run of its server history, ending at the
+    newest message synced: catching up pages forwards from there, and scrolling up
+    pages backwards from the oldest cached message. Messages are keyed by
+    (conversation, id), so a page of any conversation is a single index range
+    read however long it is.
+
+    Everything is only valid for one server epoch: when a reply reports another,
+    check_epoch empties the cache, since the new server's sequence numbers and
+    history ids do not continue the old ones.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Used from the Tk thread and the I/O workers, one at a time.
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS messages (conversation TEXT, id INTEGER, sender TEXT, "
+                            "message TEXT, time REAL, PRIMARY KEY (conversation, id)) WITHOUT ROWID")
+            # complete: the cached run reaches back to the conversation's first message
+            self.db.execute("CREATE TABLE IF NOT EXISTS conversations (conversation TEXT PRIMARY KEY, "
+                            "complete INTEGER NOT NULL DEFAULT 0)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS buddies (username TEXT PRIMARY KEY, name TEXT, status TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+
+    @staticmethod
+    def path_for(host, port, username):
+        name = urllib.parse.quote(f"{host}_{port}_{username}", safe="")
+        return os.path.join(CACHE_DIR, name + ".db")
+
+    def get_state(self, key, default=None):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_state(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def check_epoch(self, epoch):
+        """
+        Records the server epoch a reply reported. If it differs from the cached one, drops
+        cached messages, statuses and cursors first and returns True. None (an older server) is ignored.
+        """
+        if epoch is None:
+            return False
+        with self.lock:
+            row = self.db.execute("SELECT value FROM state WHERE key = 'epoch'").fetchone()
+            if row is not None and json.loads(row[0]) == epoch:
+                return False
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM messages")
+            self.db.execute("DELETE FROM conversations")
+            self.db.execute("DELETE FROM state")
+            self.db.execute("UPDATE buddies SET status = NULL")
+            self.db.execute("INSERT INTO state (key, value) VALUES ('epoch', ?)", (json.dumps(epoch),))
+            self.db.execute("COMMIT")
+        return True
+
+    def buddies(self):
+        """Returns (buddy_username -> name, buddy_username -> last known status)."""
+        with self.lock:
+            rows = self.db.execute("SELECT username, name, status FROM buddies").fetchall()
+        return ({username: name for username, name, status in rows},
+                {username: status for username, name, status in rows if status is not None})
+
+    def save_buddies(self, buddies, statuses):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM buddies")
+            self.db.executemany("INSERT INTO buddies (username, name, status) VALUES (?, ?, ?)",
+                                [(username, name, statuses.get(username)) for username, name in buddies.items()])
+            self.db.execute("COMMIT")
+
+    def save_statuses(self, statuses):
+        with self.lock:
+            self.db.executemany("UPDATE buddies SET status = ? WHERE username = ?",
+                                [(status, username) for username, status in statuses.items()])
+
+    def page(self, key, before, limit):
+        """Up to limit cached messages of a conversation with ids below before (None: the newest), oldest first."""
+        with self.lock:
+            rows = self.db.execute("SELECT id, sender, message, time FROM messages WHERE conversation = ? "
+                                   "AND id < ? ORDER BY id DESC LIMIT ?",
+                                   (key, before if before is not None else 2 ** 63 - 1, limit)).fetchall()
+        rows.reverse()
+        return [{"id": history_id, "from": sender, "message": message, "time": when}
+                for history_id, sender, message, when in rows]
+
+    def conversations(self):
+        """conversation key -> id of its newest cached message (None if nothing is cached yet)."""
+        with self.lock:
+            rows = self.db.execute("SELECT c.conversation, (SELECT MAX(id) FROM messages m "
+                                   "WHERE m.conversation = c.conversation) FROM conversations c").fetchall()
+        return dict(rows)
+
+    def newest(self, key):
+        """Id of the newest cached message of a conversation, or None."""
+        with self.lock:
+            row = self.db.execute("SELECT MAX(id) FROM messages WHERE conversation = ?", (key,)).fetchone()
+        return row[0]
+
+    def is_complete(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT complete FROM conversations WHERE conversation = ?", (key,)).fetchone()
+        return bool(row and row[0])
+
+    def store(self, key, messages, complete=False):
+        """Adds messages extending the cached run; complete marks that it now reaches the first message."""
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute("INSERT OR IGNORE INTO conversations (conversation) VALUES (?)", (key,))
+            self.db.executemany("INSERT OR IGNORE INTO messages (conversation, id, sender, message, time) "
+                                "VALUES (?, ?, ?, ?, ?)",
+                                [(key, msg["id"], msg.get("from"), msg.get("message"), msg.get("time"))
+                                 for msg in messages])
+            if complete:
+                self.db.execute("UPDATE conversations SET complete = 1 WHERE conversation = ?", (key,))
+            self.db.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def sync_history(cache, username, newest):
+    """
+    Catches cached conversations up with the server and returns {key: new messages, oldest first}.
+    newest maps each conversation key to the id of its newest cached message, or None
+    to fetch just the latest page. Every round is one batch covering all conversations
+    still behind, so a restart costs one round-trip when little has changed.
+    """
+    new = {key: [] for key in newest}
+    cursors = dict(newest)
+    while cursors:
+        keys = list(cursors)
+        requests = []
+        for key in keys:
+            kind, _, name = key.partition(":")
+            request = {"action": "get_history", "username": username, kind: name}
+            if cursors[key] is None:
+                request["limit"] = SERVER_HISTORY_PAGE
+            else:
+                request["after"] = cursors[key]
+                request["limit"] = SYNC_PAGE
+            requests.append(request)
+        results = session.batch(requests)
+        if any(cache.check_epoch(res.get("epoch")) for res in results if res.get("status") == "success"):
+            # The server started over and the cache with it: fetch the latest page of each conversation.
+            new = {key: [] for key in newest}
+            cursors = dict.fromkeys(newest)
+            continue
+        for key, request, res in zip(keys, requests, results):
+            if res.get("status") != "success":
+                del cursors[key]
+                continue
+            messages = res.get("messages", [])
+            # The latest page with nothing older means the cache holds the whole conversation.
+            cache.store(key, messages, complete="after" not in request and not res.get("more"))
+            new[key].extend(messages)
+            if "after" in request and res.get("more") and messages:
+                cursors[key] = messages[-1]["id"]
+            else:
+                del cursors[key]
+    return new
+
+class ChatLog:
+    """
+    The text of one chat window. Appended lines are buffered and inserted once
+    per frame; while the view follows the bottom, lines beyond max_lines are
+    trimmed from the top into an archive, and scrolling to the top pages them back in.
+    """
+    def __init__(self, display, max_lines=MAX_SCROLLBACK_LINES, page_lines=HISTORY_PAGE_LINES):
+        self.display = display
+        self.max_lines = max_lines
+        self.page_lines = page_lines
+        self.pending = []
+        self.flush_job = None
+        self.loading = False
+        # archive: trimmed lines, oldest first
+        self.archive = deque(maxlen=ARCHIVE_LINES)
+        # history_before / history_newest: ids of the oldest and newest history messages shown, None before any
+        self.history_before = None
+        self.history_newest = None
+        self.history_more = True
+        self.loading_history = False
+        # live: (sender, time) of messages shown as they arrived, so syncing history does not repeat them
+        self.live = set()
+        scrollbar_set = display.vbar.set
+        def on_scroll(first, last):
+            scrollbar_set(first, last)
+            self.scrolled(float(first))
+        display.config(yscrollcommand=on_scroll)
+
+    def append(self, text):
+        self.pending.append(text)
+        if self.flush_job is None:
+            self.flush_job = self.display.after(CHAT_FRAME_MS, self.flush)
+
+    def flush(self):
+        self.flush_job = None
+        if not self.pending:
+            return
+        following = self.display.yview()[1] >= 1.0
+        text = "".join(self.pending)
+        self.pending = []
+        self.display.config(state="normal")
+        self.display.insert(tk.END, text)
+        if following:
+            # Trimming while the user reads older lines would move the text under them.
+            self.trim()
+        self.display.config(state="disabled")
+        if following:
+            self.display.see(tk.END)
+
+    def trim(self):
+        excess = self.line_count() - self.max_lines
+        if excess > 0:
+            end = f"{excess + 1}.0"
+            self.archive.extend(self.display.get("1.0", end).splitlines(keepends=True))
+            self.display.delete("1.0", end)
+
+    def line_count(self):
+        return int(self.display.index("end-1c").split(".")[0])
+
+    def scrolled(self, first):
+        if first <= 0.0 and self.archive and not self.loading:
+            self.loading = True
+            self.display.after_idle(self.load_older)
+
+    def load_older(self):
+        """Puts back the newest page of archived lines above the view, keeping the view where it was."""
+        count = min(self.page_lines, len(self.archive))
+        lines = [self.archive.pop() for _ in range(count)]
+        lines.reverse()
+        self.display.config(state="normal")
+        self.display.insert("1.0", "".join(lines))
+        self.display.config(state="disabled")
+        self.display.yview(f"{count + 1}.0")
+        self.loading = False
+
+    def prepend(self, text):
+        """Adds older lines (from server history) above everything the window holds."""
+        if self.archive:
+            self.archive.extendleft(reversed(text.splitlines(keepends=True)))
+            return
+        self.display.config(state="normal")
+        self.display.insert("1.0", text)
+        self.display.config(state="disabled")
+
+    def cancel(self):
+        if self.flush_job is not None:
+            self.display.after_cancel(self.flush_job)
+            self.flush_job = None
 
 class LegacyChatApp:
     def __init__(self, root):
@@ -38,6 +688,8 @@ class LegacyChatApp:
         # Set a light blue background reminiscent of MSN Messenger
         self.root.configure(bg="#E7F3FF")
         self.username = None
+        # cache: HistoryCache of the logged-in user, opened at login
+        self.cache = None
         self.current_status = "online"
         # buddies: mapping buddy_username -> buddy_name
         self.buddies = {}
@@ -45,8 +697,86 @@ class LegacyChatApp:
         self.buddy_buttons = {}
         # chat_windows: mapping buddy_username -> (window, display_widget, entry_widget)
         self.chat_windows = {}
+        # groups: names of the groups we belong to, in buddy list order
+        self.groups = []
+        # group_windows: mapping group name -> (window, display_widget, entry_widget)
+        self.group_windows = {}
+        # chat_logs: display_widget -> ChatLog rendering it
+        self.chat_logs = {}
+        self.polling = False
+        # buddy_statuses: mapping buddy_username -> last known status
+        self.buddy_statuses = {}
+        # presence_version: server version of the last status refresh, 0 for a full refresh
+        self.presence_version = 0
+        self.refresh_job = None
+        self.refreshing = False
+        self.heartbeat_job = None
+        self.heartbeat_ms = HEARTBEAT_MS
+        # Network calls run on io_executor; their callbacks come back through ui_queue
+        # and run on the Tk thread, so the window never waits on the server.
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="legacychat-io")
+        self.ui_queue = queue.Queue()
+        # activity: texts of the calls in flight, the latest shown in the activity bar
+        self.activity = []
+        self.activity_label = tk.Label(self.root, text="", anchor="w", bg="#E7F3FF", fg="#555555",
+                                       font=("Segoe UI", 9))
+        self.activity_label.pack(side="bottom", fill="x")
+        self.root.after(UI_DRAIN_MS, self.drain_ui_queue)
         self.create_login_signup()
 
+    def run_in_background(self, work, on_done, busy=None, text="Working..."):
+        """
+        Runs work() on the I/O executor and calls on_done(result) on the Tk thread.
+        While it runs, text is shown in the activity bar and the busy widget
+        (usually the button that started it) is disabled.
+        """
+        self.activity.append(text)
+        self.show_activity()
+        if busy is not None:
+            busy.config(state="disabled")
+
+        def finish(res):
+            self.activity.remove(text)
+            self.show_activity()
+            if busy is not None and busy.winfo_exists():
+                busy.config(state="normal")
+            on_done(res)
+
+        def job():
+            try:
+                res = work()
+            except Exception as e:
+                res = {"status": "error", "message": str(e)}
+            self.ui_queue.put((finish, (res,)))
+        self.io_executor.submit(job)
+
+    def call_on_ui(self, callback, *args):
+        """Runs callback(*args) on the Tk thread; safe to call from any thread."""
+        self.ui_queue.put((callback, args))
+
+    def drain_ui_queue(self):
+        # Rescheduled first so an error in one callback cannot stop later results from arriving.
+        self.root.after(UI_DRAIN_MS, self.drain_ui_queue)
+        while True:
+            try:
+                callback, args = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                callback(*args)
+            except tk.TclError:
+                # The window the result was meant for has been closed.
+                pass
+
+    def show_activity(self):
+        self.activity_label.config(text=self.activity[-1] if self.activity else "")
+
+    def clear_root(self):
+        """Removes the current screen, keeping the activity bar."""
+        for widget in self.root.winfo_children():
+            if widget is not self.activity_label:
+                widget.destroy()
+
     def create_menu_bar(self):
         menu_bar = tk.Menu(self.root)
         account_menu = tk.Menu(menu_bar, tearoff=0)
@@ -58,41 +788,58 @@ class LegacyChatApp:
         self.root.config(menu=menu_bar)
 
     def update_status(self, new_status):
-        res = send_request({
+        def done(res):
+            if res.get("status") == "success":
+                self.current_status = new_status
+                messagebox.showinfo("Status Updated", f"Your status is now: {new_status}")
+                self.refresh_buddy_statuses()
+            else:
+                messagebox.showerror("Error", res.get("message"))
+        self.run_in_background(lambda: send_request({
             "action": "update_status",
             "username": self.username,
             "status": new_status
-        })
-        if res.get("status") == "success":
-            self.current_status = new_status
-            messagebox.showinfo("Status Updated", f"Your status is now: {new_status}")
-            self.refresh_buddy_statuses()
-        else:
-            messagebox.showerror("Error", res.get("message"))
+        }), done, text=f"Setting status to {new_status}...")
 
     def refresh_buddy_statuses(self):
         """
         Refresh each buddy's button text to include their current status.
-        Schedules itself to run every 5 seconds.
+        Only statuses that changed since the last refresh are fetched.
+        Schedules itself to run every 5 seconds; a refresh still in flight is not doubled up.
         """
-        for buddy_username, btn in self.buddy_buttons.items():
-            res = send_request({
-                "action": "get_buddy_status",
-                "username": self.username,
-                "buddy_username": buddy_username
-            })
+        if self.refresh_job is not None:
+            self.root.after_cancel(self.refresh_job)
+            self.refresh_job = None
+        if self.refreshing:
+            return
+        self.refreshing = True
+        request = {"action": "get_buddy_statuses", "username": self.username, "since": self.presence_version}
+
+        def done(res):
+            self.refreshing = False
             if res.get("status") == "success":
-                buddy_status = res.get("buddy_status", "offline")
-            else:
-                buddy_status = "unknown"
+                self.buddy_statuses.update(res.get("statuses", {}))
+                self.cache.save_statuses(res.get("statuses", {}))
+                # A buddy added meanwhile reset presence_version to 0; keep that full refresh pending.
+                if self.presence_version == request["since"]:
+                    self.presence_version = res.get("version", 0)
+                    self.cache.set_state("presence_version", self.presence_version)
+            self.show_buddy_statuses()
+            if self.refresh_job is not None:
+                self.root.after_cancel(self.refresh_job)
+            self.refresh_job = self.root.after(5000, self.refresh_buddy_statuses)
+        self.run_in_background(lambda: send_request(request), done, text="Refreshing buddy statuses...")
+
+    def show_buddy_statuses(self):
+        for buddy_username, btn in self.buddy_buttons.items():
+            buddy_status = self.buddy_statuses.get(buddy_username, "...")
             buddy_name = self.buddies.get(buddy_username, buddy_username)
-            btn.config(text=f"{buddy_name} ({buddy_status})")
-        self.root.after(5000, self.refresh_buddy_statuses)
+            if btn.winfo_exists():
+                btn.config(text=f"{buddy_name} ({buddy_status})")
 
     def create_login_signup(self):
         # Clear any widgets from the root.
-        for widget in self.root.winfo_children():
-            widget.destroy()
+        self.clear_root()
         frame = tk.Frame(self.root, bg="#E7F3FF")
         frame.pack(pady=20)
         tk.Label(frame, text="Welcome to LegacyChat", font=("Segoe UI", 16), bg="#E7F3FF").pack(pady=10)
@@ -114,15 +861,20 @@ class LegacyChatApp:
             if not username or not password:
                 messagebox.showerror("Error", "Username and password required")
                 return
-            res = send_request({"action": "signup", "username": username, "password": password})
-            if res.get("status") == "success":
-                messagebox.showinfo("Success", "Signup successful! Logging in...")
-                signup_win.destroy()
-                self.username = username
-                self.open_buddy_list()
-            else:
-                messagebox.showerror("Error", res.get("message"))
-        tk.Button(signup_win, text="Sign Up", command=attempt_signup).grid(row=2, columnspan=2, pady=10)
+            def done(res):
+                if res.get("status") == "success":
+                    messagebox.showinfo("Success", "Signup successful! Logging in...")
+                    signup_win.destroy()
+                    self.username = username
+                    self.cache = HistoryCache(HistoryCache.path_for(SERVER_IP, SERVER_PORT, username))
+                    self.open_buddy_list()
+                else:
+                    messagebox.showerror("Error", res.get("message"))
+            self.run_in_background(
+                lambda: send_request({"action": "signup", "username": username, "password": password}),
+                done, busy=signup_button, text="Signing up...")
+        signup_button = tk.Button(signup_win, text="Sign Up", command=attempt_signup)
+        signup_button.grid(row=2, columnspan=2, pady=10)
 
     def login_window(self):
         login_win = tk.Toplevel(self.root)
@@ -139,23 +891,59 @@ class LegacyChatApp:
             if not username or not password:
                 messagebox.showerror("Error", "Username and password required")
                 return
-            res = send_request({"action": "login", "username": username, "password": password})
-            if res.get("status") == "success":
-                messagebox.showinfo("Success", "Login successful!")
-                login_win.destroy()
-                self.username = username
-                buddies = res.get("buddies", [])
-                for buddy in buddies:
-                    self.buddies[buddy["username"]] = buddy["name"]
-                self.open_buddy_list()
-            else:
-                messagebox.showerror("Error", res.get("message"))
-        tk.Button(login_win, text="Log In", command=attempt_login).grid(row=2, columnspan=2, pady=10)
+            # A cache from an earlier session supplies statuses, so only changes since then are fetched.
+            cache_path = HistoryCache.path_for(SERVER_IP, SERVER_PORT, username)
+            cache = HistoryCache(cache_path) if os.path.exists(cache_path) else None
+            since = cache.get_state("presence_version", 0) if cache is not None else 0
+            def done(results):
+                res, statuses = results
+                if res.get("status") == "success":
+                    messagebox.showinfo("Success", "Login successful!")
+                    login_win.destroy()
+                    self.username = username
+                    self.cache = cache or HistoryCache(cache_path)
+                    if self.cache.check_epoch(res.get("epoch")) and since:
+                        # The statuses are changes since a version of a server that has since started over.
+                        statuses = {}
+                    cached_buddies, cached_statuses = self.cache.buddies()
+                    buddies = res.get("buddies", [])
+                    for buddy in buddies:
+                        self.buddies[buddy["username"]] = buddy["name"]
+                        if buddy["username"] in cached_statuses:
+                            self.buddy_statuses[buddy["username"]] = cached_statuses[buddy["username"]]
+                    if statuses.get("status") == "success":
+                        self.buddy_statuses.update(statuses.get("statuses", {}))
+                        self.presence_version = statuses.get("version", 0)
+                        self.cache.set_state("presence_version", self.presence_version)
+                    self.cache.save_buddies(self.buddies, self.buddy_statuses)
+                    self.groups = self.cache.get_state("groups", [])
+                    self.open_buddy_list()
+                    self.sync_cache()
+                else:
+                    if cache is not None:
+                        cache.close()
+                    messagebox.showerror("Error", res.get("message"))
+            # Log in and load buddy statuses in one round-trip.
+            def work():
+                try:
+                    return session.batch([
+                        {"action": "login", "username": username, "password": password},
+                        {"action": "get_buddy_statuses", "username": username, "since": since}
+                    ])
+                except Exception as e:
+                    return [{"status": "error", "message": str(e)}] * 2
+            self.run_in_background(work, done, busy=login_button, text="Logging in...")
+        login_button = tk.Button(login_win, text="Log In", command=attempt_login)
+        login_button.grid(row=2, columnspan=2, pady=10)
+
+    def sync_cache(self):
+        """Brings every cached conversation up to date in the background, in one batch per round."""
+        self.run_in_background(lambda: sync_history(self.cache, self.username, self.cache.conversations()),
+                               lambda new: None, text="Syncing history...")
 
     def open_buddy_list(self):
         # Clear the root.
-        for widget in self.root.winfo_children():
-            widget.destroy()
+        self.clear_root()
         self.create_menu_bar()
         frame = tk.Frame(self.root, bg="#E7F3FF")
         frame.pack(pady=20)
@@ -164,14 +952,68 @@ class LegacyChatApp:
         list_frame.pack(pady=10)
         self.buddy_buttons = {}
         for buddy_username, buddy_name in self.buddies.items():
-            btn = tk.Button(list_frame, text=buddy_name, width=25,
+            buddy_status = self.buddy_statuses.get(buddy_username, "...")
+            btn = tk.Button(list_frame, text=f"{buddy_name} ({buddy_status})", width=25,
                             command=lambda bu=buddy_username: self.open_chat(bu))
             btn.pack(pady=5)
             self.buddy_buttons[buddy_username] = btn
         tk.Button(frame, text="Add Buddie", command=self.add_buddy_window, width=20).pack(pady=5)
+        tk.Label(frame, text="Groups", font=("Segoe UI", 12), bg="#E7F3FF").pack(pady=(15, 5))
+        group_frame = tk.Frame(frame, bg="#E7F3FF")
+        group_frame.pack(pady=5)
+        for group_name in self.groups:
+            tk.Button(group_frame, text=group_name, width=25,
+                      command=lambda g=group_name: self.open_group_chat(g)).pack(pady=5)
+        tk.Button(frame, text="Create or Join Group", command=self.join_group_window, width=20).pack(pady=5)
+        tk.Button(frame, text="Search Messages", command=lambda: self.search_window({}), width=20).pack(pady=5)
         # Start polling for new messages and refreshing buddy statuses.
         self.start_polling()
         self.refresh_buddy_statuses()
+        self.refresh_groups(group_frame)
+
+    def refresh_groups(self, group_frame):
+        """Fetches our groups and rebuilds their buttons if the list changed."""
+        def done(res):
+            if res.get("status") != "success" or res.get("groups") == self.groups:
+                return
+            self.groups = res["groups"]
+            self.cache.set_state("groups", self.groups)
+            if not group_frame.winfo_exists():
+                return
+            for widget in group_frame.winfo_children():
+                widget.destroy()
+            for group_name in self.groups:
+                tk.Button(group_frame, text=group_name, width=25,
+                          command=lambda g=group_name: self.open_group_chat(g)).pack(pady=5)
+        self.run_in_background(lambda: send_request({"action": "group_list", "username": self.username}), done)
+
+    def join_group_window(self):
+        join_win = tk.Toplevel(self.root)
+        join_win.title("Create or Join Group")
+        tk.Label(join_win, text="Group Name:").grid(row=0, column=0, padx=5, pady=5)
+        group_entry = tk.Entry(join_win)
+        group_entry.grid(row=0, column=1, padx=5, pady=5)
+        def attempt(action):
+            group_name = group_entry.get().strip()
+            if not group_name:
+                messagebox.showerror("Error", "Please enter a group name.")
+                return
+            def done(res):
+                if res.get("status") == "success":
+                    if group_name not in self.groups:
+                        self.groups.append(group_name)
+                    join_win.destroy()
+                    self.open_buddy_list()  # refresh list
+                    self.open_group_chat(group_name)
+                else:
+                    messagebox.showerror("Error", res.get("message"))
+            self.run_in_background(lambda: send_request({
+                "action": action,
+                "username": self.username,
+                "group": group_name
+            }), done, text="Joining group...")
+        tk.Button(join_win, text="Create", command=lambda: attempt("group_create")).grid(row=1, column=0, pady=10)
+        tk.Button(join_win, text="Join", command=lambda: attempt("group_join")).grid(row=1, column=1, pady=10)
 
     def add_buddy_window(self):
         add_win = tk.Toplevel(self.root)
@@ -188,20 +1030,25 @@ class LegacyChatApp:
             if not buddy_username or not buddy_name:
                 messagebox.showerror("Error", "Please fill all fields.")
                 return
-            res = send_request({
+            def done(res):
+                if res.get("status") == "success":
+                    messagebox.showinfo("Success", "Buddy added!")
+                    self.buddies[buddy_username] = buddy_name
+                    # The new buddy's status may predate our last version, so fetch everything.
+                    self.presence_version = 0
+                    self.cache.save_buddies(self.buddies, self.buddy_statuses)
+                    add_win.destroy()
+                    self.open_buddy_list()  # refresh list
+                else:
+                    messagebox.showerror("Error", res.get("message"))
+            self.run_in_background(lambda: send_request({
                 "action": "add_buddy",
                 "username": self.username,
                 "buddy_username": buddy_username,
                 "buddy_name": buddy_name
-            })
-            if res.get("status") == "success":
-                messagebox.showinfo("Success", "Buddy added!")
-                self.buddies[buddy_username] = buddy_name
-                add_win.destroy()
-                self.open_buddy_list()  # refresh list
-            else:
-                messagebox.showerror("Error", res.get("message"))
-        tk.Button(add_win, text="Add", command=attempt_add).grid(row=2, columnspan=2, pady=10)
+            }), done, busy=add_button, text="Adding buddy...")
+        add_button = tk.Button(add_win, text="Add", command=attempt_add)
+        add_button.grid(row=2, columnspan=2, pady=10)
 
     def open_chat(self, buddy_username):
         if buddy_username in self.chat_windows:
@@ -221,6 +1068,11 @@ class LegacyChatApp:
         close_btn = tk.Button(header_frame, text="X", bg="#E74C3C", fg="white",
                               command=lambda: self.close_chat(buddy_username))
         close_btn.pack(padx=10, pady=5, side="right")
+        tk.Button(header_frame, text="Search",
+                  command=lambda: self.search_window({"with": buddy_username})).pack(pady=5, side="right")
+        tk.Button(header_frame, text="History",
+                  command=lambda: self.load_history({"with": buddy_username}, display)).pack(padx=5, pady=5,
+                                                                                           side="right")
         
         # Chat display area.
         display = scrolledtext.ScrolledText(chat_win, width=50, height=15, state="disabled",
@@ -243,57 +1095,276 @@ class LegacyChatApp:
         btn_wink = tk.Button(input_frame, text="Wink",
                              command=lambda: self.send_wink(buddy_username, display))
         btn_wink.grid(row=0, column=4, padx=5)
-        btn_send = tk.Button(input_frame, text="Send",
-                             command=lambda: self.send_msg(buddy_username, display, entry))
+        btn_send = tk.Button(input_frame, text="Send")
+        btn_send.config(command=lambda: self.send_msg(buddy_username, display, entry, btn_send))
         btn_send.grid(row=0, column=5, padx=5)
         self.chat_windows[buddy_username] = (chat_win, display, entry)
+        self.chat_logs[display] = ChatLog(display)
+        self.open_history({"with": buddy_username}, display)
         chat_win.protocol("WM_DELETE_WINDOW", lambda: self.close_chat(buddy_username))
 
+    def open_group_chat(self, group_name):
+        if group_name in self.group_windows:
+            window, display, entry = self.group_windows[group_name]
+            window.lift()
+            return
+        chat_win = tk.Toplevel(self.root)
+        chat_win.geometry("500x400")
+        header_frame = tk.Frame(chat_win, bg="#2C82C9")
+        header_frame.pack(fill="x")
+        tk.Label(header_frame, text=f"Group: {group_name}", bg="#2C82C9", fg="white",
+                 font=("Segoe UI", 10, "bold")).pack(padx=10, pady=5, side="left")
+        tk.Button(header_frame, text="X", bg="#E74C3C", fg="white",
+                  command=lambda: self.close_group_chat(group_name)).pack(padx=10, pady=5, side="right")
+        tk.Button(header_frame, text="Leave", command=lambda: self.leave_group(group_name)).pack(pady=5, side="right")
+        tk.Button(header_frame, text="Members",
+                  command=lambda: self.show_group_members(group_name)).pack(padx=5, pady=5, side="right")
+        tk.Button(header_frame, text="Search",
+                  command=lambda: self.search_window({"group": group_name})).pack(pady=5, side="right")
+        tk.Button(header_frame, text="History",
+                  command=lambda: self.load_history({"group": group_name}, display)).pack(padx=5, pady=5,
+                                                                                        side="right")
+        display = scrolledtext.ScrolledText(chat_win, width=50, height=15, state="disabled",
+                                              font=("Segoe UI", 10))
+        display.pack(pady=5)
+        input_frame = tk.Frame(chat_win)
+        input_frame.pack(pady=5)
+        entry = tk.Entry(input_frame, width=40, font=("Segoe UI", 10))
+        entry.grid(row=0, column=0, padx=5)
+        tk.Button(input_frame, text="Emoji", command=lambda: self.emoji_picker(entry)).grid(row=0, column=1, padx=5)
+        btn_send = tk.Button(input_frame, text="Send")
+        btn_send.config(command=lambda: self.post_group_msg(group_name, display, entry, btn_send))
+        btn_send.grid(row=0, column=2, padx=5)
+        self.group_windows[group_name] = (chat_win, display, entry)
+        self.chat_logs[display] = ChatLog(display)
+        self.open_history({"group": group_name}, display)
+        chat_win.protocol("WM_DELETE_WINDOW", lambda: self.close_group_chat(group_name))
+
+    def open_history(self, conversation, display):
+        """
+        Fills a new chat window: the newest cached page is drawn at once, then only
+        the messages the cache has not seen yet are fetched and added below it.
+        conversation is {"with": buddy_username} or {"group": group_name}.
+        """
+        chat_log = self.chat_logs[display]
+        key = conversation_key(conversation)
+        messages = self.cache.page(key, None, SERVER_HISTORY_PAGE)
+        if messages:
+            chat_log.history_newest = messages[-1]["id"]
+            self.show_older(chat_log, messages, self.cache.is_complete(key))
+        def done(new):
+            if self.chat_logs.get(display) is not chat_log:
+                return
+            messages = new.get(key, [])
+            if chat_log.history_before is None:
+                # Nothing was cached: this is the latest page, and goes above anything that arrived meanwhile.
+                if messages:
+                    chat_log.history_newest = messages[-1]["id"]
+                self.show_older(chat_log, messages, self.cache.is_complete(key))
+                return
+            lines = []
+            for msg in messages:
+                if msg["id"] > chat_log.history_newest and (msg.get("from"), msg.get("time")) not in chat_log.live:
+                    lines.append(self.history_line(msg))
+                chat_log.history_newest = max(chat_log.history_newest, msg["id"])
+            if lines:
+                chat_log.append("".join(lines))
+        self.run_in_background(lambda: sync_history(self.cache, self.username, {key: self.cache.newest(key)}),
+                               done, text="Syncing history...")
+
+    def load_history(self, conversation, display):
+        """
+        Puts the page before the oldest message shown above the chat: from the
+        cache while it has them, then from the server, caching what comes back.
+        """
+        chat_log = self.chat_logs.get(display)
+        if (chat_log is None or chat_log.loading_history or not chat_log.history_more
+                or chat_log.history_before is None):
+            return
+        key = conversation_key(conversation)
+        messages = self.cache.page(key, chat_log.history_before, SERVER_HISTORY_PAGE)
+        if messages or self.cache.is_complete(key):
+            self.show_older(chat_log, messages, self.cache.is_complete(key))
+            return
+        chat_log.loading_history = True
+        request = dict(conversation, action="get_history", username=self.username,
+                       before=chat_log.history_before, limit=SERVER_HISTORY_PAGE)
+        def work():
+            res = send_request(request)
+            if res.get("status") == "success" and not self.cache.check_epoch(res.get("epoch")):
+                self.cache.store(key, res.get("messages", []), complete=not res.get("more"))
+            return res
+        def done(res):
+            chat_log.loading_history = False
+            if self.chat_logs.get(display) is not chat_log or res.get("status") != "success":
+                return
+            self.show_older(chat_log, res.get("messages", []), not res.get("more"))
+        self.run_in_background(work, done, text="Loading history...")
+
+    def show_older(self, chat_log, messages, complete):
+        """
+        Prepends a page of history. complete says the cache or server holds nothing
+        older than what it has, so a short page is the start of the conversation.
+        """
+        if messages:
+            chat_log.history_before = messages[0]["id"]
+        chat_log.history_more = not complete or len(messages) >= SERVER_HISTORY_PAGE
+        lines = [self.history_line(msg) for msg in messages]
+        if not chat_log.history_more:
+            lines.insert(0, "--- Start of conversation ---\n")
+        chat_log.prepend("".join(lines))
+
+    def history_line(self, msg):
+        sender = msg.get("from")
+        name = "You" if sender == self.username else self.buddies.get(sender, sender)
+        when = time.strftime("%Y-%m-%d %H:%M", time.localtime(msg.get("time") or 0))
+        return f"[{when}] {name}: {msg.get('message')}\n"
+
+    def search_window(self, conversation):
+        """
+        Searches the server's message history: everything we can read, or one conversation
+        ({"with": buddy_username} or {"group": group_name}). Results come a page at a time.
+        """
+        search_win = tk.Toplevel(self.root)
+        scope = conversation.get("group") or self.buddies.get(conversation.get("with"), conversation.get("with"))
+        search_win.title(f"Search {scope}" if scope else "Search Messages")
+        search_win.geometry("520x360")
+        top = tk.Frame(search_win)
+        top.pack(fill="x", padx=5, pady=5)
+        query_entry = tk.Entry(top, width=40, font=("Segoe UI", 10))
+        query_entry.pack(side="left", padx=5)
+        results = tk.Listbox(search_win, font=("Segoe UI", 9))
+        results.pack(fill="both", expand=True, padx=5, pady=5)
+        status_label = tk.Label(search_win, text="", anchor="w")
+        status_label.pack(fill="x", padx=5)
+        more_button = tk.Button(search_win, text="More", state="disabled")
+        more_button.pack(pady=5)
+        # state: the query being paged and how many hits are shown
+        state = {"query": None, "offset": 0}
+        def fetch(button):
+            request = dict(conversation, action="search_messages", username=self.username,
+                           query=state["query"], offset=state["offset"], limit=SEARCH_PAGE)
+            def done(res):
+                if not search_win.winfo_exists():
+                    return
+                if res.get("status") != "success":
+                    messagebox.showerror("Error", res.get("message"))
+                    return
+                for hit in res.get("hits", []):
+                    where = hit.get("group") or self.buddies.get(hit.get("with"), hit.get("with"))
+                    results.insert(tk.END, f"({where}) " + self.history_line(hit).rstrip("\n"))
+                state["offset"] += len(res.get("hits", []))
+                status_label.config(text=f"{state['offset']} of {res.get('total', 0)} matches")
+                more_button.config(state="normal" if res.get("more") else "disabled")
+            self.run_in_background(lambda: send_request(request), done, busy=button, text="Searching...")
+        def start_search(event=None):
+            query = query_entry.get().strip()
+            if not query:
+                return
+            state["query"] = query
+            state["offset"] = 0
+            results.delete(0, tk.END)
+            fetch(search_button)
+        search_button = tk.Button(top, text="Search", command=start_search)
+        search_button.pack(side="left", padx=5)
+        more_button.config(command=lambda: fetch(more_button))
+        query_entry.bind("<Return>", start_search)
+        query_entry.focus_set()
+
+    def close_group_chat(self, group_name):
+        if group_name in self.group_windows:
+            window, display, entry = self.group_windows.pop(group_name)
+            self.chat_logs.pop(display).cancel()
+            window.destroy()
+
+    def post_group_msg(self, group_name, display, entry, button=None):
+        """One request posts to every member; the server fans it out."""
+        msg = entry.get().strip()
+        if not msg:
+            return
+        def done(res):
+            if res.get("status") == "success":
+                self.append_chat(display, f"You: {msg}\n")
+                if entry.get().strip() == msg:
+                    entry.delete(0, tk.END)
+                if res.get("full"):
+                    self.append_chat(display, f"(Not delivered to {', '.join(res['full'])}: mailbox full)\n")
+            else:
+                messagebox.showerror("Error", res.get("message"))
+        self.run_in_background(lambda: send_request({
+            "action": "group_post",
+            "sender": self.username,
+            "group": group_name,
+            "message": msg
+        }), done, busy=button, text="Posting message...")
+
+    def show_group_members(self, group_name):
+        def done(res):
+            if res.get("status") == "success":
+                messagebox.showinfo(group_name, "Members:\n" + "\n".join(res.get("members", [])))
+            else:
+                messagebox.showerror("Error", res.get("message"))
+        self.run_in_background(lambda: send_request({"action": "group_info", "group": group_name}), done)
+
+    def leave_group(self, group_name):
+        if not messagebox.askyesno("Leave Group", f"Leave {group_name}?"):
+            return
+        def done(res):
+            if res.get("status") == "success":
+                self.close_group_chat(group_name)
+                if group_name in self.groups:
+                    self.groups.remove(group_name)
+                self.open_buddy_list()  # refresh list
+            else:
+                messagebox.showerror("Error", res.get("message"))
+        self.run_in_background(lambda: send_request({
+            "action": "group_leave",
+            "username": self.username,
+            "group": group_name
+        }), done, text="Leaving group...")
+
     def close_chat(self, buddy_username):
         if buddy_username in self.chat_windows:
             window, display, entry = self.chat_windows[buddy_username]
+            self.chat_logs.pop(display).cancel()
             window.destroy()
             del self.chat_windows[buddy_username]
 
-    def send_msg(self, buddy_username, display, entry):
+    def send_msg(self, buddy_username, display, entry, button=None):
+        """The Send button stays disabled until the server confirms, which keeps messages in order."""
         msg = entry.get().strip()
         if not msg:
             return
-        res = send_request({
+        def done(res):
+            if res.get("status") == "success":
+                self.append_chat(display, f"You: {msg}\n")
+                if entry.get().strip() == msg:
+                    entry.delete(0, tk.END)
+            else:
+                messagebox.showerror("Error", res.get("message"))
+        self.run_in_background(lambda: send_request({
             "action": "send_message",
             "sender": self.username,
             "recipient": buddy_username,
             "message": msg
-        })
-        if res.get("status") == "success":
-            self.append_chat(display, f"You: {msg}\n")
-            entry.delete(0, tk.END)
-        else:
-            messagebox.showerror("Error", res.get("message"))
+        }), done, busy=button, text="Sending message...")
 
     def send_file_message(self, buddy_username, display, entry):
         file_path = filedialog.askopenfilename()
         if not file_path:
             return
-        try:
-            with open(file_path, "rb") as f:
-                file_data = f.read()
-            b64data = base64.b64encode(file_data).decode("utf-8")
-            filename = os.path.basename(file_path)
-            res = send_request({
-                "action": "send_file",
-                "sender": self.username,
-                "recipient": buddy_username,
-                "filename": filename,
-                "filedata": b64data
-            })
-            if res.get("status") == "success":
-                self.append_chat(display, f"You sent file: {filename}\n")
-                entry.delete(0, tk.END)
-            else:
-                messagebox.showerror("Error", res.get("message"))
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
+        filename = os.path.basename(file_path)
+        self.append_chat(display, f"Sending file: {filename}...\n")
+        self.run_in_background(lambda: upload_file(self.username, buddy_username, file_path),
+                               lambda res: self.file_sent(display, entry, filename, res),
+                               text=f"Uploading {filename}...")
+
+    def file_sent(self, display, entry, filename, res):
+        if res.get("status") == "success":
+            self.append_chat(display, f"You sent file: {filename}\n")
+            entry.delete(0, tk.END)
+        else:
+            messagebox.showerror("Error", res.get("message"))
 
     def emoji_picker(self, entry_widget):
         picker = tk.Toplevel(self.root)
@@ -313,36 +1384,45 @@ class LegacyChatApp:
         entry_widget.insert(tk.END, emoji)
 
     def append_chat(self, display, message):
-        display.config(state="normal")
-        display.insert(tk.END, message)
-        display.config(state="disabled")
-        display.see(tk.END)
+        """Queues a line for the window's next frame; a closed window drops it."""
+        chat_log = self.chat_logs.get(display)
+        if chat_log is not None:
+            chat_log.append(message)
+
+    def append_live(self, display, msg, text):
+        """Shows a message as it arrives and remembers it, so history syncing skips it."""
+        chat_log = self.chat_logs.get(display)
+        if chat_log is not None:
+            chat_log.live.add((msg.get("from"), msg.get("time")))
+            chat_log.append(text)
 
     def send_nudge(self, buddy_username, display):
-        res = send_request({
+        def done(res):
+            if res.get("status") == "success":
+                self.append_chat(display, "You nudged.\n")
+            else:
+                messagebox.showerror("Error", res.get("message"))
+        self.run_in_background(lambda: send_request({
             "action": "send_message",
             "sender": self.username,
             "recipient": buddy_username,
             "message": "[Nudge]",
             "type": "nudge"
-        })
-        if res.get("status") == "success":
-            self.append_chat(display, "You nudged.\n")
-        else:
-            messagebox.showerror("Error", res.get("message"))
+        }), done, text="Sending nudge...")
 
     def send_wink(self, buddy_username, display):
-        res = send_request({
+        def done(res):
+            if res.get("status") == "success":
+                self.append_chat(display, "You winked.\n")
+            else:
+                messagebox.showerror("Error", res.get("message"))
+        self.run_in_background(lambda: send_request({
             "action": "send_message",
             "sender": self.username,
             "recipient": buddy_username,
             "message": "[Wink]",
             "type": "wink"
-        })
-        if res.get("status") == "success":
-            self.append_chat(display, "You winked.\n")
-        else:
-            messagebox.showerror("Error", res.get("message"))
+        }), done, text="Sending wink...")
 
     def shake_window(self, window, count=0, original_coords=None):
         """
@@ -386,16 +1466,73 @@ class LegacyChatApp:
     def global_poll_messages(self):
         """
         Polls the server every second for new messages.
-        Each retrieved message is scheduled on the main thread.
+        Only used when the server does not support pushed messages.
         """
+        last_seq = self.cache.get_state("last_seq", 0)
         while True:
-            time.sleep(1)
-            res = send_request({"action": "get_messages", "username": self.username})
+            # Each poll acks what the previous one returned, so a lost reply loses nothing.
+            request = {"action": "get_messages", "username": self.username, "since": last_seq, "ack": last_seq}
+            epoch = self.cache.get_state("epoch")
+            if epoch is not None:
+                request["epoch"] = epoch
+            res = send_request(request)
             if res.get("status") == "success":
-                messages = res.get("messages", [])
-                for msg in messages:
-                    buddy_username = msg.get("from")
-                    self.root.after(0, self.handle_incoming_message, buddy_username, msg)
+                if res.get("reset"):
+                    self.epoch_changed(res.get("epoch"))
+                self.receive_messages(res.get("messages", []))
+                last_seq = res.get("last_seq", last_seq)
+                if res.get("more"):
+                    continue
+            time.sleep(1)
+
+    def epoch_changed(self, epoch):
+        """
+        The server's mailbox started over (it restarted without its data): forget the cache
+        of the old one, and fetch every buddy's status again rather than changes since a stale version.
+        """
+        if self.cache.check_epoch(epoch):
+            self.call_on_ui(self.reset_presence)
+
+    def reset_presence(self):
+        self.presence_version = 0
+
+    def receive_messages(self, messages):
+        """Hands a page of pushed or polled messages to the main thread and remembers the last one seen."""
+        if messages:
+            self.cache.set_state("last_seq", messages[-1].get("seq", 0))
+            self.call_on_ui(self.handle_incoming_messages, messages)
+
+    def handle_incoming_messages(self, messages):
+        """
+        Text for open chats is queued on their ChatLog and drawn with the next frame.
+        Text for closed chats raises one notification per buddy or group, not one per message.
+        """
+        unseen = {}
+        unseen_groups = {}
+        for msg in messages:
+            buddy_username = msg.get("from")
+            group_name = msg.get("group")
+            if group_name is not None:
+                if group_name in self.group_windows:
+                    self.handle_group_message(msg)
+                else:
+                    unseen_groups[group_name] = unseen_groups.get(group_name, 0) + 1
+                continue
+            if msg.get("type", "text") == "text" and buddy_username not in self.chat_windows:
+                unseen[buddy_username] = unseen.get(buddy_username, 0) + 1
+            else:
+                self.handle_incoming_message(buddy_username, msg)
+        for buddy_username, count in unseen.items():
+            buddy_name = self.buddies.get(buddy_username, buddy_username)
+            if count == 1:
+                self.push_notification(buddy_username, f"New message from {buddy_name}")
+            else:
+                self.push_notification(buddy_username, f"{count} new messages from {buddy_name}")
+        for group_name, count in unseen_groups.items():
+            if group_name not in self.groups:
+                # Joined from another client since our last group list.
+                self.groups.append(group_name)
+            self.push_notification(group_name, f"{count} new message(s) in {group_name}")
 
     def handle_incoming_message(self, buddy_username, msg):
         buddy_name = self.buddies.get(buddy_username, buddy_username)
@@ -404,7 +1541,7 @@ class LegacyChatApp:
             if buddy_username in self.chat_windows:
                 window, display, entry = self.chat_windows[buddy_username]
                 self.append_chat(display, f"{buddy_name} sent a file: {msg.get('filename')}\n")
-                self.prompt_save_file(buddy_name, msg.get("filename"), msg.get("filedata"))
+                self.prompt_save_file(buddy_name, msg.get("filename"), msg.get("filedata"), msg.get("file_id"))
             else:
                 self.push_notification(buddy_username, f"{buddy_name} sent a file: {msg.get('filename')}")
         elif msg_type == "nudge":
@@ -414,10 +1551,16 @@ class LegacyChatApp:
         else:
             if buddy_username in self.chat_windows:
                 window, display, entry = self.chat_windows[buddy_username]
-                self.append_chat(display, f"{buddy_name}: {msg.get('message')}\n")
+                self.append_live(display, msg, f"{buddy_name}: {msg.get('message')}\n")
             else:
                 self.push_notification(buddy_username, f"New message from {buddy_name}")
 
+    def handle_group_message(self, msg):
+        """Draws a post in its open group window."""
+        sender = msg.get("from")
+        window, display, entry = self.group_windows[msg.get("group")]
+        self.append_live(display, msg, f"{self.buddies.get(sender, sender)}: {msg.get('message')}\n")
+
     def push_notification(self, buddy_username, text):
         notif = tk.Toplevel(self.root)
         notif.title("New Message")
@@ -425,20 +1568,73 @@ class LegacyChatApp:
         tk.Label(notif, text=text, font=("Segoe UI", 12)).pack(expand=True)
         notif.after(3000, notif.destroy)
 
-    def prompt_save_file(self, buddy_name, filename, filedata):
+    def prompt_save_file(self, buddy_name, filename, filedata, file_id=None):
+        """
+        Files sent by reference are only downloaded if saved; either way the server
+        is then told we are done with it, so it can drop its copy.
+        """
+        save_path = None
         if messagebox.askyesno("File Received", f"{buddy_name} sent file: {filename}. Save now?"):
             save_path = filedialog.asksaveasfilename(initialfile=filename)
-            if save_path:
-                try:
-                    with open(save_path, "wb") as f:
-                        f.write(base64.b64decode(filedata))
-                    messagebox.showinfo("Saved", "File saved successfully!")
-                except Exception as e:
-                    messagebox.showerror("Error", str(e))
+        if save_path and file_id:
+            self.save_remote_file(file_id, save_path)
+        elif file_id:
+            self.run_in_background(lambda: send_request({"action": "file_release", "username": self.username, "file_id": file_id}),
+                                   lambda res: None)
+        elif save_path:
+            try:
+                with open(save_path, "wb") as f:
+                    f.write(base64.b64decode(filedata))
+                messagebox.showinfo("Saved", "File saved successfully!")
+            except Exception as e:
+                messagebox.showerror("Error", str(e))
+
+    def save_remote_file(self, file_id, save_path):
+        """Downloads a file in the background, releases it, and reports the result on the main thread."""
+        def work():
+            res = download_file(file_id, save_path)
+            if res.get("status") == "success":
+                send_request({"action": "file_release", "username": self.username, "file_id": file_id})
+            return res
+        def done(res):
+            if res.get("status") == "success":
+                messagebox.showinfo("Saved", "File saved successfully!")
+            else:
+                messagebox.showerror("Error", res.get("message"))
+        self.run_in_background(work, done, text=f"Downloading {os.path.basename(save_path)}...")
 
     def start_polling(self):
-        thread = threading.Thread(target=self.global_poll_messages, daemon=True)
-        thread.start()
+        """Subscribes for pushed messages, falling back to polling on older servers."""
+        if self.polling:
+            return
+        self.polling = True
+        def done(res):
+            if res.get("status") != "success":
+                threading.Thread(target=self.global_poll_messages, daemon=True).start()
+        last_seq = self.cache.get_state("last_seq", 0)
+        epoch = self.cache.get_state("epoch")
+        self.run_in_background(lambda: session.subscribe(self.username, self.receive_messages, last_seq, epoch,
+                                                         self.epoch_changed),
+                               done, text="Connecting...")
+        self.heartbeat_job = self.root.after(self.heartbeat_ms, self.send_heartbeat)
+
+    def send_heartbeat(self):
+        """
+        Tells the server this session is still alive so it is not closed as idle
+        (and we are not shown offline). Runs quietly, without the activity bar.
+        """
+        def done(res):
+            if res.get("status") == "success" and res.get("interval"):
+                self.heartbeat_ms = int(res["interval"] * 1000)
+            self.heartbeat_job = self.root.after(self.heartbeat_ms, self.send_heartbeat)
+
+        def job():
+            try:
+                res = send_request({"action": "heartbeat"})
+            except Exception as e:
+                res = {"status": "error", "message": str(e)}
+            self.call_on_ui(done, res)
+        self.io_executor.submit(job)
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -1,182 +1,3786 @@
 #!/usr/bin/env python3
 import socket
 import threading
+import asyncio
 import json
+import time
+import os
+import base64
+import binascii
+import tempfile
+import uuid
+import struct
+import bisect
+import zlib
+import multiprocessing
+import sys
+import heapq
+import http.server
+import math
+import hashlib
+import hmac
+import re
+import gzip
+import signal
+from array import array
+from collections import deque
+
+# Largest request line or frame a connection may send (inline send_file payloads are one line);
+# anything bigger is answered with an error and the connection is closed.
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# Per-connection token buckets: requests per second (with a burst allowance) and request bytes
+# per second. A client over its rate is not read from until it is back under, so TCP pushes back.
+RATE_LIMIT_REQUESTS = 200
+RATE_LIMIT_BURST = 400
+RATE_LIMIT_BYTES = 8 * 1024 * 1024
+# Slow consumers: a send that cannot complete within SEND_TIMEOUT seconds (threaded), or a
+# connection holding more than MAX_OUTBOUND_BYTES unsent, disconnects the client.
+SEND_TIMEOUT = 10
+MAX_OUTBOUND_BYTES = 8 * 1024 * 1024
+# Idle connections: a client connection that sends nothing for IDLE_TIMEOUT seconds is closed;
+# clients send a heartbeat every HEARTBEAT_INTERVAL to stay connected. Deadlines are kept on a
+# timing wheel of IDLE_TICK-second slots. A user whose last subscribed connection goes is shown
+# offline until they subscribe again.
+HEARTBEAT_INTERVAL = 30
+IDLE_TIMEOUT = 90
+IDLE_TICK = 1.0
+# Largest decoded chunk accepted by file_chunk or returned by file_fetch.
+MAX_CHUNK_SIZE = 1024 * 1024
+# File ids: 12 hex digits of creation time, the blob's sha256, then 32 random hex digits.
+FILE_ID_LENGTH = 12 + 64 + 32
+# Messages returned per get_messages / subscribe page unless the client asks for fewer.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Most sub-requests one batch may carry.
+MAX_BATCH_SIZE = 1000
+# Sub-requests a batch may run while already holding their user's lock: their handlers lock no
+# other user and make no peer calls. Anything else (subscribe drops the connection's previous
+# user, add_buddy and status lookups may ask other shards) runs with no lock held, since taking
+# a second user's lock under the first could deadlock against a request locking them the other way.
+BATCH_LOCKED_ACTIONS = {"login", "send_message", "get_messages", "ack", "update_status"}
+# Actions whose handlers read, write or hash files; the async engine runs them (and batches
+# holding them) on its executor so the event loop keeps serving other connections meanwhile.
+EXECUTOR_ACTIONS = {"file_begin", "file_status", "file_chunk", "file_commit", "file_fetch", "file_release"}
+# Mailbox limits for undelivered messages. When a mailbox is full, "reject" refuses new
+# messages and "drop_oldest" evicts the oldest unacked ones to make room.
+MAILBOX_MAX_MESSAGES = 10000
+MAILBOX_MAX_BYTES = 64 * 1024 * 1024
+MAILBOX_POLICY = "reject"
+# Unacked messages older than this (seconds) are removed by the sweeper, which runs every SWEEP_INTERVAL.
+MESSAGE_TTL = 30 * 24 * 3600
+SWEEP_INTERVAL = 60
+# Chunked uploads nobody has written to for this long (seconds) are dropped from the spool by the sweeper.
+UPLOAD_TTL = 24 * 3600
+# Rough per-message cost beyond its string fields, for memory accounting.
+MESSAGE_OVERHEAD = 200
+# Field naming the user a request is about, when it is not "username": batches lock
+# that user's record and cluster workers route the request to that user's shard.
+# Group actions are keyed by the group name instead: a group lives on the shard its name hashes to.
+USER_KEY_FIELDS = {"send_message": "recipient", "send_file": "recipient", "file_begin": "recipient",
+                   "group_create": "group", "group_join": "group", "group_leave": "group", "group_post": "group",
+                   "group_info": "group"}
+# Actions handled by the shard that owns the user named by USER_KEY_FIELDS.
+SHARDED_ACTIONS = {"signup", "login", "add_buddy", "send_message", "send_file", "get_messages", "ack",
+                   "update_status", "get_buddy_status", "get_buddy_statuses", "subscribe", "file_begin",
+                   "group_create", "group_join", "group_leave", "group_post", "group_info"}
+# Seconds a cluster worker waits on another worker's reply before giving up on that shard.
+PEER_TIMEOUT = 10
+# Binary framing (negotiated per connection): 4-byte big-endian payload length, then the JSON payload.
+FRAME_HEADER = struct.Struct(">I")
+# Compression (negotiated along with binary framing): a length word with COMPRESSED_FLAG set is
+# followed by a zlib stream of the payload. Payloads under COMPRESSION_THRESHOLD bytes, or that
+# deflate does not shrink, go out as they are.
+COMPRESSED_FLAG = 0x80000000
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+NEWLINE = b"\n"
+# A pushed message is this prefix, the message JSON without its closing brace, then its seq.
+PUSH_PREFIX = b'{"push": "message", "message": '
+# Message history search: query terms are runs of word characters, lowercased; hits are ranked
+# by BM25 with these parameters and paged with offset/limit up to MAX_SEARCH_RESULTS deep.
+TOKEN_PATTERN = re.compile(r"\w+")
+MAX_QUERY_TERMS = 8
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_RESULTS = 1000
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Traffic capture for benchmarks/replay.py: a gzip stream of CAPTURE_MAGIC, then records of
+# CAPTURE_RECORD (kind, connection id, microseconds since the epoch, payload length) + payload.
+CAPTURE_MAGIC = b"LCCAP1\n"
+CAPTURE_RECORD = struct.Struct(">cIQI")
+CAPTURE_LEVEL = 1
+CAPTURE_FLUSH_INTERVAL = 1.0
+# Latency histogram bucket upper bounds, in seconds (one overflow bucket follows).
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Most distinct labels (e.g. action names) one metric keeps before lumping the rest into "other".
+MAX_METRIC_LABELS = 64
+# Shortest sampling interval the profile action accepts; shorter requests are raised to it,
+# since sampling every thread's stack that often would itself slow the server down.
+MIN_PROFILE_INTERVAL_MS = 1
+
+def message_size(msg):
+    """Approximate memory held by a queued message: its string fields in UTF-8 bytes plus fixed overhead."""
+    return MESSAGE_OVERHEAD + sum(len(value) if value.isascii() else len(value.encode("utf-8"))
+                                  for value in msg.values() if isinstance(value, str))
+
+def stamp_untimed(messages, now):
+    """
+    Gives mailbox entries stored without a "time" (by older versions) the time of the next
+    newer entry that has one, or now, so they expire and the mailbox stays in time order.
+    """
+    latest = now
+    for seq, msg in reversed(messages):
+        if "time" in msg:
+            latest = min(latest, msg["time"])
+        else:
+            msg["time"] = latest
+
+def tokenize(text):
+    """The search terms in a message text."""
+    if not isinstance(text, str):
+        return []
+    return TOKEN_PATTERN.findall(text.lower())
+
+def file_digest(path):
+    """sha256 of a file's contents, read a chunk at a time."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(MAX_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def frame_buffers(payload, framing, compress_threshold=None):
+    """
+    Returns the buffers that put one payload on the wire, without joining them.
+    With compress_threshold set, binary payloads at least that long are deflated when it helps.
+    """
+    if framing == "binary":
+        if compress_threshold is not None and len(payload) >= compress_threshold:
+            compressed = zlib.compress(payload, COMPRESSION_LEVEL)
+            if len(compressed) < len(payload):
+                return [FRAME_HEADER.pack(len(compressed) | COMPRESSED_FLAG), compressed]
+        return [FRAME_HEADER.pack(len(payload)), payload]
+    return [payload, NEWLINE]
+
+def inflate(data, max_size=None):
+    """Decompresses a compressed frame, refusing to produce more than max_size bytes."""
+    decompressor = zlib.decompressobj()
+    try:
+        payload = decompressor.decompress(data, max_size + 1 if max_size is not None else 0)
+    except zlib.error as ex:
+        raise ValueError("Bad compressed frame: {}".format(ex))
+    if max_size is not None and len(payload) > max_size:
+        raise FrameTooLarge("Request too large")
+    if not decompressor.eof:
+        raise ValueError("Truncated compressed frame")
+    return payload
+
+def negotiate_reply(request):
+    """
+    The reply to a negotiate request. Compression ("compression": "deflate") is only
+    offered with binary framing, since compressed payloads may contain newlines.
+    """
+    framing = request.get("framing", "line")
+    if framing not in ("line", "binary"):
+        return {"status": "error", "message": "Unsupported framing"}
+    compression = None
+    if framing == "binary" and request.get("compression") == "deflate":
+        compression = "deflate"
+    return {"status": "success", "framing": framing, "compression": compression}
+
+def send_buffers(sock, buffers):
+    """
+    sendmsg until every buffer is written, so header and payload never get copied together.
+    Sockets without sendmsg (Windows) get one joined sendall instead.
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    views = [memoryview(buffer) for buffer in buffers]
+    while views:
+        sent = sock.sendmsg(views)
+        while sent:
+            if sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+class JsonCodec:
+    """Encodes replies and decodes requests on the wire: UTF-8 JSON via the standard library."""
+    name = "json"
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, value):
+        return json.dumps(value).encode("utf-8")
+
+class OrjsonCodec(JsonCodec):
+    """
+    orjson, when installed: several times faster both ways. Values it refuses
+    (non-string keys, integers over 64 bits) are encoded by the standard library.
+    """
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+        self.loads = orjson.loads
+        self.fast_dumps = orjson.dumps
+
+    def dumps(self, value):
+        try:
+            return self.fast_dumps(value)
+        except TypeError:
+            return JsonCodec.dumps(self, value)
+
+class UjsonCodec(JsonCodec):
+    """ujson, when installed and orjson is not."""
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+        self.loads = ujson.loads
+        self.fast_dumps = ujson.dumps
+
+    def dumps(self, value):
+        try:
+            return self.fast_dumps(value, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+        except (TypeError, OverflowError):
+            return JsonCodec.dumps(self, value)
+
+# Wire codecs, fastest first; make_codec() picks the first whose library imports.
+JSON_CODECS = (OrjsonCodec, UjsonCodec, JsonCodec)
+
+def make_codec(name=None):
+    """The codec called name, or the fastest one available."""
+    for codec_class in JSON_CODECS:
+        if name is not None and codec_class.name != name:
+            continue
+        try:
+            return codec_class()
+        except ImportError:
+            if name is not None:
+                raise
+    raise ValueError("Unknown codec: {}".format(name))
+
+class Action:
+    """
+    A registered request handler. fields maps each required field to its type;
+    a request missing one, or carrying an empty string or a value of another
+    type (true/false are not ints), is answered with message before the handler
+    runs. Handlers defined in a class are looked up on the server by method
+    name, so a subclass overriding one is dispatched to.
+    """
+    __slots__ = ("name", "handler", "method", "fields", "message", "wants_conn", "peer_only")
+
+    def __init__(self, name, handler, fields, message, wants_conn, peer_only):
+        self.name = name
+        self.handler = handler
+        self.method = handler.__name__ if not handler.__qualname__.endswith("<locals>." + handler.__name__) \
+            and "." in handler.__qualname__ else None
+        self.fields = tuple(fields.items())
+        self.message = message or "Missing fields: {}".format(", ".join(fields))
+        self.wants_conn = wants_conn
+        self.peer_only = peer_only
+
+    def invalid(self, request):
+        """True if a required field is missing or has the wrong type."""
+        for field, kind in self.fields:
+            value = request.get(field)
+            if not isinstance(value, kind) or kind is str and not value or kind is int and type(value) is bool:
+                return True
+        return False
+
+# Request handlers by action name, filled in by @action. Plugins register theirs the same way;
+# a handler is called as handler(server, request), plus the connection when conn=True.
+ACTIONS = {}
+
+def action(name, fields=None, message=None, conn=False, peer=False):
+    """Registers the decorated function as the handler for name; peer=True limits it to cluster peers."""
+    def register(handler):
+        ACTIONS[name] = Action(name, handler, fields or {}, message, conn, peer)
+        return handler
+    return register
+
+class FrameTooLarge(ValueError):
+    pass
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `burst`. take() returns how long to wait before going on."""
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def take(self, amount=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        # Tokens may go negative: the debt is paid off before the next request gets through.
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+class TimerWheel:
+    """
+    Hashed timing wheel of connection idle deadlines. Requests only stamp
+    conn.last_active; a connection is looked at once per timeout, when its
+    slot comes round, and is then either moved to its new deadline's slot or
+    handed back as idle. The cost is per expiry, not per connection per tick.
+    """
+    def __init__(self, timeout, tick=IDLE_TICK):
+        self.timeout = timeout
+        self.tick = tick
+        self.slots = [set() for _ in range(int(math.ceil(timeout / tick)) + 2)]
+        # current: the last tick number (monotonic seconds / tick) whose slot has been processed
+        self.current = int(time.monotonic() / tick)
+        self.lock = threading.Lock()
+
+    def schedule(self, conn):
+        """Files conn under the tick its deadline falls in. Caller holds the lock."""
+        number = max(int((conn.last_active + self.timeout) / self.tick) + 1, self.current + 1)
+        conn.wheel_slot = number % len(self.slots)
+        self.slots[conn.wheel_slot].add(conn)
+
+    def add(self, conn):
+        with self.lock:
+            self.schedule(conn)
+
+    def remove(self, conn):
+        with self.lock:
+            if conn.wheel_slot is not None:
+                self.slots[conn.wheel_slot].discard(conn)
+                conn.wheel_slot = None
+
+    def advance(self, now):
+        """Processes every slot due by now; returns the connections idle for longer than timeout."""
+        idle = []
+        with self.lock:
+            while self.current < int(now / self.tick):
+                self.current += 1
+                index = self.current % len(self.slots)
+                due, self.slots[index] = self.slots[index], set()
+                for conn in due:
+                    if conn.last_active + self.timeout <= now:
+                        conn.wheel_slot = None
+                        idle.append(conn)
+                    else:
+                        self.schedule(conn)
+        return idle
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+class FrameReader:
+    """
+    Bytes-level receive buffer for one socket.
+    recv_into fills a reusable bytearray and newline scanning resumes where it
+    stopped, so long lines are never re-split and multi-byte UTF-8 characters
+    split across reads are only decoded once the whole line is in. Each line or
+    frame is copied out of the buffer once, through a memoryview slice.
+    With max_size set, a longer line or frame raises FrameTooLarge instead of growing the buffer.
+    """
+    def __init__(self, sock, size=65536, initial=b"", max_size=None):
+        self.sock = sock
+        self.max_size = max_size
+        self.initial_size = size
+        # initial: bytes already read from this socket by someone else (the cluster master)
+        self.buffer = bytearray(max(size, len(initial) * 2))
+        self.buffer[:len(initial)] = initial
+        self.start = 0
+        self.end = len(initial)
+        # scanned: bytes before this offset are known to hold no newline
+        self.scanned = 0
+
+    def recv_more(self, need):
+        """Makes room for `need` unread bytes, then does one recv_into. False on EOF."""
+        if self.end == len(self.buffer) or len(self.buffer) - self.start < need:
+            pending = self.end - self.start
+            if len(self.buffer) < need or pending > len(self.buffer) // 2:
+                grown = bytearray(max(len(self.buffer) * 2, need))
+                grown[:pending] = memoryview(self.buffer)[self.start:self.end]
+                self.buffer = grown
+            else:
+                self.buffer[:pending] = memoryview(self.buffer)[self.start:self.end]
+            self.scanned -= self.start
+            self.start, self.end = 0, pending
+        count = self.sock.recv_into(memoryview(self.buffer)[self.end:])
+        if not count:
+            return False
+        self.end += count
+        return True
+
+    def consume(self, end):
+        self.start = self.scanned = end
+        if self.start == self.end:
+            self.start = self.end = self.scanned = 0
+            if len(self.buffer) > self.initial_size * 16:
+                # Give back the memory of an unusually large frame.
+                self.buffer = bytearray(self.initial_size)
+
+    def read_line(self):
+        while True:
+            newline = self.buffer.find(NEWLINE, max(self.scanned, self.start), self.end)
+            if newline >= 0:
+                line = bytes(memoryview(self.buffer)[self.start:newline])
+                self.consume(newline + 1)
+                return line
+            self.scanned = self.end
+            if self.max_size is not None and self.end - self.start > self.max_size:
+                raise FrameTooLarge("Request too large")
+            if not self.recv_more(self.end - self.start + 1):
+                return None
+
+    def read_frame(self):
+        header_size = FRAME_HEADER.size
+        while self.end - self.start < header_size:
+            if not self.recv_more(header_size):
+                return None
+        (length,) = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        compressed = length & COMPRESSED_FLAG
+        length &= ~COMPRESSED_FLAG
+        if self.max_size is not None and length > self.max_size:
+            raise FrameTooLarge("Request too large")
+        while self.end - self.start < header_size + length:
+            if not self.recv_more(header_size + length):
+                return None
+        payload_start = self.start + header_size
+        payload = bytes(memoryview(self.buffer)[payload_start:payload_start + length])
+        self.consume(payload_start + length)
+        if compressed:
+            return inflate(payload, self.max_size)
+        return payload
+
+class ClientConnection:
+    """
+    A connected socket served by its own thread, which writes its replies itself.
+    Pushes from other threads are queued and written by the connection's writer
+    thread, so a sender never waits on someone else's socket. With send_timeout
+    set, a send the client does not read within that many seconds drops the
+    connection, and so does letting more than max_pending bytes queue up unsent.
+    """
+    def __init__(self, sock, send_timeout=None, max_pending=None):
+        self.sock = sock
+        self.max_pending = max_pending
+        self.username = None
+        self.closed = False
+        # framing: "line" (newline-delimited JSON) or "binary" (length-prefixed frames)
+        self.framing = "line"
+        # compress_threshold: set once compression is negotiated; smaller payloads are sent as is
+        self.compress_threshold = None
+        # is_peer: a local connection from another cluster worker
+        self.is_peer = False
+        # relay: in a cluster, the link to another worker that pushes this connection's messages
+        self.relay = None
+        # rate_limits: (requests TokenBucket, bytes TokenBucket), or None for unlimited
+        self.rate_limits = None
+        self.slow_consumer = False
+        # capture_id: this connection's id in the traffic capture, once it has sent a request
+        self.capture_id = None
+        # last_active: monotonic time of the last request; wheel_slot: its TimerWheel slot, if watched
+        self.last_active = time.monotonic()
+        self.wheel_slot = None
+        # outbox: (payload, framing, compress_threshold) waiting to be written, in order, holding
+        # pending_bytes of payload; whichever thread holds write_lock sends them
+        self.outbox = deque()
+        self.pending_bytes = 0
+        self.cond = threading.Condition()
+        self.write_lock = threading.Lock()
+        # writer: started by the first flush(), for frames queued by other threads
+        self.writer = None
+        if send_timeout:
+            # SO_SNDTIMEO bounds blocking sends only; recv keeps waiting for the next request.
+            seconds = int(send_timeout)
+            timeval = struct.pack("ll", seconds, int((send_timeout - seconds) * 1000000))
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+            except (OSError, AttributeError):
+                pass
+
+    def send_frame(self, payload, framing=None):
+        """
+        Queues a frame and writes the outbox from the calling thread, which may block on this
+        socket: for the connection's own thread. Others use queue_frame and flush.
+        """
+        self.queue_frame(payload, framing)
+        # If the writer thread is busy with the outbox, it sends this frame as well.
+        if self.write_lock.acquire(blocking=False):
+            try:
+                self.drain()
+            finally:
+                self.write_lock.release()
+
+    def queue_frame(self, payload, framing=None):
+        """Adds a frame to the outbox without blocking; it is written after anything queued before."""
+        with self.cond:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            if self.max_pending is not None and self.pending_bytes > self.max_pending:
+                print("Disconnecting slow consumer", self.username or "")
+                self.slow_consumer = True
+                self.shutdown()
+                raise ConnectionError("Slow consumer disconnected")
+            self.outbox.append((payload, framing or self.framing, self.compress_threshold))
+            self.pending_bytes += len(payload)
+
+    def flush(self):
+        """Hands the outbox to the writer thread; never blocks on the socket."""
+        with self.cond:
+            if self.writer is None and not self.closed:
+                self.writer = threading.Thread(target=self.write_loop, daemon=True)
+                self.writer.start()
+            self.cond.notify()
+
+    def write_loop(self):
+        while True:
+            with self.cond:
+                while not self.outbox and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            with self.write_lock:
+                try:
+                    self.drain()
+                except (OSError, ConnectionError):
+                    # The connection's own thread sees it closed and cleans up.
+                    self.shutdown()
+                    return
+
+    def drain(self):
+        """Writes the outbox until it is empty; caller holds write_lock."""
+        while True:
+            with self.cond:
+                if self.closed:
+                    raise ConnectionError("Connection closed")
+                if not self.outbox:
+                    return
+                payload, framing, compress_threshold = self.outbox.popleft()
+            try:
+                send_buffers(self.sock, frame_buffers(payload, framing, compress_threshold))
+            except (BlockingIOError, TimeoutError):
+                # Part of a frame may be on the wire, so the stream cannot be resumed.
+                print("Disconnecting slow consumer", self.username or "")
+                self.slow_consumer = True
+                self.shutdown()
+                raise ConnectionError("Slow consumer disconnected")
+            finally:
+                with self.cond:
+                    self.pending_bytes -= len(payload)
+
+    def shutdown(self):
+        """Wakes the connection's own thread out of recv so it cleans up and closes."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        """Writes what is still queued, unless the connection was dropped, and closes the socket."""
+        with self.write_lock:
+            try:
+                self.drain()
+            except (OSError, ConnectionError):
+                pass
+            with self.cond:
+                self.closed = True
+                self.cond.notify()
+        self.sock.close()
+
+class AsyncClientConnection:
+    """
+    A connection served by the event loop; sends from other threads are handed to the loop.
+    A client that lets more than max_pending bytes pile up unsent is disconnected.
+    """
+    def __init__(self, writer, loop, max_pending=None):
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.max_pending = max_pending
+        self.username = None
+        self.closed = False
+        self.framing = "line"
+        self.compress_threshold = None
+        self.is_peer = False
+        self.relay = None
+        self.rate_limits = None
+        self.slow_consumer = False
+        self.capture_id = None
+        self.last_active = time.monotonic()
+        self.wheel_slot = None
+
+    def send_frame(self, payload, framing=None):
+        if self.closed or self.writer.is_closing():
+            raise ConnectionError("Connection closed")
+        buffers = frame_buffers(payload, framing or self.framing, self.compress_threshold)
+        if threading.get_ident() == self.loop_thread:
+            self.write(buffers)
+        else:
+            self.loop.call_soon_threadsafe(self.write, buffers)
+
+    def queue_frame(self, payload, framing=None):
+        """The loop's callback queue already keeps frames in order and never blocks the caller."""
+        self.send_frame(payload, framing)
+
+    def flush(self):
+        pass
+
+    def write(self, buffers):
+        if self.closed:
+            return
+        if self.max_pending is not None and self.writer.transport.get_write_buffer_size() > self.max_pending:
+            print("Disconnecting slow consumer", self.username or "")
+            self.slow_consumer = True
+            self.closed = True
+            self.writer.transport.abort()
+            return
+        self.writer.writelines(buffers)
+
+    def shutdown(self):
+        """Drops the connection from any thread; its handler sees it closed and cleans up."""
+        self.closed = True
+        try:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+        except RuntimeError:
+            # The loop has already stopped.
+            pass
+
+    def close(self):
+        self.closed = True
+        self.writer.close()
+
+class PeerLink:
+    """Pooled local connections to another cluster worker, speaking the normal line protocol."""
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.codec = codec or JsonCodec()
+        # idle: (socket, FrameReader) pairs not in use by any thread
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def request(self, request):
+        with self.lock:
+            entry = self.idle.pop() if self.idle else None
+        try:
+            if entry is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(PEER_TIMEOUT)
+                entry = (sock, FrameReader(sock))
+                sock.connect(self.path)
+            sock, reader = entry
+            send_buffers(sock, frame_buffers(self.codec.dumps(request), "line"))
+            line = reader.read_line()
+            if line is None:
+                raise ConnectionError("Peer closed the connection")
+        except (OSError, ConnectionError) as e:
+            if entry is not None:
+                entry[0].close()
+            return {"status": "error", "message": "Shard unavailable: {}".format(e)}
+        with self.lock:
+            self.idle.append(entry)
+        return self.codec.loads(line)
+
+def send_handoff(sock, fd, framing, compression, initial):
+    """Passes an accepted client socket, plus the bytes already read from it, to a cluster worker."""
+    if framing == "binary":
+        kind = b"Z" if compression == "deflate" else b"B"
+    else:
+        kind = b"L"
+    payload = kind + initial
+    data = struct.pack(">I", len(payload)) + payload
+    sent = socket.send_fds(sock, [data], [fd])
+    if sent < len(data):
+        sock.sendall(data[sent:])
+
+def stop_on_sigterm():
+    """
+    Makes SIGTERM shut the server down the way Ctrl+C does (asyncio.run cancels its tasks
+    first), so its cleanup runs. Only the main thread may install it.
+    """
+    def interrupt(signum, frame):
+        signal.raise_signal(signal.SIGINT)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, interrupt)
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff channel closed")
+        data += chunk
+    return bytes(data)
+
+def recv_handoff(sock):
+    """
+    Receives one handoff from the cluster master: (fd, framing, compression, initial bytes),
+    or None at shutdown.
+    """
+    header, fds, flags, address = socket.recv_fds(sock, 4, 1)
+    if not header:
+        return None
+    header += recv_exact(sock, 4 - len(header))
+    payload = recv_exact(sock, struct.unpack(">I", header)[0])
+    framing = "binary" if payload[:1] in (b"B", b"Z") else "line"
+    compression = "deflate" if payload[:1] == b"Z" else None
+    return fds[0], framing, compression, payload[1:]
+
+class UserRecord:
+    """
+    One account and its mailbox, guarded by its own lock so unrelated users never contend.
+    status and status_version are written under the server's presence_lock instead.
+    """
+    __slots__ = ("username", "password", "buddies", "messages", "mailbox_bytes", "next_seq", "status",
+                 "status_version", "expired_status", "subscribers", "lock")
+
+    def __init__(self, username, password, lock=None):
+        self.username = username
+        self.password = password
+        # buddies: buddy_username -> display name
+        self.buddies = {}
+        # messages: list of (seq, message) in delivery order; seq numbers are never reused
+        self.messages = []
+        # mailbox_bytes: message_size() summed over messages
+        self.mailbox_bytes = 0
+        self.next_seq = 1
+        self.status = "online"
+        self.status_version = 0
+        # expired_status: the status to bring back when a user shown offline after losing
+        # their last connection subscribes again; None otherwise
+        self.expired_status = None
+        # subscribers: connections that receive pushed messages
+        self.subscribers = set()
+        # Reentrant so a batch can hold it across several sub-requests for the same user.
+        self.lock = lock or threading.RLock()
+
+class GroupRecord:
+    """A group conversation: its members (usernames on any shard), guarded by its own lock."""
+    __slots__ = ("name", "owner", "members", "lock")
+
+    def __init__(self, name, owner):
+        self.name = name
+        self.owner = owner
+        self.members = set()
+        self.lock = threading.Lock()
+
+def needs_executor(request):
+    """True for a request (or batch) that the event loop should hand to its executor."""
+    if not isinstance(request, dict):
+        return False
+    if request.get("action") == "batch" and isinstance(request.get("requests"), list):
+        return any(isinstance(sub, dict) and sub.get("action") in EXECUTOR_ACTIONS for sub in request["requests"])
+    return request.get("action") in EXECUTOR_ACTIONS
+
+def settle_future(loop, future, error=None):
+    """Completes an event loop's future from another thread; a loop that has stopped is left alone."""
+    def settle():
+        if not future.done():
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(IOError("storage failed: {}".format(error)))
+    try:
+        loop.call_soon_threadsafe(settle)
+    except RuntimeError:
+        pass
+
+class Storage:
+    """
+    Durable state under data_dir: an append-only write-ahead log split into
+    numbered segments, plus a snapshot of the whole store.
+
+    Records are buffered and written by one flusher thread that fsyncs once
+    per batch (group commit), so concurrent writers share a single fsync.
+    A snapshot rotates to a fresh segment first and then drops the older
+    ones; replay is idempotent, so records that landed in both the snapshot
+    and the new segment are harmless.
+    """
+    def __init__(self, data_dir, commit_interval=0.005, snapshot_every=200000):
+        self.data_dir = data_dir
+        self.commit_interval = commit_interval
+        self.snapshot_every = snapshot_every
+        os.makedirs(data_dir, exist_ok=True)
+        self.buffer = []
+        self.appended = 0
+        self.committed = 0
+        self.records_since_snapshot = 0
+        # generation: bumped by every rotate, so a writer can tell whether two records share a segment
+        self.generation = 0
+        self.snapshotting = False
+        self.closed = False
+        # failed: the exception that stopped the flusher; every later append and wait raises it
+        self.failed = None
+        self.cond = threading.Condition()
+        # waiters: (ticket, loop, future) for event loops waiting on a commit without blocking
+        self.waiters = []
+        # io_lock: held while writing to or rotating the current segment
+        self.io_lock = threading.Lock()
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 1
+        self.wal = open(self.segment_path(self.segment), "ab")
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+
+    def segment_path(self, number):
+        return os.path.join(self.data_dir, "wal-%08d.log" % number)
+
+    def snapshot_path(self):
+        return os.path.join(self.data_dir, "snapshot.json")
+
+    def segments(self):
+        numbers = []
+        for name in os.listdir(self.data_dir):
+            if name.startswith("wal-") and name.endswith(".log"):
+                numbers.append(int(name[4:-4]))
+        return sorted(numbers)
+
+    def load(self):
+        """Returns (snapshot dict or None, iterator over the log records to replay on top of it)."""
+        snapshot = None
+        first_segment = 1
+        if os.path.exists(self.snapshot_path()):
+            with open(self.snapshot_path(), "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            first_segment = snapshot["segment"]
+        return snapshot, self.replay(first_segment)
+
+    def replay(self, first_segment):
+        """
+        Yields the records of the segments from first_segment on. A torn last record in the
+        current segment is cut off, so records appended from now on follow the last good one.
+        """
+        for number in self.segments():
+            if number < first_segment:
+                continue
+            path = self.segment_path(number)
+            good = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line) if line.endswith(b"\n") else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        # Torn write from a crash: nothing after it was acknowledged.
+                        break
+                    good += len(line)
+                    yield record
+            if number == self.segment and good != os.path.getsize(path):
+                print("Cutting a torn record off {} at offset {}".format(path, good))
+                os.truncate(path, good)
+
+    def append(self, record, fallback=None, generation=None):
+        """
+        Queues one record for the next group commit and returns (ticket, generation), the
+        generation being that of the segment the record went into.
+        If generation is given and a rotate has happened since, fallback is written instead:
+        for records that only make sense next to an earlier one in the same segment.
+        """
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self.cond:
+            if self.failed is not None:
+                raise IOError("storage failed: {}".format(self.failed))
+            if generation is not None and generation != self.generation:
+                line = json.dumps(fallback, separators=(",", ":")) + "\n"
+            self.buffer.append(line)
+            self.appended += 1
+            self.records_since_snapshot += 1
+            self.cond.notify_all()
+            return self.appended, self.generation
+
+    def wait(self, ticket):
+        with self.cond:
+            while self.committed < ticket and not self.closed and self.failed is None:
+                self.cond.wait()
+            if self.committed < ticket and self.failed is not None:
+                raise IOError("storage failed: {}".format(self.failed))
+
+    def commit_future(self, ticket):
+        """
+        For the event loop: a future on the running loop that completes once ticket is
+        fsynced (or fails with the flusher), or None if it already is.
+        """
+        with self.cond:
+            if self.committed >= ticket or self.closed:
+                return None
+            if self.failed is not None:
+                raise IOError("storage failed: {}".format(self.failed))
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self.waiters.append((ticket, loop, future))
+            return future
+
+    def mark_committed(self, ticket):
+        """Records that everything up to ticket is fsynced and wakes its waiters; caller holds cond."""
+        self.committed = max(self.committed, ticket)
+        self.cond.notify_all()
+        if self.waiters:
+            waiting = []
+            for waiter in self.waiters:
+                if waiter[0] <= self.committed:
+                    settle_future(waiter[1], waiter[2])
+                elif self.closed or self.failed is not None:
+                    settle_future(waiter[1], waiter[2], self.failed)
+                else:
+                    waiting.append(waiter)
+            self.waiters = waiting
+
+    def flush_loop(self):
+        while True:
+            with self.cond:
+                while not self.buffer and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            # Give concurrent writers a moment to join this batch.
+            time.sleep(self.commit_interval)
+            try:
+                self.commit()
+            except Exception as e:
+                # A full disk or I/O error: stop accepting writes instead of acknowledging lost ones.
+                print("Storage flusher failed: {}".format(e))
+                with self.cond:
+                    self.failed = e
+                    self.mark_committed(self.committed)
+                return
+
+    def commit(self):
+        with self.io_lock:
+            with self.cond:
+                batch, self.buffer = self.buffer, []
+                ticket = self.appended
+            if batch:
+                self.wal.write("".join(batch).encode("utf-8"))
+                self.wal.flush()
+                os.fsync(self.wal.fileno())
+            with self.cond:
+                self.mark_committed(ticket)
+
+    def needs_snapshot(self):
+        with self.cond:
+            if self.snapshotting or self.records_since_snapshot < self.snapshot_every:
+                return False
+            self.snapshotting = True
+            return True
+
+    def rotate(self):
+        """Commits what is buffered and starts a new segment; returns its number."""
+        with self.io_lock:
+            with self.cond:
+                batch, self.buffer = self.buffer, []
+                ticket = self.appended
+                self.records_since_snapshot = 0
+                self.generation += 1
+            self.wal.write("".join(batch).encode("utf-8"))
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+            self.wal.close()
+            self.segment += 1
+            self.wal = open(self.segment_path(self.segment), "ab")
+            with self.cond:
+                self.mark_committed(ticket)
+            return self.segment
+
+    def write_snapshot(self, segment, users, groups=None, epoch=None, posts=None):
+        """Atomically replaces the snapshot and deletes the segments it covers."""
+        tmp_path = self.snapshot_path() + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"segment": segment, "epoch": epoch, "users": users, "groups": groups or {},
+                       "posts": posts or {}}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path())
+        for number in self.segments():
+            if number < segment:
+                os.remove(self.segment_path(number))
+        with self.cond:
+            self.snapshotting = False
+
+    def close(self):
+        self.commit()
+        with self.cond:
+            self.closed = True
+            self.mark_committed(self.committed)
+        with self.io_lock:
+            self.wal.close()
+
+class BlobStore:
+    """
+    Committed files, each distinct content stored once under blobs/<sha256>.
+    Every file message delivered holds its own reference, a hard link
+    refs/<file_id> to the blob, so the file system does the reference
+    counting (st_nlink) and cluster workers sharing the directory need no
+    lock between them. A blob goes away with its last reference. File ids
+    carry their creation time and the blob's hash, so a reference can be
+    expired or released knowing only its id. owners/<file_id> names the user
+    the reference was delivered to; only they may release it.
+    """
+    def __init__(self, root):
+        self.blob_dir = os.path.join(root, "blobs")
+        self.ref_dir = os.path.join(root, "refs")
+        self.owner_dir = os.path.join(root, "owners")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.ref_dir, exist_ok=True)
+        os.makedirs(self.owner_dir, exist_ok=True)
+
+    def add(self, path, owner, digest=None):
+        """
+        Moves the file at path into the store, unless its content is already there;
+        returns a new file id, referenced on behalf of owner.
+        """
+        if digest is None:
+            digest = file_digest(path)
+        blob = os.path.join(self.blob_dir, digest)
+        while True:
+            try:
+                os.link(path, blob)
+            except FileExistsError:
+                pass
+            file_id = "%012x%s%s" % (int(time.time()), digest, uuid.uuid4().hex)
+            # The owner goes first, so a reference is never seen without one.
+            with open(os.path.join(self.owner_dir, file_id), "w", encoding="utf-8") as f:
+                f.write(owner)
+            try:
+                os.link(blob, self.ref_path(file_id))
+                break
+            except FileNotFoundError:
+                # Its last reference was released in between: store ours again.
+                os.remove(os.path.join(self.owner_dir, file_id))
+                continue
+        os.remove(path)
+        return file_id
+
+    def owner(self, file_id):
+        """The user a reference was delivered to, or None for references stored before owners were kept."""
+        try:
+            with open(os.path.join(self.owner_dir, file_id), "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def ref_path(self, file_id):
+        if not isinstance(file_id, str) or len(file_id) != FILE_ID_LENGTH or not file_id.isalnum():
+            raise ValueError("Bad file id")
+        return os.path.join(self.ref_dir, file_id)
+
+    def release(self, file_id, owner=None):
+        """
+        Drops one reference, and the blob with its last one. Returns False if it was already gone.
+        With owner given, raises PermissionError if the reference was delivered to someone else.
+        """
+        path = self.ref_path(file_id)
+        if owner is not None and self.owner(file_id) not in (None, owner):
+            raise PermissionError("Not the recipient of this file")
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        try:
+            os.remove(os.path.join(self.owner_dir, file_id))
+        except FileNotFoundError:
+            pass
+        blob = os.path.join(self.blob_dir, file_id[12:76])
+        try:
+            # Should add() link the blob right after this check, its reference keeps the data alive;
+            # the content is merely stored again next time.
+            if os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def expire(self, cutoff):
+        """Releases every reference created before cutoff; returns how many went."""
+        expired = 0
+        for name in os.listdir(self.ref_dir):
+            try:
+                created = int(name[:12], 16)
+            except ValueError:
+                continue
+            if created < cutoff and self.release(name):
+                expired += 1
+        return expired
+
+    def stats(self):
+        blobs = 0
+        size = 0
+        with os.scandir(self.blob_dir) as entries:
+            for entry in entries:
+                blobs += 1
+                size += entry.stat().st_size
+        return {"blobs": blobs, "bytes": size, "refs": len(os.listdir(self.ref_dir))}
+
+class MessageHistory:
+    """
+    Every text message and group post, kept on disk in one append-only file
+    under history_dir, with in-memory arrays to find them again.
+
+    Each message gets an id (a microsecond timestamp, bumped so ids never repeat
+    or go backwards) and a position in the file. Per conversation we keep the
+    positions of its messages, so get_history pages backwards with a bisect.
+    The inverted index maps each token to the positions containing it, with the
+    token's count in that message, and grows as messages are appended: nothing
+    is ever re-indexed. Text is only read back from the file for returned hits.
+    A writer thread writes appended lines in batches; until then they are read from memory.
+    """
+    def __init__(self, history_dir):
+        os.makedirs(history_dir, exist_ok=True)
+        self.path = os.path.join(history_dir, "history.log")
+        # Per position: message id, file offset, conversation number and token count.
+        self.ids = array("q")
+        self.offsets = array("q")
+        self.convs = array("i")
+        self.lengths = array("H")
+        self.total_tokens = 0
+        # conversations: conversation key -> number; keys are ("dm", a, b) with a < b, or ("group", name)
+        self.conversations = {}
+        self.conv_keys = []
+        # conv_positions: conversation number -> array of positions, oldest first
+        self.conv_positions = []
+        # user_convs: username -> numbers of the direct conversations they are in
+        self.user_convs = {}
+        # index: token -> (array of positions, array of in-message counts)
+        self.index = {}
+        self.last_id = 0
+        self.lock = threading.Lock()
+        self.load()
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+        self.reader = open(self.path, "rb")
+        # pending: encoded lines not yet written; flushed: the file offset where they start
+        self.pending = []
+        self.flushed = self.size
+        self.closed = False
+        self.cond = threading.Condition()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def load(self):
+        """Rebuilds the arrays and index from the file, cutting off a torn last line."""
+        if not os.path.exists(self.path):
+            return
+        good = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self.add(record, good)
+                good += len(line)
+        if good != os.path.getsize(self.path):
+            os.truncate(self.path, good)
+
+    def append(self, key, msg):
+        """Stores one message of conversation key; returns its id."""
+        with self.lock:
+            history_id = max(self.last_id + 1, time.time_ns() // 1000)
+            record = {"id": history_id, "conv": list(key), "from": msg.get("from"),
+                      "message": msg.get("message"), "time": msg.get("time")}
+            line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+            with self.cond:
+                self.pending.append(line)
+                self.cond.notify()
+            # size first: readers take it as the end of the newest position once add publishes it.
+            offset = self.size
+            self.size += len(line)
+            self.add(record, offset)
+            return history_id
+
+    def write_loop(self):
+        """
+        Writes pending lines, as many as have piled up per write, and flushes (not fsyncs) them:
+        a crash of the process loses at most the batch in hand, one of the machine may lose more.
+        """
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                batch = list(self.pending)
+            data = b"".join(batch)
+            self.file.write(data)
+            self.file.flush()
+            with self.cond:
+                del self.pending[:len(batch)]
+                self.flushed += len(data)
+
+    def add(self, record, offset):
+        key = tuple(record["conv"])
+        conv = self.conversations.get(key)
+        if conv is None:
+            conv = len(self.conv_keys)
+            self.conversations[key] = conv
+            self.conv_keys.append(key)
+            self.conv_positions.append(array("i"))
+            if key[0] == "dm":
+                for username in key[1:]:
+                    self.user_convs.setdefault(username, set()).add(conv)
+        position = len(self.ids)
+        counts = {}
+        for token in tokenize(record.get("message")):
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            postings = self.index.get(token)
+            if postings is None:
+                postings = self.index[token] = (array("i"), array("H"))
+            postings[0].append(position)
+            postings[1].append(min(count, 0xFFFF))
+        length = sum(counts.values())
+        self.total_tokens += length
+        self.lengths.append(min(length, 0xFFFF))
+        self.ids.append(record["id"])
+        self.offsets.append(offset)
+        self.convs.append(conv)
+        self.conv_positions[conv].append(position)
+        self.last_id = max(self.last_id, record["id"])
+
+    def read(self, positions):
+        """The stored records at these positions, in the same order."""
+        records = []
+        for position in positions:
+            offset = self.offsets[position]
+            end = self.offsets[position + 1] if position + 1 < len(self.offsets) else self.size
+            line = self.read_bytes(offset, end)
+            records.append(json.loads(line.split(NEWLINE, 1)[0]))
+        return records
+
+    def read_bytes(self, offset, end):
+        """A stored line, from memory while the writer has not reached it yet."""
+        if end > self.flushed:
+            with self.cond:
+                if end > self.flushed:
+                    return b"".join(self.pending)[offset - self.flushed:end - self.flushed]
+        return os.pread(self.reader.fileno(), end - offset, offset)
+
+    def page(self, key, before, limit, after=None):
+        """
+        Up to limit records of conversation key, oldest first, and whether there are more.
+        With after: the oldest ones with ids above it, "more" meaning newer ones exist.
+        Otherwise the newest ones with ids below before (if given), "more" meaning older ones exist.
+        """
+        conv = self.conversations.get(key)
+        if conv is None:
+            return [], False
+        positions = self.conv_positions[conv]
+        end = len(positions)
+        if after is not None:
+            start = bisect.bisect_right(positions, after, hi=end, key=lambda position: self.ids[position])
+            return self.read(positions[start:start + limit]), start + limit < end
+        if before is not None:
+            end = bisect.bisect_left(positions, before, hi=end, key=lambda position: self.ids[position])
+        start = max(end - limit, 0)
+        return self.read(positions[start:end]), start > 0
+
+    def search(self, terms, convs, count):
+        """
+        The best count (score, id, position) hits among conversations convs for messages
+        containing every term, ranked by BM25. Starts from the rarest term's postings.
+        """
+        # Appends only add positions past this one, so everything below it is safe to read unlocked.
+        with self.lock:
+            total = len(self.ids)
+            average = self.total_tokens / total if total else 1.0
+        postings = []
+        for term in terms:
+            entry = self.index.get(term)
+            if entry is None:
+                return [], 0
+            postings.append(entry)
+        postings.sort(key=lambda entry: len(entry[0]))
+        idfs = [math.log(1 + (total - len(entry[0]) + 0.5) / (len(entry[0]) + 0.5)) for entry in postings]
+        # Hits so far: position -> score. Each further term narrows them with a bisect into its postings.
+        first_positions, first_counts = postings[0]
+        scores = {}
+        for i in range(bisect.bisect_left(first_positions, total)):
+            position = first_positions[i]
+            if self.convs[position] in convs:
+                scores[position] = idfs[0] * self.term_weight(first_counts[i], position, average)
+        for (positions, counts), idf in zip(postings[1:], idfs[1:]):
+            if not scores:
+                break
+            narrowed = {}
+            for position, score in scores.items():
+                i = bisect.bisect_left(positions, position)
+                if i < len(positions) and positions[i] == position:
+                    narrowed[position] = score + idf * self.term_weight(counts[i], position, average)
+            scores = narrowed
+        best = heapq.nlargest(count, ((score, self.ids[position], position) for position, score in scores.items()))
+        return best, len(scores)
+
+    def term_weight(self, count, position, average):
+        length = self.lengths[position]
+        return count * (BM25_K1 + 1) / (count + BM25_K1 * (1 - BM25_B + BM25_B * length / average))
+
+    def stats(self):
+        return {"messages": len(self.ids), "conversations": len(self.conv_keys), "terms": len(self.index),
+                "bytes": self.size}
+
+    def close(self):
+        with self.lock:
+            with self.cond:
+                self.closed = True
+                self.cond.notify()
+            self.writer.join()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.reader.close()
+
+class TrafficRecorder:
+    """
+    Appends client requests and their replies to a capture file that
+    benchmarks/replay.py re-drives against another server. Record kinds:
+    b"O" opens a connection (payload: its framing and compression as JSON),
+    b"Q" is a request payload, b"R" the reply to the connection's previous
+    request and b"C" closes it. Captures hold passwords and message text as
+    they were sent, so they need the same care as the data directory.
+    Request threads only queue records; the writer thread compresses them.
+    """
+    def __init__(self, path, responses=True):
+        self.path = path
+        self.responses = responses
+        self.file = gzip.open(path, "wb", compresslevel=CAPTURE_LEVEL)
+        self.file.write(CAPTURE_MAGIC)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.pending = []
+        self.next_id = 0
+        self.records = 0
+        self.closed = False
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def write(self, kind, capture_id, payload=b""):
+        header = CAPTURE_RECORD.pack(kind, capture_id, int(time.time() * 1000000), len(payload))
+        with self.cond:
+            if self.closed:
+                return
+            self.pending.append(header)
+            self.pending.append(payload)
+            self.records += 1
+            self.cond.notify()
+
+    def request(self, conn, payload):
+        if conn.capture_id is None:
+            with self.lock:
+                self.next_id += 1
+                conn.capture_id = self.next_id
+            # Cluster workers get connections that already negotiated with the master.
+            opening = {"framing": conn.framing,
+                       "compression": "deflate" if conn.compress_threshold is not None else None}
+            self.write(b"O", conn.capture_id, json.dumps(opening).encode("utf-8"))
+        self.write(b"Q", conn.capture_id, payload)
+
+    def response(self, conn, reply):
+        if self.responses:
+            self.write(b"R", conn.capture_id, reply)
+
+    def close_connection(self, conn):
+        if conn.capture_id is not None:
+            self.write(b"C", conn.capture_id)
+
+    def write_loop(self):
+        """
+        Compresses queued records, as many as have piled up per write, and pushes them
+        to disk every CAPTURE_FLUSH_INTERVAL, so a killed server loses little.
+        """
+        flushed = time.monotonic()
+        while True:
+            with self.cond:
+                if not self.pending and not self.closed:
+                    self.cond.wait(CAPTURE_FLUSH_INTERVAL)
+                batch, self.pending = self.pending, []
+                closed = self.closed
+            if batch:
+                self.file.write(b"".join(batch))
+            if closed:
+                self.file.close()
+                return
+            if time.monotonic() - flushed >= CAPTURE_FLUSH_INTERVAL:
+                self.file.flush()
+                flushed = time.monotonic()
+
+    def stats(self):
+        return {"path": self.path, "records": self.records, "connections": self.next_id}
+
+    def close(self):
+        """Writes out what is still queued and closes the file."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.writer.join()
+
+class Histogram:
+    """Counts observations (seconds) into fixed log-spaced buckets; percentiles are bucket upper bounds."""
+    __slots__ = ("counts", "total", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += 1
+        self.sum += seconds
+
+    def percentile(self, fraction):
+        if not self.total:
+            return 0.0
+        rank = fraction * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else float("inf")
+        return float("inf")
+
+    def summary(self):
+        return {"count": self.total,
+                "mean_ms": round(self.sum / self.total * 1000, 3) if self.total else 0.0,
+                "p50_ms": self.percentile(0.50) * 1000,
+                "p95_ms": self.percentile(0.95) * 1000,
+                "p99_ms": self.percentile(0.99) * 1000}
+
+class Metrics:
+    """
+    Process-wide counters and latency histograms, keyed by (name, label).
+    Each thread updates its own shard without locking; copy() merges them.
+    Shards of threads that have exited are folded into one retired shard now and then.
+    Labels are capped at MAX_METRIC_LABELS per name so junk actions cannot grow it without bound.
+    """
+    def __init__(self):
+        # lock: guards shards, retired and new labels; never taken on the update path
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.local = threading.local()
+        # shards: (thread, counters, histograms) per thread that has recorded anything;
+        # counters: (name, label) -> int; histograms: (name, label) -> Histogram
+        self.shards = []
+        self.retired = ({}, {})
+        self.live_shards = 1
+        self.labels = {}
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = ({}, {})
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+                if len(self.shards) > 2 * self.live_shards:
+                    self.fold_dead_shards()
+        return shard
+
+    def fold_dead_shards(self):
+        """Merges the shards of finished threads into retired; caller holds lock."""
+        live = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                merge_metrics(self.retired, shard)
+        self.shards = live
+        self.live_shards = max(len(live), 1)
+
+    def label(self, name, label):
+        labels = self.labels.get(name)
+        if labels is not None and label in labels:
+            return label
+        with self.lock:
+            labels = self.labels.setdefault(name, set())
+            if label not in labels:
+                if len(labels) >= MAX_METRIC_LABELS:
+                    return "other"
+                labels.add(label)
+        return label
+
+    def count(self, name, amount=1, label=""):
+        counters = self.shard()[0]
+        key = (name, self.label(name, label))
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, label=""):
+        histograms = self.shard()[1]
+        key = (name, self.label(name, label))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def record_request(self, action, seconds, ok):
+        """One process_request dispatch: request count, error count and latency."""
+        counters, histograms = self.shard()
+        action = self.label("request_seconds", str(action))
+        histogram = histograms.get(("request_seconds", action))
+        if histogram is None:
+            histogram = histograms[("request_seconds", action)] = Histogram()
+        histogram.observe(seconds)
+        if not ok:
+            key = ("request_errors", action)
+            counters[key] = counters.get(key, 0) + 1
+
+    def copy(self):
+        """The counters and histograms summed over every thread's shard."""
+        merged = ({}, {})
+        with self.lock:
+            self.fold_dead_shards()
+            merge_metrics(merged, self.retired)
+            for thread, shard in self.shards:
+                merge_metrics(merged, shard)
+        return merged
+
+def merge_metrics(into, shard):
+    """Adds one (counters, histograms) shard into another. The source may still be updated by its thread."""
+    counters, histograms = into
+    # list() takes each snapshot in one step, so a concurrent insert cannot break the iteration.
+    for key, value in list(shard[0].items()):
+        counters[key] = counters.get(key, 0) + value
+    for key, histogram in list(shard[1].items()):
+        total = histograms.get(key)
+        if total is None:
+            total = histograms[key] = Histogram()
+        for index, count in enumerate(list(histogram.counts)):
+            total.counts[index] += count
+        total.total += histogram.total
+        total.sum += histogram.sum
+
+class TimedLock:
+    """
+    Wraps a Lock or RLock and times how long acquirers wait for it.
+    The uncontended path only bumps a counter on the lock itself (safe: we hold it);
+    waits go into the "lock_wait_seconds" histogram.
+    """
+    __slots__ = ("lock", "name", "metrics", "acquires", "contended")
+
+    def __init__(self, lock, name, metrics):
+        self.lock = lock
+        self.name = name
+        self.metrics = metrics
+        self.acquires = 0
+        self.contended = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.acquires += 1
+            return True
+        if not blocking:
+            return False
+        started = time.perf_counter()
+        if not self.lock.acquire(True, timeout):
+            return False
+        waited = time.perf_counter() - started
+        self.acquires += 1
+        self.contended += 1
+        self.metrics.observe("lock_wait_seconds", waited, self.name)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+class SamplingProfiler:
+    """
+    Opt-in wall-clock profiler: a thread snapshots every other thread's stack with
+    sys._current_frames() each interval and counts the folded stacks.
+    Threads idle in recv/select show up too; filter them when reading the output.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stacks = {}
+        self.samples = 0
+        self.interval = 0.005
+        self.thread = None
+        self.running = False
+
+    def start(self, interval=0.005):
+        with self.lock:
+            self.interval = interval
+            if self.running:
+                return
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+
+    def reset(self):
+        with self.lock:
+            self.stacks = {}
+            self.samples = 0
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running:
+            frames = sys._current_frames()
+            folded = []
+            for thread_id, frame in frames.items():
+                if thread_id == own:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append("{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename),
+                                                     frame.f_lineno))
+                    frame = frame.f_back
+                folded.append(";".join(reversed(names)))
+            del frames
+            with self.lock:
+                for stack in folded:
+                    self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def top(self, limit=50):
+        """The most frequent folded stacks, as [stack, count] pairs."""
+        with self.lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)
+        return [[stack, count] for stack, count in stacks[:limit]]
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """GET /metrics (counters and histograms) and GET /profile (folded stacks) for the scrape endpoint."""
+    def do_GET(self):
+        chat_server = self.server.chat_server
+        if self.path == "/metrics":
+            body = chat_server.metrics_text()
+        elif self.path == "/profile":
+            body = "".join("{} {}\n".format(stack, count) for stack, count in chat_server.profiler.top(1000))
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
 
 class LegacyChatServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, backlog=1024, max_connections=20000, data_dir=None,
+                 shard_index=0, shard_count=1, peer_paths=None, files_root=None,
+                 metrics_port=None, admin_token=None, capture_path=None, epoch=None):
         self.server_address = (host, port)
-        # Data store: username -> {'password': str, 'buddies': dict, 'messages': list, 'status': str}
+        # Request counters, latency histograms and lock waits; see the stats action.
+        self.metrics = Metrics()
+        self.profiler = SamplingProfiler()
+        # Optional plain-text scrape endpoint on 127.0.0.1:metrics_port.
+        self.metrics_port = metrics_port
+        # When set, stats and profile requests must carry this token.
+        self.admin_token = admin_token
+        # Cluster mode: this process owns the users whose username hashes to shard_index.
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        # Wire codec for requests, replies and pushes; the fastest installed JSON library.
+        self.codec = make_codec()
+        self.peers = [PeerLink(path, self.codec) if i != shard_index else None
+                      for i, path in enumerate(peer_paths or [])]
+        # Data store: username -> UserRecord
         self.users = {}
-        self.lock = threading.Lock()
+        # groups: group name -> GroupRecord, for the groups this shard owns
+        self.groups = {}
+        # Registry lock: only taken to add users or groups. Each UserRecord and GroupRecord has its own lock.
+        self.lock = TimedLock(threading.Lock(), "registry", self.metrics)
+        self.presence_version = 0
+        self.presence_lock = TimedLock(threading.Lock(), "presence", self.metrics)
         self.running = True
+        self.backlog = backlog
+        self.max_connections = max_connections
+        self.connection_count = 0
+        self.connection_lock = threading.Lock()
+        self.storage = None
+        # epoch: identifies this server's data. It only changes when the data starts over (a restart
+        # without data_dir, or a wiped one), telling clients their cursors and cached history are stale.
+        self.epoch = None
+        if data_dir:
+            self.storage = Storage(data_dir)
+            self.restore()
+        if self.epoch is None or epoch is not None and epoch != self.epoch:
+            self.epoch = epoch or uuid.uuid4().hex
+            self.log({"op": "epoch", "epoch": self.epoch})
+        # Chunked uploads are spooled to disk and survive restarts when data_dir is set.
+        # Cluster workers share one files_root so any worker can take chunks for any upload.
+        # scratch: without data_dir, a temporary directory for uploads and history, removed by close() (or at exit)
+        self.scratch = None
+        if not data_dir:
+            self.scratch = tempfile.TemporaryDirectory(prefix="legacychat-")
+        files_root = files_root or data_dir or self.scratch.name
+        self.spool_dir = os.path.join(files_root, "spool")
+        self.files_dir = os.path.join(files_root, "files")
+        os.makedirs(self.spool_dir, exist_ok=True)
+        os.makedirs(self.files_dir, exist_ok=True)
+        self.blobs = BlobStore(self.files_dir)
+        # Searchable message history, kept next to the log when data_dir is set.
+        history_dir = os.path.join(data_dir or self.scratch.name, "history")
+        self.history = MessageHistory(history_dir)
+        # uploads: upload_id -> {'sender', 'recipient', 'filename', 'size', 'path', 'lock'}, plus
+        # 'expired' once the sweeper has deleted it
+        self.uploads = {}
+        self.upload_lock = threading.Lock()
+        self.max_chunk_size = MAX_CHUNK_SIZE
+        self.max_frame_size = MAX_FRAME_SIZE
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.rate_limit_requests = RATE_LIMIT_REQUESTS
+        self.rate_limit_burst = RATE_LIMIT_BURST
+        self.rate_limit_bytes = RATE_LIMIT_BYTES
+        self.send_timeout = SEND_TIMEOUT
+        self.max_outbound_bytes = MAX_OUTBOUND_BYTES
+        self.mailbox_max_messages = MAILBOX_MAX_MESSAGES
+        self.mailbox_max_bytes = MAILBOX_MAX_BYTES
+        self.mailbox_policy = MAILBOX_POLICY
+        self.message_ttl = MESSAGE_TTL
+        self.sweep_interval = SWEEP_INTERVAL
+        self.upload_ttl = UPLOAD_TTL
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        # idle_timeout: 0 keeps idle connections open; presence_expiry: False leaves statuses alone
+        self.idle_timeout = IDLE_TIMEOUT
+        self.presence_expiry = True
+        # Created by start_reaper once the server starts serving.
+        self.idle_wheel = None
+        # Per-thread batch state: pending log tickets while a batch defers its commit waits.
+        self.batch_state = threading.local()
+        # Optional traffic capture of every client request and reply, for replay benchmarks.
+        self.recorder = TrafficRecorder(capture_path) if capture_path else None
 
-    def start(self):
-        print("Starting LegacyChat Server on {}:{}".format(*self.server_address))
+    def start(self, mode="threaded"):
+        print("Starting LegacyChat Server ({}, {} codec) on {}:{}".format(mode, self.codec.name, *self.server_address))
+        self.start_metrics_endpoint()
+        self.start_reaper()
+        threading.Thread(target=self.sweep_loop, daemon=True).start()
+        stop_on_sigterm()
+        try:
+            if mode == "async":
+                asyncio.run(self.serve_async())
+            elif mode == "threaded":
+                self.serve_threaded()
+            else:
+                raise ValueError("Unknown server mode: {}".format(mode))
+        except KeyboardInterrupt:
+            print("Server is shutting down.")
+        finally:
+            self.close()
+
+    def close(self):
+        """Flushes everything to disk and removes the scratch directory, if there is one."""
+        if self.storage is not None:
+            self.storage.close()
+        self.history.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.scratch is not None:
+            self.scratch.cleanup()
+
+    def serve_threaded(self):
+        """One thread per connected client."""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind(self.server_address)
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.backlog)
         try:
             while self.running:
                 client_socket, client_address = self.server_socket.accept()
+                with self.connection_lock:
+                    if self.connection_count >= self.max_connections:
+                        client_socket.close()
+                        continue
+                    self.connection_count += 1
                 print("Connection from", client_address)
                 threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
-        except KeyboardInterrupt:
-            print("Server is shutting down.")
         finally:
             self.server_socket.close()
 
-    def handle_client(self, client_socket):
-        """Simple line-delimited JSON protocol."""
+    def serve_worker(self, handoff_sock, peer_path):
+        """Cluster worker: serves sockets handed over by the master plus connections from other workers."""
+        # handoff_lock: held while reporting a closed connection back to the master
+        self.handoff_lock = threading.Lock()
+        peer_listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        peer_listener.bind(peer_path)
+        peer_listener.listen(self.backlog)
+        threading.Thread(target=self.accept_peers, args=(peer_listener,), daemon=True).start()
+        self.start_metrics_endpoint()
+        self.start_reaper()
+        threading.Thread(target=self.sweep_loop, daemon=True).start()
+        try:
+            while self.running:
+                handoff = recv_handoff(handoff_sock)
+                if handoff is None:
+                    break
+                fd, framing, compression, initial = handoff
+                client_socket = socket.socket(fileno=fd)
+                with self.connection_lock:
+                    self.connection_count += 1
+                threading.Thread(target=self.serve_handoff, args=(handoff_sock, client_socket, initial, framing,
+                                                                  compression), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def serve_handoff(self, handoff_sock, client_socket, initial, framing, compression):
+        """Serves a socket from the master, then tells the master it closed, so it can count connections."""
+        try:
+            self.handle_client(client_socket, initial, framing, compression=compression)
+        finally:
+            with self.handoff_lock:
+                try:
+                    handoff_sock.sendall(b"C")
+                except OSError:
+                    pass
+
+    def accept_peers(self, peer_listener):
+        while self.running:
+            peer_socket, address = peer_listener.accept()
+            with self.connection_lock:
+                self.connection_count += 1
+            threading.Thread(target=self.handle_client, args=(peer_socket, b"", "line", True), daemon=True).start()
+
+    async def serve_async(self):
+        """All clients on a single selector event loop running the same handlers."""
+        # async_connections: open connections, dropped at shutdown so no handler outlives the loop
+        self.async_connections = set()
+        server = await asyncio.start_server(self.handle_client_async, *self.server_address,
+                                            backlog=self.backlog, limit=self.max_frame_size,
+                                            reuse_address=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for conn in list(self.async_connections):
+                conn.closed = True
+                conn.writer.transport.abort()
+
+    async def handle_client_async(self, reader, writer):
+        """Same protocol as handle_client, on the event loop."""
+        if self.connection_count >= self.max_connections:
+            writer.close()
+            return
+        self.connection_count += 1
+        print("Connection from", writer.get_extra_info("peername"))
+        conn = AsyncClientConnection(writer, asyncio.get_running_loop(), self.max_outbound_bytes)
+        self.async_connections.add(conn)
+        conn.rate_limits = self.new_rate_limits()
+        if self.idle_wheel is not None:
+            self.idle_wheel.add(conn)
+        framing = conn.framing
         try:
-            data_buffer = ""
             while True:
-                data = client_socket.recv(4096).decode("utf-8")
-                if not data:
+                framing = conn.framing
+                if framing == "binary":
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                    (length,) = FRAME_HEADER.unpack(header)
+                    compressed = length & COMPRESSED_FLAG
+                    length &= ~COMPRESSED_FLAG
+                    if length > self.max_frame_size:
+                        raise FrameTooLarge("Request too large")
+                    payload = await reader.readexactly(length)
+                    if compressed:
+                        payload = inflate(payload, self.max_frame_size)
+                else:
+                    try:
+                        payload = await reader.readline()
+                    except ValueError:
+                        # StreamReader hit its limit (max_frame_size) without finding a newline.
+                        raise FrameTooLarge("Request too large")
+                    if not payload:
+                        break
+                    payload = payload.strip()
+                    if not payload:
+                        continue
+                conn.last_active = time.monotonic()
+                self.metrics.count("bytes_in", len(payload))
+                delay = self.throttle(conn, len(payload))
+                if delay:
+                    await asyncio.sleep(delay)
+                reply = await self.handle_payload_async(payload, conn)
+                self.metrics.count("bytes_out", len(reply))
+                conn.send_frame(reply, framing)
+                # Stop reading from a client that does not read its replies; give up after send_timeout.
+                await asyncio.wait_for(writer.drain(), self.send_timeout)
+        except asyncio.IncompleteReadError:
+            pass
+        except asyncio.CancelledError:
+            # The loop is shutting down: end like a disconnect, since the stream's
+            # done-callback reports a cancelled handler as an error.
+            pass
+        except FrameTooLarge as ex:
+            self.reject_frame(conn, framing, ex)
+        except asyncio.TimeoutError:
+            print("Disconnecting slow consumer", conn.username or "")
+            conn.slow_consumer = True
+        except (ConnectionError, ValueError, asyncio.LimitOverrunError) as ex:
+            if not conn.slow_consumer:
+                print("Error handling client:", ex)
+        finally:
+            if conn.slow_consumer:
+                self.metrics.count("slow_consumers")
+            self.connection_count -= 1
+            self.async_connections.discard(conn)
+            self.connection_closed(conn)
+            conn.close()
+
+    def handle_payload(self, payload, conn=None, request=None):
+        """
+        Runs one request payload through process_request and returns the encoded reply payload.
+        request is the payload already decoded, if the caller has done that.
+        """
+        recorder = self.recorder if conn is not None and not conn.is_peer else None
+        if recorder is not None:
+            recorder.request(conn, payload)
+        try:
+            if request is None:
+                request = self.codec.loads(payload)
+            response = self.process_request(request, conn)
+        except Exception as e:
+            response = {"status": "error", "message": str(e)}
+        # Persistent clients tag requests with an id so replies, errors included, can be matched.
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]
+        reply = self.codec.dumps(response)
+        if recorder is not None:
+            recorder.response(conn, reply)
+        return reply
+
+    async def handle_payload_async(self, payload, conn):
+        """
+        handle_payload for the event loop: handlers only note the records they wrote, and
+        the reply waits here, without blocking the loop, until the last one is fsynced.
+        """
+        try:
+            request = self.codec.loads(payload)
+        except Exception:
+            # handle_payload decodes it again and answers with the error.
+            request = None
+        if needs_executor(request):
+            return await asyncio.get_running_loop().run_in_executor(None, self.handle_payload, payload, conn, request)
+        self.batch_state.deferred = []
+        try:
+            reply = self.handle_payload(payload, conn, request)
+        finally:
+            tickets, self.batch_state.deferred = self.batch_state.deferred, None
+        if tickets:
+            try:
+                future = self.storage.commit_future(max(tickets))
+                if future is not None:
+                    await future
+            except IOError as e:
+                response = {"status": "error", "message": str(e)}
+                request = self.codec.loads(payload)
+                if isinstance(request, dict) and "id" in request:
+                    response["id"] = request["id"]
+                reply = self.codec.dumps(response)
+        return reply
+
+    def handle_client(self, client_socket, initial=b"", framing="line", peer=False, compression=None):
+        """
+        Line-delimited JSON by default. A client may negotiate length-prefixed
+        binary frames, optionally compressed, with its first request.
+        """
+        conn = ClientConnection(client_socket, self.send_timeout, self.max_outbound_bytes)
+        conn.framing = framing
+        if compression == "deflate":
+            conn.compress_threshold = self.compression_threshold
+        conn.is_peer = peer
+        # Other workers forward many users' requests over one link, so they are not rate limited
+        # or closed when idle.
+        conn.rate_limits = None if peer else self.new_rate_limits()
+        if self.idle_wheel is not None and not peer:
+            self.idle_wheel.add(conn)
+        reader = FrameReader(client_socket, initial=initial, max_size=self.max_frame_size)
+        try:
+            while True:
+                framing = conn.framing
+                if framing == "binary":
+                    payload = reader.read_frame()
+                else:
+                    payload = reader.read_line()
+                if payload is None:
                     break
-                data_buffer += data
-                if "\n" in data_buffer:
-                    lines = data_buffer.split("\n")
-                    for line in lines[:-1]:
-                        line = line.strip()
-                        if not line:
-                            continue
-                        try:
-                            request = json.loads(line)
-                            response = self.process_request(request)
-                        except Exception as e:
-                            response = {"status": "error", "message": str(e)}
-                        client_socket.sendall((json.dumps(response) + "\n").encode("utf-8"))
-                    data_buffer = lines[-1]
+                if framing == "line" and not payload.strip():
+                    continue
+                conn.last_active = time.monotonic()
+                self.metrics.count("bytes_in", len(payload))
+                delay = self.throttle(conn, len(payload))
+                if delay:
+                    time.sleep(delay)
+                reply = self.handle_payload(payload, conn)
+                self.metrics.count("bytes_out", len(reply))
+                # The reply goes out in the framing the request came in, even for negotiate.
+                conn.send_frame(reply, framing)
+        except FrameTooLarge as ex:
+            self.reject_frame(conn, framing, ex)
         except Exception as ex:
-            print("Error handling client:", ex)
+            if not conn.slow_consumer:
+                print("Error handling client:", ex)
         finally:
-            client_socket.close()
+            if conn.slow_consumer:
+                self.metrics.count("slow_consumers")
+            with self.connection_lock:
+                self.connection_count -= 1
+            self.connection_closed(conn)
+            conn.close()
 
-    def process_request(self, request):
-        action = request.get("action")
-        if action == "signup":
-            return self.signup(request)
-        elif action == "login":
-            return self.login(request)
-        elif action == "add_buddy":
-            return self.add_buddy(request)
-        elif action == "send_message":
-            return self.send_message(request)
-        elif action == "get_messages":
-            return self.get_messages(request)
-        elif action == "send_file":
-            return self.send_file(request)
-        elif action == "update_status":
-            return self.update_status(request)
-        elif action == "get_buddy_status":
-            return self.get_buddy_status(request)
-        else:
+    def connection_closed(self, conn):
+        """Forgets a finished connection; a user left without subscribed connections is shown offline."""
+        if self.idle_wheel is not None:
+            self.idle_wheel.remove(conn)
+        self.close_relay(conn)
+        user = self.users.get(conn.username)
+        self.unsubscribe(conn)
+        if user is not None and self.presence_expiry:
+            self.expire_presence(user)
+        if self.recorder is not None:
+            self.recorder.close_connection(conn)
+
+    def start_reaper(self):
+        if self.idle_timeout:
+            self.idle_wheel = TimerWheel(self.idle_timeout)
+            threading.Thread(target=self.reap_loop, daemon=True).start()
+
+    def reap_loop(self):
+        """Closes connections idle past idle_timeout; their handlers then clean up as for any disconnect."""
+        while self.running:
+            time.sleep(IDLE_TICK)
+            for conn in self.idle_wheel.advance(time.monotonic()):
+                self.metrics.count("idle_closed")
+                print("Closing idle connection", conn.username or "")
+                conn.shutdown()
+
+    def new_rate_limits(self):
+        if not self.rate_limit_requests:
+            return None
+        return (TokenBucket(self.rate_limit_requests, self.rate_limit_burst),
+                TokenBucket(self.rate_limit_bytes, max(self.rate_limit_bytes, self.max_frame_size)))
+
+    def throttle(self, conn, size):
+        """Seconds this connection must wait before its next request is handled (0 when under its rate)."""
+        if conn.rate_limits is None:
+            return 0.0
+        requests, data = conn.rate_limits
+        delay = max(requests.take(), data.take(size))
+        if delay:
+            self.metrics.count("throttled")
+        return delay
+
+    def reject_frame(self, conn, framing, ex):
+        """Answers an oversized request with an error; the rest of it is never read, so the connection closes."""
+        self.metrics.count("oversized_requests")
+        print("Closing connection after oversized request", conn.username or "")
+        try:
+            conn.send_frame(json.dumps({"status": "error", "message": str(ex)}).encode("utf-8"), framing)
+        except (OSError, ConnectionError):
+            pass
+
+    def process_request(self, request, conn=None):
+        """Dispatches one request and records its latency under its action name."""
+        started = time.perf_counter()
+        response = self.dispatch(request, conn)
+        self.metrics.record_request(request.get("action") if isinstance(request, dict) else None,
+                                    time.perf_counter() - started, response.get("status") == "success")
+        return response
+
+    def dispatch(self, request, conn):
+        """Looks the action up in ACTIONS, checks its required fields and runs its handler."""
+        if not isinstance(request, dict):
+            return {"status": "error", "message": "Request must be a JSON object"}
+        name = request.get("action")
+        is_peer = conn is not None and conn.is_peer
+        if self.shard_count > 1 and not is_peer:
+            owner = self.owner_shard(request)
+            if owner is not None and owner != self.shard_index:
+                if name == "subscribe":
+                    return self.subscribe_remote(request, conn, owner)
+                return self.peers[owner].request(request)
+        spec = ACTIONS.get(name) if isinstance(name, str) else None
+        if spec is None or spec.peer_only and not is_peer:
             return {"status": "error", "message": "Unknown action"}
+        if spec.fields and spec.invalid(request):
+            return {"status": "error", "message": spec.message}
+        if spec.method is None:
+            if spec.wants_conn:
+                return spec.handler(self, request, conn)
+            return spec.handler(self, request)
+        if spec.wants_conn:
+            return getattr(self, spec.method)(request, conn)
+        return getattr(self, spec.method)(request)
+
+    @action("peer_user_exists", peer=True)
+    def peer_user_exists(self, request):
+        return {"status": "success", "exists": request.get("username") in self.users}
+
+    @action("peer_statuses", peer=True)
+    def peer_statuses(self, request):
+        return self.local_statuses(request.get("usernames", []), request.get("since", 0))
+
+    @action("peer_deliver", peer=True)
+    def peer_deliver(self, request):
+        user = self.users.get(request.get("username"))
+        if user is None:
+            return {"status": "error", "message": "Recipient does not exist"}
+        return self.deliver(user, request.get("message"))
+
+    @action("peer_group_deliver", peer=True)
+    def peer_group_deliver(self, request):
+        return self.fan_out(request.get("usernames", []), request.get("message"))
+
+    @action("peer_group_list", peer=True)
+    def peer_group_list(self, request):
+        return {"status": "success", "groups": self.local_groups_of(request.get("username"))}
 
+    @action("signup", {"username": str, "password": str}, "Username and password required")
     def signup(self, request):
-        username = request.get("username")
-        password = request.get("password")
-        if not username or not password:
-            return {"status": "error", "message": "Username and password required"}
+        username = request["username"]
+        password = request["password"]
+        # The registry lock is only needed to add a user; everything else locks one UserRecord.
         with self.lock:
             if username in self.users:
                 return {"status": "error", "message": "Username already exists"}
-            self.users[username] = {"password": password, "buddies": {}, "messages": [], "status": "online"}
+            user = self.new_user(username, password)
+            with self.presence_lock:
+                user.status_version = self.next_presence_version()
+            self.users[username] = user
+            ticket = self.log({"op": "signup", "username": username, "password": password,
+                               "version": user.status_version})
             print(f"New signup: {username}")
+        self.wait_logged(ticket)
         return {"status": "success", "message": "User signed up"}
 
+    @action("login", {"username": str, "password": str}, "Username and password required")
     def login(self, request):
-        username = request.get("username")
-        password = request.get("password")
-        if not username or not password:
-            return {"status": "error", "message": "Username and password required"}
-        with self.lock:
-            user = self.users.get(username)
-            if user is None:
-                return {"status": "error", "message": "User does not exist"}
-            if user["password"] != password:
+        username = request["username"]
+        password = request["password"]
+        user = self.users.get(username)
+        if user is None:
+            return {"status": "error", "message": "User does not exist"}
+        with user.lock:
+            if user.password != password:
                 return {"status": "error", "message": "Incorrect password"}
-        buddy_list = [{"username": buddy, "name": self.users[username]["buddies"][buddy]} for buddy in self.users[username]["buddies"]]
-        return {"status": "success", "message": "User logged in", "buddies": buddy_list}
+            buddy_list = [{"username": buddy, "name": name} for buddy, name in user.buddies.items()]
+        return {"status": "success", "message": "User logged in", "buddies": buddy_list, "epoch": self.epoch}
 
+    @action("add_buddy", {"username": str, "buddy_username": str, "buddy_name": str}, "Missing fields for adding buddy")
     def add_buddy(self, request):
-        username = request.get("username")
-        buddy_username = request.get("buddy_username")
-        buddy_name = request.get("buddy_name")
-        if not username or not buddy_username or not buddy_name:
-            return {"status": "error", "message": "Missing fields for adding buddy"}
-        with self.lock:
-            if username not in self.users:
-                return {"status": "error", "message": "User not found"}
-            if buddy_username not in self.users:
-                return {"status": "error", "message": "Buddy username does not exist"}
-            self.users[username]["buddies"][buddy_username] = buddy_name
+        username = request["username"]
+        buddy_username = request["buddy_username"]
+        buddy_name = request["buddy_name"]
+        user = self.users.get(username)
+        if user is None:
+            return {"status": "error", "message": "User not found"}
+        if not self.user_exists(buddy_username):
+            return {"status": "error", "message": "Buddy username does not exist"}
+        with user.lock:
+            user.buddies[buddy_username] = buddy_name
+            ticket = self.log({"op": "add_buddy", "username": username, "buddy_username": buddy_username,
+                               "buddy_name": buddy_name})
+        self.wait_logged(ticket)
         return {"status": "success", "message": "Buddy added"}
 
+    @action("send_message", {"sender": str, "recipient": str, "message": str}, "Missing fields for sending message")
     def send_message(self, request):
-        sender = request.get("sender")
-        recipient = request.get("recipient")
-        message_text = request.get("message")
-        if not sender or not recipient or not message_text:
-            return {"status": "error", "message": "Missing fields for sending message"}
-        with self.lock:
-            if recipient not in self.users:
-                return {"status": "error", "message": "Recipient does not exist"}
-            msg = {"from": sender, "message": message_text}
-            self.users[recipient]["messages"].append(msg)
+        sender = request["sender"]
+        recipient = request["recipient"]
+        message_text = request["message"]
+        user = self.users.get(recipient)
+        if user is None:
+            return {"status": "error", "message": "Recipient does not exist"}
+        msg = {"from": sender, "message": message_text, "time": time.time()}
+        res = self.deliver(user, msg)
+        if res["status"] != "success":
+            return res
+        self.history.append(("dm",) + tuple(sorted((sender, recipient))), msg)
         return {"status": "success", "message": "Message sent"}
 
+    @action("send_file", {"sender": str, "recipient": str, "filename": str, "filedata": str},
+            "Missing fields for sending file")
     def send_file(self, request):
-        sender = request.get("sender")
-        recipient = request.get("recipient")
-        filename = request.get("filename")
-        filedata = request.get("filedata")
-        if not sender or not recipient or not filename or not filedata:
-            return {"status": "error", "message": "Missing fields for sending file"}
-        with self.lock:
-            if recipient not in self.users:
-                return {"status": "error", "message": "Recipient does not exist"}
-            file_msg = {"from": sender, "filename": filename, "filedata": filedata, "type": "file"}
-            self.users[recipient]["messages"].append(file_msg)
+        sender = request["sender"]
+        recipient = request["recipient"]
+        filename = request["filename"]
+        filedata = request["filedata"]
+        user = self.users.get(recipient)
+        if user is None:
+            return {"status": "error", "message": "Recipient does not exist"}
+        # The whole file rides in the message, as clients using this inline form expect to
+        # receive it; clients that stream files use file_begin/file_chunk/file_commit instead.
+        file_msg = {"from": sender, "filename": os.path.basename(filename), "filedata": filedata, "type": "file"}
+        res = self.deliver(user, file_msg)
+        if res["status"] != "success":
+            return res
         return {"status": "success", "message": "File sent"}
 
+    @action("file_begin", {"sender": str, "recipient": str, "filename": str, "size": int},
+            "Missing fields for sending file")
+    def file_begin(self, request):
+        """Starts a chunked upload spooled to disk. Returns the upload id and the offset to send from."""
+        sender = request["sender"]
+        recipient = request["recipient"]
+        filename = request["filename"]
+        size = request["size"]
+        if size < 0:
+            return {"status": "error", "message": "Missing fields for sending file"}
+        if recipient not in self.users:
+            return {"status": "error", "message": "Recipient does not exist"}
+        upload_id = uuid.uuid4().hex
+        upload = {"sender": sender, "recipient": recipient, "filename": os.path.basename(filename), "size": size}
+        with open(self.spool_path(upload_id, ".json"), "w", encoding="utf-8") as f:
+            json.dump(upload, f)
+        open(self.spool_path(upload_id, ".part"), "wb").close()
+        return {"status": "success", "upload_id": upload_id, "offset": 0}
+
+    @action("file_status", {"upload_id": str}, "Missing fields for file status")
+    def file_status(self, request):
+        """Reports how many bytes of an upload have been spooled, so a client can resume."""
+        upload = self.get_upload(request["upload_id"])
+        if upload is None:
+            return {"status": "error", "message": "Upload not found"}
+        return {"status": "success", "offset": os.path.getsize(upload["path"]), "size": upload["size"]}
+
+    @action("file_chunk", {"upload_id": str, "offset": int, "data": str}, "Missing fields for file chunk")
+    def file_chunk(self, request):
+        """Appends one base64 chunk. The offset must match what the server already has."""
+        upload = self.get_upload(request["upload_id"])
+        offset = request["offset"]
+        data = request["data"]
+        if upload is None:
+            return {"status": "error", "message": "Upload not found"}
+        # Check the encoded length first so an oversized chunk is never decoded.
+        if len(data) > 4 * math.ceil(self.max_chunk_size / 3):
+            return {"status": "error", "message": "Chunk too large"}
+        try:
+            chunk = base64.b64decode(data, validate=True)
+        except (binascii.Error, ValueError):
+            return {"status": "error", "message": "Bad file data"}
+        if len(chunk) > self.max_chunk_size:
+            return {"status": "error", "message": "Chunk too large"}
+        with upload["lock"]:
+            if upload.get("expired"):
+                return {"status": "error", "message": "Upload not found"}
+            received = os.path.getsize(upload["path"])
+            if offset != received:
+                return {"status": "error", "message": "Unexpected offset", "offset": received}
+            if received + len(chunk) > upload["size"]:
+                return {"status": "error", "message": "Chunk past end of file", "offset": received}
+            with open(upload["path"], "ab") as f:
+                f.write(chunk)
+        return {"status": "success", "offset": received + len(chunk)}
+
+    @action("file_commit", {"upload_id": str}, "Missing fields for file commit")
+    def file_commit(self, request):
+        """
+        Finishes an upload: its content joins the blob store (or is dropped if an identical
+        file is already there) and the recipient gets a small reference to it.
+        """
+        upload_id = request["upload_id"]
+        upload = self.get_upload(upload_id)
+        if upload is None:
+            return {"status": "error", "message": "Upload not found"}
+        if not self.user_exists(upload["recipient"]):
+            return {"status": "error", "message": "Recipient does not exist"}
+        with upload["lock"]:
+            if upload.get("expired"):
+                return {"status": "error", "message": "Upload not found"}
+            received = os.path.getsize(upload["path"])
+            if received != upload["size"]:
+                return {"status": "error", "message": "Upload incomplete", "offset": received}
+            file_id = self.blobs.add(upload["path"], upload["recipient"])
+            os.remove(self.spool_path(upload_id, ".json"))
+        with self.upload_lock:
+            self.uploads.pop(upload_id, None)
+        file_msg = {"from": upload["sender"], "filename": upload["filename"], "file_id": file_id,
+                    "size": upload["size"], "type": "file"}
+        res = self.deliver_to(upload["recipient"], file_msg)
+        if res.get("status") != "success":
+            self.blobs.release(file_id)
+            return res
+        return {"status": "success", "message": "File sent", "file_id": file_id}
+
+    @action("file_fetch", {"file_id": str}, "Missing fields for file fetch")
+    def file_fetch(self, request):
+        """Reads back part of a committed file as base64, for streaming downloads."""
+        file_id = request["file_id"]
+        offset = request.get("offset", 0)
+        length = request.get("length", self.max_chunk_size)
+        if type(offset) is not int or type(length) is not int or offset < 0 or length < 1:
+            return {"status": "error", "message": "Missing fields for file fetch"}
+        length = min(length, self.max_chunk_size)
+        try:
+            with open(self.stored_file_path(file_id), "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                f.seek(offset)
+                chunk = f.read(length)
+        except (OSError, ValueError):
+            return {"status": "error", "message": "File not found"}
+        return {"status": "success", "data": base64.b64encode(chunk).decode("ascii"), "offset": offset,
+                "size": size, "eof": offset + len(chunk) >= size}
+
+    @action("file_release", {"username": str, "file_id": str}, "Missing fields for file release")
+    def file_release(self, request):
+        """The recipient is done with a file (saved or declined); drops their reference to it."""
+        try:
+            released = self.blobs.release(request["file_id"], request["username"])
+        except ValueError:
+            return {"status": "error", "message": "File not found"}
+        except PermissionError:
+            return {"status": "error", "message": "Not the recipient of this file"}
+        if not released:
+            return {"status": "error", "message": "File not found"}
+        return {"status": "success", "message": "File released"}
+
+    def stored_file_path(self, file_id):
+        """A file id's path: its blob reference, or a whole file committed before the blob store."""
+        if isinstance(file_id, str) and len(file_id) == FILE_ID_LENGTH:
+            return self.blobs.ref_path(file_id)
+        return self.file_path(file_id)
+
+    def get_upload(self, upload_id):
+        """Looks up an upload, reloading its metadata from the spool after a restart."""
+        if not upload_id or not upload_id.isalnum():
+            return None
+        with self.upload_lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                try:
+                    with open(self.spool_path(upload_id, ".json"), "r", encoding="utf-8") as f:
+                        upload = json.load(f)
+                except (OSError, ValueError):
+                    return None
+                upload["path"] = self.spool_path(upload_id, ".part")
+                upload["lock"] = threading.Lock()
+                self.uploads[upload_id] = upload
+            return upload
+
+    def spool_path(self, upload_id, suffix):
+        return os.path.join(self.spool_dir, upload_id + suffix)
+
+    def file_path(self, file_id):
+        if not isinstance(file_id, str) or not file_id.isalnum():
+            raise ValueError("Bad file id")
+        return os.path.join(self.files_dir, file_id)
+
+    def deliver(self, user, msg):
+        """
+        Queues a message in the recipient's mailbox under the next sequence number
+        and pushes it to their subscribed connections. It stays queued until acked,
+        or until it expires or is evicted. Returns an error when the mailbox is full.
+        """
+        if "time" not in msg:
+            msg = dict(msg, time=time.time())
+        size = message_size(msg)
+        if size > self.mailbox_max_bytes:
+            self.metrics.count("mailbox_rejected")
+            return {"status": "error", "message": "Message too large for mailbox"}
+        with user.lock:
+            seq = self.enqueue(user, msg, size)
+            if seq is None:
+                return {"status": "error", "message": "Recipient's mailbox is full"}
+            ticket = self.log({"op": "message", "username": user.username, "seq": seq, "message": msg})
+            subscribers = list(user.subscribers)
+        self.push_queued(user, subscribers)
+        self.wait_logged(ticket)
+        return {"status": "success", "message": "Delivered", "seq": seq}
+
+    def enqueue(self, user, msg, size, body=None):
+        """
+        Appends msg to a mailbox under the next seq and queues it on the subscribed
+        connections; caller holds user.lock, logs the append, and once the lock is released
+        calls push_queued. body is msg already encoded as JSON, so a message going to
+        many mailboxes is encoded once. Returns the seq, or None if the mailbox is full.
+        """
+        evict = self.evictions_needed(user, size)
+        if evict and self.mailbox_policy != "drop_oldest":
+            self.metrics.count("mailbox_rejected")
+            return None
+        if evict:
+            self.log({"op": "drain", "username": user.username, "seq": user.messages[evict - 1][0]})
+            self.remove_entries(user, evict)
+            self.metrics.count("mailbox_evicted", evict)
+        seq = user.next_seq
+        user.next_seq += 1
+        user.messages.append((seq, msg))
+        user.mailbox_bytes += size
+        # Queued under the lock so subscribers always see sequence numbers in order;
+        # push_queued hands them to the connections' writer threads after the lock is released.
+        if user.subscribers:
+            if body is None:
+                body = self.codec.dumps(msg)
+            payload = b"".join((PUSH_PREFIX, body[:-1], b', "seq": %d}}' % seq))
+            for conn in list(user.subscribers):
+                try:
+                    conn.queue_frame(payload)
+                    self.metrics.count("bytes_out", len(payload))
+                    self.metrics.count("pushes")
+                except (OSError, ConnectionError):
+                    user.subscribers.discard(conn)
+        return seq
+
+    def push_queued(self, user, connections):
+        """Has the connections write out what enqueue queued on them; call without holding user.lock."""
+        for conn in connections:
+            try:
+                conn.flush()
+            except (OSError, ConnectionError):
+                with user.lock:
+                    user.subscribers.discard(conn)
+
+    def evictions_needed(self, user, size):
+        """How many of the oldest messages must go for one more of this size to fit; caller holds user.lock."""
+        count = len(user.messages) + 1 - self.mailbox_max_messages
+        evict = max(count, 0)
+        excess = user.mailbox_bytes + size - self.mailbox_max_bytes
+        while excess > 0 and evict < len(user.messages):
+            excess -= message_size(user.messages[evict][1])
+            evict += 1
+        return evict
+
+    def remove_entries(self, user, count):
+        """Drops the oldest count mailbox entries and their bytes; caller holds user.lock."""
+        for seq, msg in user.messages[:count]:
+            user.mailbox_bytes -= message_size(msg)
+        del user.messages[:count]
+
+    @action("get_messages", {"username": str}, "Username required")
     def get_messages(self, request):
-        username = request.get("username")
-        if not username:
-            return {"status": "error", "message": "Username required"}
-        with self.lock:
-            if username not in self.users:
-                return {"status": "error", "message": "User not found"}
-            messages = self.users[username]["messages"]
-            self.users[username]["messages"] = []
-        return {"status": "success", "messages": messages}
+        """
+        With "since"/"limit"/"ack", pages through the mailbox by sequence number:
+        returns up to limit messages after since, and deletes everything up to ack.
+        Without them, returns and clears the whole mailbox as older clients expect.
+        """
+        username = request["username"]
+        user = self.users.get(username)
+        if user is None:
+            return {"status": "error", "message": "User not found"}
+        if "since" not in request and "limit" not in request and "ack" not in request:
+            return {"status": "success", "messages": self.drain(user)}
+        if self.stale_epoch(request):
+            # since and ack count from a mailbox this server no longer has: start over, deleting nothing.
+            return dict(self.read_mailbox(user, 0, request.get("limit", DEFAULT_PAGE_SIZE)), reset=True)
+        ack = request.get("ack")
+        if ack is not None:
+            if not isinstance(ack, int):
+                return {"status": "error", "message": "Bad ack"}
+            self.acknowledge(user, ack)
+        return self.read_mailbox(user, request.get("since", 0), request.get("limit", DEFAULT_PAGE_SIZE))
+
+    def stale_epoch(self, request):
+        """True if the request carries cursors from another epoch; requests without one are trusted."""
+        epoch = request.get("epoch")
+        return epoch is not None and epoch != self.epoch
+
+    def read_mailbox(self, user, since, limit):
+        if not isinstance(since, int) or not isinstance(limit, int) or limit < 1:
+            return {"status": "error", "message": "Bad since or limit"}
+        limit = min(limit, MAX_PAGE_SIZE)
+        with user.lock:
+            start = bisect.bisect_right(user.messages, since, key=lambda entry: entry[0])
+            entries = user.messages[start:start + limit]
+            more = start + limit < len(user.messages)
+        messages = [dict(msg, seq=seq) for seq, msg in entries]
+        last_seq = entries[-1][0] if entries else since
+        return {"status": "success", "messages": messages, "last_seq": last_seq, "more": more, "epoch": self.epoch}
+
+    @action("ack", {"username": str, "seq": int}, "Username and seq required")
+    def ack(self, request):
+        """Deletes every mailbox entry up to and including seq."""
+        username = request["username"]
+        seq = request["seq"]
+        user = self.users.get(username)
+        if user is None:
+            return {"status": "error", "message": "User not found"}
+        if self.stale_epoch(request):
+            return {"status": "error", "message": "Stale epoch", "epoch": self.epoch}
+        self.acknowledge(user, seq)
+        return {"status": "success", "message": "Acknowledged"}
+
+    def acknowledge(self, user, seq):
+        with user.lock:
+            count = bisect.bisect_right(user.messages, seq, key=lambda entry: entry[0])
+            ticket = 0
+            if count:
+                self.remove_entries(user, count)
+                ticket = self.log({"op": "drain", "username": user.username, "seq": seq})
+        self.wait_logged(ticket)
+
+    def drain(self, user):
+        """Empties a mailbox and returns its messages."""
+        with user.lock:
+            entries = user.messages
+            user.messages = []
+            user.mailbox_bytes = 0
+            ticket = 0
+            if entries:
+                ticket = self.log({"op": "drain", "username": user.username, "seq": entries[-1][0]})
+        self.wait_logged(ticket)
+        return [msg for seq, msg in entries]
 
+    def sweep_loop(self):
+        while self.running:
+            time.sleep(self.sweep_interval)
+            self.expire_messages()
+            self.expire_files()
+            self.expire_uploads()
+
+    def expire_messages(self, now=None):
+        """Removes unacked messages older than message_ttl from every mailbox. Returns how many went."""
+        if not self.message_ttl:
+            return 0
+        cutoff = (now or time.time()) - self.message_ttl
+        expired = 0
+        for user in list(self.users.values()):
+            with user.lock:
+                count = 0
+                # Mailboxes are in delivery order, so expired messages form a prefix.
+                while count < len(user.messages) and user.messages[count][1]["time"] < cutoff:
+                    count += 1
+                if count:
+                    self.log({"op": "drain", "username": user.username, "seq": user.messages[count - 1][0]})
+                    self.remove_entries(user, count)
+                    expired += count
+        if expired:
+            self.metrics.count("mailbox_expired", expired)
+            print(f"Expired {expired} undelivered messages")
+        return expired
+
+    def expire_files(self, now=None):
+        """Releases file references older than message_ttl, like the messages that carried them."""
+        if not self.message_ttl:
+            return 0
+        expired = self.blobs.expire((now or time.time()) - self.message_ttl)
+        if expired:
+            self.metrics.count("files_expired", expired)
+            print(f"Expired {expired} unreleased files")
+        return expired
+
+    def expire_uploads(self, now=None):
+        """Deletes spooled uploads (data and metadata) not written to for upload_ttl. Returns how many went."""
+        if not self.upload_ttl:
+            return 0
+        cutoff = (now or time.time()) - self.upload_ttl
+        upload_ids = set()
+        for name in os.listdir(self.spool_dir):
+            upload_id, suffix = os.path.splitext(name)
+            if suffix in (".json", ".part"):
+                upload_ids.add(upload_id)
+        expired = 0
+        for upload_id in upload_ids:
+            # upload_lock keeps get_upload from loading it meanwhile; its own lock waits out a chunk being written.
+            with self.upload_lock:
+                upload = self.uploads.get(upload_id)
+                lock = upload["lock"] if upload is not None else threading.Lock()
+                with lock:
+                    if self.upload_written(upload_id) >= cutoff:
+                        continue
+                    if upload is not None:
+                        upload["expired"] = True
+                        del self.uploads[upload_id]
+                    for suffix in (".json", ".part"):
+                        try:
+                            os.remove(self.spool_path(upload_id, suffix))
+                        except FileNotFoundError:
+                            pass
+            expired += 1
+        if expired:
+            self.metrics.count("uploads_expired", expired)
+            print(f"Expired {expired} abandoned uploads")
+        return expired
+
+    def upload_written(self, upload_id):
+        """When an upload's spool files were last written (0 if they are gone)."""
+        written = 0
+        for suffix in (".json", ".part"):
+            try:
+                written = max(written, os.path.getmtime(self.spool_path(upload_id, suffix)))
+            except FileNotFoundError:
+                pass
+        return written
+
+    @action("update_status", {"username": str, "status": str}, "Username and status required")
     def update_status(self, request):
-        username = request.get("username")
-        status = request.get("status")
-        if not username or not status:
-            return {"status": "error", "message": "Username and status required"}
-        with self.lock:
-            if username not in self.users:
-                return {"status": "error", "message": "User not found"}
-            self.users[username]["status"] = status
+        username = request["username"]
+        status = request["status"]
+        user = self.users.get(username)
+        if user is None:
+            return {"status": "error", "message": "User not found"}
+        with self.presence_lock:
+            ticket = self.set_status(user, status)
+        self.wait_logged(ticket)
         return {"status": "success", "message": "Status updated"}
 
+    def set_status(self, user, status, restore=None):
+        """
+        Changes and logs a user's status; restore is the status expire_presence put aside.
+        Caller holds presence_lock: status and version change together under it so a reader
+        never hands out a version newer than a status it has not seen yet.
+        """
+        user.status = status
+        user.status_version = self.next_presence_version()
+        user.expired_status = restore
+        record = {"op": "status", "username": user.username, "status": status, "version": user.status_version}
+        if restore is not None:
+            record["restore"] = restore
+        return self.log(record)
+
+    def expire_presence(self, user):
+        """Shows a user with no subscribed connection left as offline, keeping their status for the next subscribe."""
+        with user.lock:
+            if user.subscribers:
+                return
+            with self.presence_lock:
+                if user.status == "offline":
+                    return
+                self.set_status(user, "offline", restore=user.status)
+        self.metrics.count("presence_expired")
+
+    @action("heartbeat")
+    def heartbeat(self, request):
+        """
+        Keeps a quiet connection from being closed as idle (any request does).
+        The reply tells the client how often to send one.
+        """
+        return {"status": "success", "interval": self.heartbeat_interval, "timeout": self.idle_timeout}
+
+    @action("get_buddy_status", {"username": str, "buddy_username": str}, "Username and buddy_username required")
     def get_buddy_status(self, request):
-        username = request.get("username")
-        buddy_username = request.get("buddy_username")
-        if not username or not buddy_username:
-            return {"status": "error", "message": "Username and buddy_username required"}
+        username = request["username"]
+        buddy_username = request["buddy_username"]
+        statuses, version = self.lookup_statuses([buddy_username], -1)
+        if username not in self.users or buddy_username not in statuses:
+            return {"status": "error", "message": "User or buddy not found"}
+        return {"status": "success", "buddy_status": statuses[buddy_username]}
+
+    @action("get_buddy_statuses", {"username": str}, "Username required")
+    def get_buddy_statuses(self, request):
+        """
+        Returns every buddy's status in one reply.
+        With "since" set to a previously returned version, only buddies whose
+        status changed after that version are included.
+        """
+        username = request["username"]
+        since = request.get("since", 0)
+        user = self.users.get(username)
+        if user is None:
+            return {"status": "error", "message": "User not found"}
+        with user.lock:
+            buddy_usernames = list(user.buddies)
+        statuses, version = self.lookup_statuses(buddy_usernames, since)
+        return {"status": "success", "statuses": statuses, "version": version}
+
+    def lookup_statuses(self, usernames, since):
+        """
+        Statuses of the named users that changed after since, asking other shards for theirs.
+        Also returns a version that every later status change on any of those shards will exceed.
+        """
+        by_shard = {}
+        for username in usernames:
+            by_shard.setdefault(self.shard_of(username), []).append(username)
+        by_shard.setdefault(self.shard_index, [])
+        statuses = {}
+        versions = []
+        for shard, names in by_shard.items():
+            if shard == self.shard_index:
+                result = self.local_statuses(names, since)
+            else:
+                result = self.peers[shard].request({"action": "peer_statuses", "usernames": names, "since": since})
+                if result.get("status") != "success":
+                    # Do not advance past changes we could not see.
+                    versions.append(max(since, 0))
+                    continue
+            statuses.update(result["statuses"])
+            versions.append(result["version"])
+        return statuses, min(versions)
+
+    def local_statuses(self, usernames, since):
+        with self.presence_lock:
+            # Any status change after this point gets a larger version (see next_presence_version).
+            version = max(self.presence_version, time.time_ns() // 1000 - 1)
+        statuses = {}
+        for username in usernames:
+            user = self.users.get(username)
+            if user is not None and user.status_version > since:
+                statuses[username] = user.status
+        return {"status": "success", "statuses": statuses, "version": version}
+
+    def shard_of(self, username):
+        if self.shard_count == 1:
+            return 0
+        return zlib.crc32(username.encode("utf-8")) % self.shard_count
+
+    def owner_shard(self, request):
+        """The shard owning the user a request is about, or None if any worker can answer it."""
+        action = request.get("action")
+        if action not in SHARDED_ACTIONS:
+            return None
+        key = request.get(USER_KEY_FIELDS.get(action, "username"))
+        if not isinstance(key, str) or not key:
+            return None
+        return self.shard_of(key)
+
+    def user_exists(self, username):
+        shard = self.shard_of(username)
+        if shard == self.shard_index:
+            return username in self.users
+        return self.peers[shard].request({"action": "peer_user_exists", "username": username}).get("exists", False)
+
+    def deliver_to(self, username, msg):
+        """Delivers to a user on any shard."""
+        shard = self.shard_of(username)
+        if shard != self.shard_index:
+            return self.peers[shard].request({"action": "peer_deliver", "username": username, "message": msg})
+        user = self.users.get(username)
+        if user is None:
+            return {"status": "error", "message": "Recipient does not exist"}
+        return self.deliver(user, msg)
+
+    def next_presence_version(self):
+        """
+        Presence versions are microsecond timestamps, bumped when needed so they never repeat.
+        Callers hold self.presence_lock.
+        """
+        self.presence_version = max(self.presence_version + 1, time.time_ns() // 1000)
+        return self.presence_version
+
+    @action("group_create", {"username": str, "group": str}, "Username and group required")
+    def group_create(self, request):
+        username = request["username"]
+        name = request["group"]
+        if not self.user_exists(username):
+            return {"status": "error", "message": "User not found"}
         with self.lock:
-            if username not in self.users or buddy_username not in self.users:
-                return {"status": "error", "message": "User or buddy not found"}
-            status = self.users[buddy_username].get("status", "offline")
-        return {"status": "success", "status": status}
+            if name in self.groups:
+                return {"status": "error", "message": "Group already exists"}
+            group = GroupRecord(name, username)
+            group.members.add(username)
+            self.groups[name] = group
+            ticket = self.log({"op": "group_create", "group": name, "owner": username})
+        self.wait_logged(ticket)
+        return {"status": "success", "message": "Group created", "group": name}
+
+    @action("group_join", {"username": str, "group": str}, "Username and group required")
+    def group_join(self, request):
+        username = request["username"]
+        group = self.groups.get(request["group"])
+        if group is None:
+            return {"status": "error", "message": "Group not found"}
+        if not self.user_exists(username):
+            return {"status": "error", "message": "User not found"}
+        with group.lock:
+            if self.groups.get(group.name) is not group:
+                # Its last member left while we were looking it up.
+                return {"status": "error", "message": "Group not found"}
+            group.members.add(username)
+            ticket = self.log({"op": "group_join", "group": group.name, "username": username})
+        self.wait_logged(ticket)
+        return {"status": "success", "message": "Joined group", "group": group.name}
+
+    @action("group_leave", {"username": str, "group": str}, "Username and group required")
+    def group_leave(self, request):
+        """Removes a member; the group goes away with its last member."""
+        username = request["username"]
+        group = self.groups.get(request["group"])
+        if group is None:
+            return {"status": "error", "message": "Group not found"}
+        with group.lock:
+            if username not in group.members:
+                return {"status": "error", "message": "Not a member of this group"}
+            group.members.discard(username)
+            empty = not group.members
+            ticket = self.log({"op": "group_leave", "group": group.name, "username": username})
+        if empty:
+            with self.lock:
+                with group.lock:
+                    if not group.members and self.groups.get(group.name) is group:
+                        del self.groups[group.name]
+        self.wait_logged(ticket)
+        return {"status": "success", "message": "Left group"}
+
+    @action("group_post", {"sender": str, "group": str, "message": str}, "Missing fields for posting")
+    def group_post(self, request):
+        """
+        Posts one message to every member but the sender. The message object is
+        built and encoded once and shared by every member's mailbox; members on
+        other shards get one forwarded request per shard.
+        """
+        sender = request["sender"]
+        message_text = request["message"]
+        group = self.groups.get(request["group"])
+        if group is None:
+            return {"status": "error", "message": "Group not found"}
+        with group.lock:
+            if sender not in group.members:
+                return {"status": "error", "message": "Not a member of this group"}
+            members = [member for member in group.members if member != sender]
+        msg = {"from": sender, "group": group.name, "message": message_text, "time": time.time()}
+        self.history.append(("group", group.name), msg)
+        by_shard = {}
+        for member in members:
+            by_shard.setdefault(self.shard_of(member), []).append(member)
+        delivered = 0
+        full = []
+        for shard, usernames in by_shard.items():
+            if shard == self.shard_index:
+                res = self.fan_out(usernames, msg)
+            else:
+                res = self.peers[shard].request({"action": "peer_group_deliver", "usernames": usernames,
+                                                 "message": msg})
+            if res.get("status") != "success":
+                full.extend(usernames)
+                continue
+            delivered += res["delivered"]
+            full.extend(res["full"])
+        return {"status": "success", "message": "Posted", "delivered": delivered, "full": full}
+
+    def fan_out(self, usernames, msg):
+        """
+        Delivers one message to many local mailboxes. The message body goes to the log
+        once; each mailbox logs a small reference to it.
+        """
+        if "time" not in msg:
+            msg = dict(msg, time=time.time())
+        size = message_size(msg)
+        if size > self.mailbox_max_bytes:
+            self.metrics.count("mailbox_rejected", len(usernames))
+            return {"status": "success", "delivered": 0, "full": list(usernames)}
+        body = self.codec.dumps(msg)
+        post_id = uuid.uuid4().hex
+        # The generation comes back with the ticket: read separately, a rotate in between could
+        # pair the post record's old segment with the new generation and orphan the post_refs.
+        ticket, generation = self.log_generation({"op": "post", "id": post_id, "message": msg})
+        delivered = 0
+        full = []
+        for username in usernames:
+            user = self.users.get(username)
+            if user is None:
+                continue
+            with user.lock:
+                seq = self.enqueue(user, msg, size, body)
+                if seq is None:
+                    full.append(username)
+                    continue
+                # Should a snapshot have rotated the log since the post record, write the message in full.
+                ticket = self.log({"op": "post_ref", "username": username, "seq": seq, "id": post_id},
+                                  fallback={"op": "message", "username": username, "seq": seq, "message": msg},
+                                  generation=generation)
+                subscribers = list(user.subscribers)
+            self.push_queued(user, subscribers)
+            delivered += 1
+        self.wait_logged(ticket)
+        return {"status": "success", "delivered": delivered, "full": full}
+
+    @action("group_info", {"group": str}, "Group required")
+    def group_info(self, request):
+        group = self.groups.get(request["group"])
+        if group is None:
+            return {"status": "error", "message": "Group not found"}
+        with group.lock:
+            members = sorted(group.members)
+        return {"status": "success", "group": group.name, "owner": group.owner, "members": members}
+
+    @action("group_list", {"username": str}, "Username required")
+    def group_list(self, request):
+        """Every group the user belongs to, across all shards."""
+        username = request["username"]
+        groups = self.local_groups_of(username)
+        for peer in self.peers:
+            if peer is None:
+                continue
+            res = peer.request({"action": "peer_group_list", "username": username})
+            if res.get("status") != "success":
+                return res
+            groups.extend(res["groups"])
+        return {"status": "success", "groups": sorted(groups)}
+
+    def local_groups_of(self, username):
+        return [group.name for group in list(self.groups.values()) if username in group.members]
+
+    @action("get_history", {"username": str}, "Username and buddy or group required")
+    def get_history(self, request):
+        """
+        Pages backwards through a conversation, given "with" (a buddy) or "group".
+        Returns up to limit messages older than id "before" (default: the newest), oldest first;
+        pass the first id back as "before" for the page above it. With "after" instead, pages
+        forwards from that id, for clients catching up on what they have not seen.
+        """
+        key = self.conversation_key(request)
+        if key is None:
+            return {"status": "error", "message": "Username and buddy or group required"}
+        before = request.get("before")
+        after = request.get("after")
+        limit = request.get("limit", DEFAULT_PAGE_SIZE)
+        if (before is not None and not isinstance(before, int) or after is not None and not isinstance(after, int)
+                or not isinstance(limit, int) or limit < 1):
+            return {"status": "error", "message": "Bad before, after or limit"}
+        limit = min(limit, MAX_PAGE_SIZE)
+        request = dict(request, limit=limit)
+        messages = []
+        more = False
+        for shard in self.history_shards(key):
+            if shard == self.shard_index:
+                res = self.local_history(request)
+            else:
+                res = self.peers[shard].request(dict(request, action="peer_history"))
+            if res.get("status") != "success":
+                return res
+            messages.extend(res["messages"])
+            more = more or res["more"]
+        # A direct conversation is kept on both users' shards: each holds the messages sent to its user.
+        messages.sort(key=lambda message: message["id"])
+        more = more or len(messages) > limit
+        messages = messages[:limit] if after is not None else messages[-limit:]
+        return {"status": "success", "messages": messages, "more": more, "epoch": self.epoch}
+
+    @action("peer_history", peer=True)
+    def local_history(self, request):
+        key = self.conversation_key(request)
+        if key is None:
+            return {"status": "error", "message": "Username and buddy or group required"}
+        if not self.may_read(request["username"], key):
+            return {"status": "error", "message": "Not a member of this group"}
+        records, more = self.history.page(key, request.get("before"), request.get("limit", DEFAULT_PAGE_SIZE),
+                                          request.get("after"))
+        messages = [{"id": record["id"], "from": record["from"], "message": record["message"],
+                     "time": record["time"]} for record in records]
+        return {"status": "success", "messages": messages, "more": more}
+
+    @action("search_messages", {"username": str, "query": str}, "Username and query required")
+    def search_messages(self, request):
+        """
+        Ranked full-text search over the user's conversations, or just the one named by
+        "with" or "group". Every query term must appear; hits come best first, limit at
+        a time from offset, each with its conversation and score.
+        """
+        username = request["username"]
+        terms = list(dict.fromkeys(tokenize(request["query"])))[:MAX_QUERY_TERMS]
+        if not terms:
+            return {"status": "error", "message": "Username and query required"}
+        offset = request.get("offset", 0)
+        limit = request.get("limit", DEFAULT_SEARCH_LIMIT)
+        if not isinstance(offset, int) or not isinstance(limit, int) or offset < 0 or limit < 1:
+            return {"status": "error", "message": "Bad offset or limit"}
+        depth = min(offset + limit, MAX_SEARCH_RESULTS)
+        sub_request = {"username": username, "terms": terms, "depth": depth}
+        key = None
+        if request.get("with") or request.get("group"):
+            key = self.conversation_key(request)
+            if key is None:
+                return {"status": "error", "message": "Bad buddy or group"}
+            if key[0] == "group":
+                sub_request["group"] = key[1]
+            else:
+                sub_request["with"] = request["with"]
+        hits = []
+        total = 0
+        for shard in self.history_shards(key):
+            if shard == self.shard_index:
+                res = self.local_search(sub_request)
+            else:
+                res = self.peers[shard].request(dict(sub_request, action="peer_search"))
+            if res.get("status") != "success":
+                return res
+            hits.extend(res["hits"])
+            total += res["total"]
+        hits.sort(key=lambda hit: (hit["score"], hit["id"]), reverse=True)
+        return {"status": "success", "hits": hits[offset:depth], "total": total, "more": depth < total}
+
+    @action("peer_search", peer=True)
+    def local_search(self, request):
+        """The best "depth" hits for "terms" among the conversations on this shard the user may read."""
+        username = request.get("username")
+        terms = request.get("terms")
+        depth = request.get("depth", DEFAULT_SEARCH_LIMIT)
+        if not isinstance(username, str) or not isinstance(terms, list) or not isinstance(depth, int):
+            return {"status": "error", "message": "Bad search"}
+        key = self.conversation_key(request)
+        if key is not None:
+            if not self.may_read(username, key):
+                return {"status": "error", "message": "Not a member of this group"}
+            keys = [key]
+            convs = set()
+        else:
+            keys = [("group", name) for name in self.local_groups_of(username)]
+            convs = set(self.history.user_convs.get(username, ()))
+        for key in keys:
+            conv = self.history.conversations.get(key)
+            if conv is not None:
+                convs.add(conv)
+        best, total = self.history.search(terms, convs, depth)
+        records = self.history.read([position for score, history_id, position in best])
+        hits = []
+        for (score, history_id, position), record in zip(best, records):
+            key = tuple(record["conv"])
+            hit = {"id": history_id, "from": record["from"], "message": record["message"],
+                   "time": record["time"], "score": round(score, 4)}
+            if key[0] == "group":
+                hit["group"] = key[1]
+            else:
+                hit["with"] = key[2] if key[1] == username else key[1]
+            hits.append(hit)
+        return {"status": "success", "hits": hits, "total": total}
+
+    def conversation_key(self, request):
+        """The history key of the conversation a request names with "with" or "group", or None."""
+        username = request.get("username")
+        if not isinstance(username, str) or not username:
+            return None
+        group = request.get("group")
+        if isinstance(group, str) and group:
+            return ("group", group)
+        buddy = request.get("with")
+        if isinstance(buddy, str) and buddy:
+            return ("dm",) + tuple(sorted((username, buddy)))
+        return None
+
+    def history_shards(self, key):
+        """Shards holding messages of conversation key (all of them for None), this one first."""
+        if key is None:
+            shards = range(self.shard_count)
+        elif key[0] == "group":
+            shards = [self.shard_of(key[1])]
+        else:
+            shards = [self.shard_of(key[1]), self.shard_of(key[2])]
+        return sorted(set(shards), key=lambda shard: shard != self.shard_index)
+
+    def may_read(self, username, key):
+        """Direct conversations are readable by both users, groups by their current members."""
+        if key[0] == "dm":
+            return username in key[1:]
+        group = self.groups.get(key[1])
+        if group is None:
+            # Deleted with its last member; nobody can read it.
+            return False
+        with group.lock:
+            return username in group.members
+
+    @action("subscribe", {"username": str}, "Username required", conn=True)
+    def subscribe(self, request, conn):
+        """
+        Registers the calling connection for pushed messages.
+        The reply carries the first page of messages after "since" that are already
+        waiting; later pages come from get_messages. Nothing is deleted until acked.
+        """
+        username = request["username"]
+        if conn is None:
+            return {"status": "error", "message": "Subscribe needs a persistent connection"}
+        user = self.users.get(username)
+        if user is None:
+            return {"status": "error", "message": "User not found"}
+        if conn.username is not None and conn.username != username:
+            self.unsubscribe(conn)
+            self.close_relay(conn)
+        since = request.get("since", 0)
+        with user.lock:
+            conn.username = username
+            user.subscribers.add(conn)
+            if user.expired_status is not None:
+                with self.presence_lock:
+                    self.set_status(user, user.expired_status)
+            if self.stale_epoch(request) or isinstance(since, int) and since >= user.next_seq:
+                # The client remembers a mailbox from before this one was reset: start it over.
+                return dict(self.read_mailbox(user, 0, request.get("limit", DEFAULT_PAGE_SIZE)), reset=True)
+            return self.read_mailbox(user, since, request.get("limit", DEFAULT_PAGE_SIZE))
+
+    def subscribe_remote(self, request, conn, owner):
+        """
+        Subscribes a connection handed to this worker for a user another worker owns.
+        A link of its own to the owner subscribes there, and a thread passes the pushes
+        that arrive on it back to the client; closing either side ends both.
+        """
+        if conn is None:
+            return {"status": "error", "message": "Subscribe needs a persistent connection"}
+        self.unsubscribe(conn)
+        self.close_relay(conn)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        reader = FrameReader(sock)
+        try:
+            sock.settimeout(PEER_TIMEOUT)
+            sock.connect(self.peers[owner].path)
+            send_buffers(sock, frame_buffers(self.codec.dumps(request), "line"))
+            while True:
+                line = reader.read_line()
+                if line is None:
+                    raise ConnectionError("Peer closed the connection")
+                reply = self.codec.loads(line)
+                if "push" not in reply:
+                    break
+                # Pushes racing with the reply: the client holds them back until its backlog is paged in.
+                conn.send_frame(line)
+            sock.settimeout(None)
+        except (OSError, ConnectionError, ValueError) as e:
+            sock.close()
+            return {"status": "error", "message": "Shard unavailable: {}".format(e)}
+        if reply.get("status") != "success":
+            sock.close()
+            return reply
+        conn.username = request["username"]
+        conn.relay = sock
+        threading.Thread(target=self.relay_pushes, args=(sock, reader, conn), daemon=True).start()
+        return reply
+
+    def relay_pushes(self, sock, reader, conn):
+        try:
+            while True:
+                line = reader.read_line()
+                if line is None:
+                    break
+                conn.send_frame(line)
+        except (OSError, ConnectionError):
+            pass
+        finally:
+            sock.close()
+            if conn.relay is sock:
+                # The owner went away: drop the client too, so it reconnects and subscribes again.
+                conn.shutdown()
+
+    def close_relay(self, conn):
+        relay, conn.relay = conn.relay, None
+        if relay is not None:
+            try:
+                relay.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @action("batch", {"requests": list}, "Requests list required", conn=True)
+    def batch(self, request, conn):
+        """
+        Runs a list of sub-requests in order and returns their replies in the same order.
+        A run of consecutive sub-requests for the same user takes that user's lock once
+        (only for BATCH_LOCKED_ACTIONS),
+        and the whole batch waits for a single group commit instead of one per mutation.
+        """
+        requests = request["requests"]
+        if len(requests) > MAX_BATCH_SIZE:
+            return {"status": "error", "message": "Too many requests in batch"}
+        if getattr(self.batch_state, "tickets", None) is not None:
+            return {"status": "error", "message": "Batches cannot be nested"}
+        self.batch_state.tickets = []
+        results = []
+        try:
+            index = 0
+            while index < len(requests):
+                user = self.lock_owner(requests[index])
+                end = index + 1
+                while end < len(requests) and user is not None and self.lock_owner(requests[end]) is user:
+                    end += 1
+                if user is None:
+                    results.append(self.run_sub_request(requests[index], conn))
+                else:
+                    with user.lock:
+                        for sub_request in requests[index:end]:
+                            results.append(self.run_sub_request(sub_request, conn))
+                index = end
+        finally:
+            tickets = self.batch_state.tickets
+            self.batch_state.tickets = None
+        self.wait_logged(max(tickets, default=0))
+        return {"status": "success", "results": results}
+
+    def run_sub_request(self, sub_request, conn):
+        if not isinstance(sub_request, dict):
+            return {"status": "error", "message": "Sub-request must be an object"}
+        if sub_request.get("action") == "batch":
+            return {"status": "error", "message": "Batches cannot be nested"}
+        try:
+            return self.process_request(sub_request, conn)
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+
+    def lock_owner(self, sub_request):
+        """The existing user whose lock a batch may hold across a sub-request, or None."""
+        if not isinstance(sub_request, dict) or sub_request.get("action") not in BATCH_LOCKED_ACTIONS:
+            return None
+        field = USER_KEY_FIELDS.get(sub_request["action"], "username")
+        key = sub_request.get(field)
+        if not isinstance(key, str):
+            return None
+        return self.users.get(key)
+
+    @action("negotiate", conn=True)
+    def negotiate(self, request, conn):
+        """
+        Switches a connection to length-prefixed binary frames, and to compressing
+        large ones if asked for. Only allowed before anything else has been sent,
+        so both sides switch at a known point.
+        """
+        if conn is None:
+            return {"status": "error", "message": "Negotiate needs a persistent connection"}
+        reply = negotiate_reply(request)
+        if reply["status"] != "success":
+            return reply
+        if conn.framing != "line":
+            return {"status": "error", "message": "Framing already negotiated"}
+        if conn.username is not None:
+            # Pushes could otherwise arrive in the new framing before this reply.
+            return {"status": "error", "message": "Negotiate must come before subscribe"}
+        conn.framing = reply["framing"]
+        if reply["compression"] == "deflate":
+            conn.compress_threshold = self.compression_threshold
+        return reply
+
+    def unsubscribe(self, conn):
+        user = self.users.get(conn.username)
+        if user is not None:
+            with user.lock:
+                user.subscribers.discard(conn)
+
+    def new_user(self, username, password):
+        return UserRecord(username, password, TimedLock(threading.RLock(), "user", self.metrics))
+
+    def is_admin(self, request):
+        """Admin actions are refused outright unless an admin token was configured."""
+        token = request.get("token")
+        if self.admin_token is None or not isinstance(token, str):
+            return False
+        return hmac.compare_digest(token.encode("utf-8"), self.admin_token.encode("utf-8"))
+
+    @action("stats")
+    def stats(self, request):
+        """
+        Admin: request counts and latency percentiles per action, lock waits,
+        connections, mailbox depths and bytes in/out for this process.
+        In cluster mode "shard" picks which worker answers.
+        """
+        if not self.is_admin(request):
+            return {"status": "error", "message": "Not authorized"}
+        shard = request.get("shard")
+        if shard is not None and shard != self.shard_index:
+            if not isinstance(shard, int) or not 0 <= shard < self.shard_count:
+                return {"status": "error", "message": "No such shard"}
+            return self.peers[shard].request(request)
+        counters, histograms = self.metrics.copy()
+        requests = {}
+        for (name, action), histogram in histograms.items():
+            if name == "request_seconds":
+                requests[action] = dict(histogram.summary(), errors=counters.get(("request_errors", action), 0))
+        locks = {}
+        for name, (acquires, contended) in self.lock_counts().items():
+            wait = histograms.get(("lock_wait_seconds", name), Histogram())
+            locks[name] = {"acquires": acquires, "contended": contended}
+            locks[name].update(("wait_" + key, value) for key, value in wait.summary().items() if key != "count")
+        return {"status": "success", "shard": self.shard_index,
+                "uptime": round(time.time() - self.metrics.started, 1),
+                "requests": requests, "locks": locks, "mailboxes": self.mailbox_stats(),
+                "connections": self.connection_count,
+                "bytes_in": counters.get(("bytes_in", ""), 0),
+                "bytes_out": counters.get(("bytes_out", ""), 0),
+                "pushes": counters.get(("pushes", ""), 0),
+                "throttled": counters.get(("throttled", ""), 0),
+                "oversized_requests": counters.get(("oversized_requests", ""), 0),
+                "slow_consumers": counters.get(("slow_consumers", ""), 0),
+                "idle_closed": counters.get(("idle_closed", ""), 0),
+                "presence_expired": counters.get(("presence_expired", ""), 0),
+                "idle_watched": len(self.idle_wheel) if self.idle_wheel is not None else 0,
+                "history": self.history.stats(),
+                "codec": self.codec.name,
+                "files": self.blobs.stats(),
+                "capture": self.recorder.stats() if self.recorder is not None else None,
+                "profiler": {"running": self.profiler.running, "samples": self.profiler.samples}}
+
+    def lock_counts(self):
+        """lock name -> (acquires, contended); every user's lock is summed under "user"."""
+        counts = {name: (lock.acquires, lock.contended)
+                  for name, lock in (("registry", self.lock), ("presence", self.presence_lock))}
+        acquires = contended = 0
+        for user in list(self.users.values()):
+            acquires += user.lock.acquires
+            contended += user.lock.contended
+        counts["user"] = (acquires, contended)
+        return counts
+
+    def mailbox_stats(self, top=5):
+        """Mailbox totals for the process, plus the users holding the most messages and the most bytes."""
+        users = list(self.users.values())
+        depths = [(len(user.messages), user.username) for user in users]
+        sizes = [(user.mailbox_bytes, user.username) for user in users]
+        counters, histograms = self.metrics.copy()
+        return {"users": len(depths), "messages": sum(depth for depth, username in depths),
+                "bytes": sum(size for size, username in sizes),
+                "deepest": [[username, depth] for depth, username in heapq.nlargest(top, depths)],
+                "largest": [[username, size] for size, username in heapq.nlargest(top, sizes)],
+                "rejected": counters.get(("mailbox_rejected", ""), 0),
+                "evicted": counters.get(("mailbox_evicted", ""), 0),
+                "expired": counters.get(("mailbox_expired", ""), 0)}
+
+    @action("profile")
+    def profile(self, request):
+        """
+        Admin: {"enable": true, "interval_ms": 5} starts the sampling profiler,
+        {"enable": false} stops it; every call returns the hottest folded stacks so far.
+        "reset": true clears collected samples first.
+        """
+        if not self.is_admin(request):
+            return {"status": "error", "message": "Not authorized"}
+        if request.get("reset"):
+            self.profiler.reset()
+        enable = request.get("enable")
+        if enable is True:
+            interval = request.get("interval_ms", 5)
+            if not isinstance(interval, (int, float)) or isinstance(interval, bool) or interval <= 0:
+                return {"status": "error", "message": "Bad interval_ms"}
+            self.profiler.start(max(interval, MIN_PROFILE_INTERVAL_MS) / 1000.0)
+        elif enable is False:
+            self.profiler.stop()
+        limit = request.get("limit", 50)
+        if not isinstance(limit, int) or limit <= 0:
+            limit = 50
+        return {"status": "success", "running": self.profiler.running, "samples": self.profiler.samples,
+                "stacks": self.profiler.top(limit)}
+
+    def metrics_text(self):
+        """The metrics in the Prometheus plain-text exposition format."""
+        counters, histograms = self.metrics.copy()
+        lines = []
+
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def histogram_lines(metric, label_name, name):
+            lines.append("# TYPE {} histogram".format(metric))
+            for (key, label), histogram in sorted(histograms.items()):
+                if key != name:
+                    continue
+                label = escape(label)
+                cumulative = 0
+                for index, count in enumerate(histogram.counts):
+                    cumulative += count
+                    bound = repr(LATENCY_BUCKETS[index]) if index < len(LATENCY_BUCKETS) else "+Inf"
+                    lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(metric, label_name, label, bound, cumulative))
+                lines.append('{}_sum{{{}="{}"}} {}'.format(metric, label_name, label, histogram.sum))
+                lines.append('{}_count{{{}="{}"}} {}'.format(metric, label_name, label, histogram.total))
+
+        histogram_lines("legacychat_request_seconds", "action", "request_seconds")
+        lines.append("# TYPE legacychat_request_errors_total counter")
+        for (name, label), value in sorted(counters.items()):
+            if name == "request_errors":
+                lines.append('legacychat_request_errors_total{{action="{}"}} {}'.format(escape(label), value))
+        histogram_lines("legacychat_lock_wait_seconds", "lock", "lock_wait_seconds")
+        lines.append("# TYPE legacychat_lock_acquires_total counter")
+        lines.append("# TYPE legacychat_lock_contended_total counter")
+        for name, (acquires, contended) in sorted(self.lock_counts().items()):
+            lines.append('legacychat_lock_acquires_total{{lock="{}"}} {}'.format(name, acquires))
+            lines.append('legacychat_lock_contended_total{{lock="{}"}} {}'.format(name, contended))
+        for name in ("bytes_in", "bytes_out", "pushes", "mailbox_rejected", "mailbox_evicted", "mailbox_expired",
+                     "throttled", "oversized_requests", "slow_consumers"):
+            lines.append("# TYPE legacychat_{}_total counter".format(name))
+            lines.append("legacychat_{}_total {}".format(name, counters.get((name, ""), 0)))
+        mailboxes = self.mailbox_stats(top=1)
+        gauges = (("connections", self.connection_count), ("users", mailboxes["users"]),
+                  ("mailbox_messages", mailboxes["messages"]), ("mailbox_bytes", mailboxes["bytes"]),
+                  ("mailbox_max_depth", mailboxes["deepest"][0][1] if mailboxes["deepest"] else 0))
+        for name, value in gauges:
+            lines.append("# TYPE legacychat_{} gauge".format(name))
+            lines.append("legacychat_{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def start_metrics_endpoint(self):
+        """Serves GET /metrics and GET /profile as plain text on 127.0.0.1:metrics_port."""
+        if not self.metrics_port:
+            return
+        httpd = http.server.ThreadingHTTPServer(("127.0.0.1", self.metrics_port), MetricsHandler)
+        httpd.daemon_threads = True
+        httpd.chat_server = self
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        print("Metrics on http://127.0.0.1:{}/metrics".format(self.metrics_port))
+
+    def log(self, record, fallback=None, generation=None):
+        """
+        Appends a mutation to the write-ahead log, if persistence is on.
+        Called under the lock that ordered the mutation; returns a ticket for wait_logged.
+        """
+        return self.log_generation(record, fallback, generation)[0]
+
+    def log_generation(self, record, fallback=None, generation=None):
+        """Like log, but returns (ticket, generation of the segment the record went into)."""
+        if self.storage is None:
+            return 0, None
+        ticket, generation = self.storage.append(record, fallback, generation)
+        if self.storage.needs_snapshot():
+            threading.Thread(target=self.snapshot, daemon=True).start()
+        return ticket, generation
+
+    def wait_logged(self, ticket):
+        """Blocks until the record is fsynced. Call after releasing locks so others can join the batch."""
+        if not ticket:
+            return
+        tickets = getattr(self.batch_state, "tickets", None)
+        if tickets is not None:
+            # Inside a batch: wait once for the last record when the batch ends.
+            tickets.append(ticket)
+            return
+        deferred = getattr(self.batch_state, "deferred", None)
+        if deferred is not None:
+            # On the event loop: handle_payload_async holds the reply back instead.
+            deferred.append(ticket)
+            return
+        self.storage.wait(ticket)
+
+    def snapshot(self):
+        """Writes a full snapshot so startup only replays the log written after it."""
+        segment = self.storage.rotate()
+        users = {}
+        # seen: id of a message object -> how many mailboxes hold it; group posts share one object
+        seen = {}
+        for username, user in list(self.users.items()):
+            status_version = user.status_version
+            with user.lock:
+                buddies = dict(user.buddies)
+                entries = list(user.messages)
+                next_seq = user.next_seq
+            for seq, msg in entries:
+                seen[id(msg)] = seen.get(id(msg), 0) + 1
+            users[username] = {"password": user.password, "buddies": buddies,
+                               "messages": entries, "next_seq": next_seq,
+                               "status": user.status, "status_version": status_version,
+                               "expired_status": user.expired_status}
+        # A message in several mailboxes is written once under "posts"; the mailboxes hold its key.
+        posts = {}
+        keys = {}
+        for data in users.values():
+            messages = []
+            for seq, msg in data["messages"]:
+                if seen[id(msg)] > 1:
+                    key = keys.get(id(msg))
+                    if key is None:
+                        key = keys[id(msg)] = str(len(posts))
+                        posts[key] = msg
+                    messages.append([seq, key])
+                else:
+                    messages.append([seq, msg])
+            data["messages"] = messages
+        groups = {}
+        for name, group in list(self.groups.items()):
+            with group.lock:
+                groups[name] = {"owner": group.owner, "members": sorted(group.members)}
+        self.storage.write_snapshot(segment, users, groups, self.epoch, posts)
+        print(f"Snapshot written ({len(users)} users)")
+
+    def restore(self):
+        """Loads the latest snapshot and replays the log written after it."""
+        snapshot, records = self.storage.load()
+        if snapshot is not None:
+            self.epoch = snapshot.get("epoch")
+            posts = snapshot.get("posts", {})
+            for username, data in snapshot["users"].items():
+                user = self.new_user(username, data["password"])
+                user.buddies = data["buddies"]
+                # A string in place of the message is the key of a post shared with other mailboxes.
+                user.messages = [(seq, posts[msg] if isinstance(msg, str) else msg) for seq, msg in data["messages"]]
+                user.mailbox_bytes = sum(message_size(msg) for seq, msg in user.messages)
+                user.next_seq = data["next_seq"]
+                user.status = data["status"]
+                user.status_version = data["status_version"]
+                user.expired_status = data.get("expired_status")
+                self.users[username] = user
+            for name, data in snapshot.get("groups", {}).items():
+                group = GroupRecord(name, data["owner"])
+                group.members.update(data["members"])
+                self.groups[name] = group
+        # replay_posts: post id -> message, so replayed group posts share one object again
+        self.replay_posts = {}
+        replayed = 0
+        for record in records:
+            self.apply(record)
+            replayed += 1
+        del self.replay_posts
+        now = time.time()
+        for user in self.users.values():
+            self.presence_version = max(self.presence_version, user.status_version)
+            stamp_untimed(user.messages, now)
+        print(f"Restored {len(self.users)} users ({replayed} log records replayed)")
+
+    def apply(self, record):
+        """Replays one log record. Every op is idempotent so snapshot/log overlap is harmless."""
+        op = record["op"]
+        if op == "signup":
+            if record["username"] not in self.users:
+                user = self.new_user(record["username"], record["password"])
+                user.status_version = record["version"]
+                self.users[record["username"]] = user
+            return
+        if op == "post":
+            self.replay_posts[record["id"]] = record["message"]
+            return
+        if op == "epoch":
+            self.epoch = record["epoch"]
+            return
+        if op.startswith("group_"):
+            self.apply_group(record)
+            return
+        user = self.users.get(record["username"])
+        if user is None:
+            return
+        if op == "post_ref":
+            msg = self.replay_posts.get(record["id"])
+            if msg is None:
+                # The post record should always precede its refs in the same segment.
+                print("Dropping post_ref with no post record: {} seq {} post {}".format(
+                    record["username"], record["seq"], record["id"]))
+                return
+            op = "message"
+            record = dict(record, message=msg)
+        if op == "add_buddy":
+            user.buddies[record["buddy_username"]] = record["buddy_name"]
+        elif op == "message":
+            if record["seq"] >= user.next_seq:
+                user.messages.append((record["seq"], record["message"]))
+                user.mailbox_bytes += message_size(record["message"])
+                user.next_seq = record["seq"] + 1
+        elif op == "drain":
+            count = bisect.bisect_right(user.messages, record["seq"], key=lambda entry: entry[0])
+            self.remove_entries(user, count)
+        elif op == "status":
+            if record["version"] >= user.status_version:
+                user.status = record["status"]
+                user.status_version = record["version"]
+                user.expired_status = record.get("restore")
+
+    def apply_group(self, record):
+        op = record["op"]
+        name = record["group"]
+        if op == "group_create":
+            if name not in self.groups:
+                group = GroupRecord(name, record["owner"])
+                group.members.add(record["owner"])
+                self.groups[name] = group
+            return
+        group = self.groups.get(name)
+        if group is None:
+            return
+        if op == "group_join":
+            group.members.add(record["username"])
+        elif op == "group_leave":
+            group.members.discard(record["username"])
+            if not group.members:
+                del self.groups[name]
+
+def run_cluster_worker(index, count, handoff_sock, peer_paths, data_dir, files_root,
+                       metrics_port=None, admin_token=None, capture_path=None, epoch=None):
+    shard_dir = os.path.join(data_dir, "shard-{}".format(index)) if data_dir else None
+    # Each worker records its own connections to capture_path.<shard index>; replay merges them.
+    # Each worker scrapes on its own port: metrics_port + shard index.
+    server = LegacyChatServer("", 0, data_dir=shard_dir, shard_index=index, shard_count=count,
+                              peer_paths=peer_paths, files_root=files_root,
+                              metrics_port=metrics_port + index if metrics_port else None,
+                              admin_token=admin_token,
+                              capture_path="{}.{}".format(capture_path, index) if capture_path else None,
+                              epoch=epoch)
+    stop_on_sigterm()
+    server.serve_worker(handoff_sock, peer_paths[index])
+
+class ClusterServer:
+    """
+    Runs one LegacyChatServer worker process per shard; each owns the users whose
+    username hashes to it. The master accepts connections, reads the first request
+    to learn whose connection it is, and hands the socket to that user's worker.
+    Workers forward requests about users on other shards over local unix sockets,
+    and relay pushes for a user subscribed through a connection another worker holds.
+    Workers report each handed-off connection that closes, so the master can hold
+    the whole cluster to max_connections.
+    """
+    def __init__(self, host, port, workers, backlog=1024, max_connections=20000, data_dir=None, metrics_port=None,
+                 admin_token=None, capture_path=None):
+        self.server_address = (host, port)
+        self.workers = workers
+        self.max_connections = max_connections
+        self.connection_count = 0
+        self.connection_lock = threading.Lock()
+        self.metrics_port = metrics_port
+        self.admin_token = admin_token
+        self.capture_path = capture_path
+        self.backlog = backlog
+        self.data_dir = data_dir
+        self.handoffs = []
+        self.handoff_locks = []
+        self.processes = []
+
+    def start(self):
+        self.check_shard_count()
+        print("Starting LegacyChat Server (cluster, {} workers) on {}:{}".format(self.workers, *self.server_address))
+        runtime = tempfile.TemporaryDirectory(prefix="legacychat-cluster-")
+        runtime_dir = runtime.name
+        files_root = self.data_dir or runtime_dir
+        peer_paths = [os.path.join(runtime_dir, "shard-{}.sock".format(i)) for i in range(self.workers)]
+        epoch = self.load_epoch()
+        context = multiprocessing.get_context("fork")
+        for index in range(self.workers):
+            parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            process = context.Process(target=run_cluster_worker, daemon=True,
+                                      args=(index, self.workers, child_end, peer_paths, self.data_dir, files_root,
+                                            self.metrics_port, self.admin_token, self.capture_path, epoch))
+            process.start()
+            child_end.close()
+            self.handoffs.append(parent_end)
+            self.handoff_locks.append(threading.Lock())
+            self.processes.append(process)
+            threading.Thread(target=self.count_closed, args=(parent_end,), daemon=True).start()
+        deadline = time.monotonic() + 30
+        while not all(os.path.exists(path) for path in peer_paths) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind(self.server_address)
+        server_socket.listen(self.backlog)
+        stop_on_sigterm()
+        try:
+            while True:
+                client_socket, client_address = server_socket.accept()
+                with self.connection_lock:
+                    if self.connection_count >= self.max_connections:
+                        client_socket.close()
+                        continue
+                    self.connection_count += 1
+                print("Connection from", client_address)
+                threading.Thread(target=self.route_connection, args=(client_socket,), daemon=True).start()
+        except KeyboardInterrupt:
+            print("Server is shutting down.")
+        finally:
+            server_socket.close()
+            # Workers shut down on SIGTERM as on Ctrl+C, flushing their storage first.
+            for process in self.processes:
+                process.terminate()
+            for process in self.processes:
+                process.join(timeout=5)
+            runtime.cleanup()
+
+    def count_closed(self, handoff):
+        """Takes one connection off the count for every close a worker reports."""
+        while True:
+            try:
+                data = handoff.recv(4096)
+            except OSError:
+                return
+            if not data:
+                return
+            with self.connection_lock:
+                self.connection_count -= len(data)
+
+    def check_shard_count(self):
+        """
+        Users live on shard crc32(username) % workers, so a data_dir must always be served by
+        the same number of workers: kept in data_dir/shards, it refuses to start with another.
+        """
+        if not self.data_dir:
+            return
+        saved = self.read_setting("shards")
+        if saved is None:
+            # A data_dir from before the count was kept has one directory per shard.
+            existing = [name for name in os.listdir(self.data_dir)
+                        if name.startswith("shard-")] if os.path.isdir(self.data_dir) else []
+            saved = len(existing) or self.workers
+            self.write_setting("shards", str(saved))
+        if int(saved) != self.workers:
+            raise ValueError("{0} holds {1} shards; start the cluster with {1} workers".format(self.data_dir, saved))
+
+    def load_epoch(self):
+        """
+        The epoch every worker reports, so replies from any shard agree: kept in data_dir/epoch
+        when data persists, new on every start otherwise.
+        """
+        if not self.data_dir:
+            return uuid.uuid4().hex
+        epoch = self.read_setting("epoch")
+        if epoch is None:
+            epoch = uuid.uuid4().hex
+            self.write_setting("epoch", epoch)
+        return epoch
+
+    def read_setting(self, name):
+        """The contents of data_dir/name, or None if it was never written."""
+        try:
+            with open(os.path.join(self.data_dir, name), "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def write_setting(self, name, value):
+        """Atomically writes value to data_dir/name."""
+        path = os.path.join(self.data_dir, name)
+        os.makedirs(self.data_dir, exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(value)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def route_connection(self, client_socket):
+        """Reads the first request (after an optional negotiate) and hands the socket to its shard."""
+        handed_off = False
+        try:
+            client_socket.settimeout(30)
+            reader = FrameReader(client_socket, max_size=MAX_FRAME_SIZE)
+            framing = "line"
+            compression = None
+            payload = reader.read_line()
+            if payload is None:
+                client_socket.close()
+                return
+            request = json.loads(payload)
+            if isinstance(request, dict) and request.get("action") == "negotiate":
+                reply = negotiate_reply(request)
+                if "id" in request:
+                    reply["id"] = request["id"]
+                send_buffers(client_socket, frame_buffers(json.dumps(reply).encode("utf-8"), "line"))
+                if reply["status"] == "success":
+                    framing = reply["framing"]
+                    compression = reply["compression"]
+                payload = reader.read_frame() if framing == "binary" else reader.read_line()
+                if payload is None:
+                    client_socket.close()
+                    return
+                request = json.loads(payload)
+            key = None
+            if isinstance(request, dict) and request.get("action") == "batch":
+                # The GUI logs in and subscribes with a batch: route on the first sub-request naming a user.
+                for sub_request in request.get("requests") or ():
+                    if isinstance(sub_request, dict) and (sub_request.get("username") or sub_request.get("sender")):
+                        request = sub_request
+                        break
+            if isinstance(request, dict):
+                key = request.get("username") or request.get("sender")
+            # A connection that names no user yet (a heartbeat, say) goes to shard 0, which relays
+            # a later subscribe for another shard's user (see subscribe_remote).
+            shard = zlib.crc32(key.encode("utf-8")) % self.workers if isinstance(key, str) else 0
+            initial = b"".join(frame_buffers(payload, framing)) + bytes(reader.buffer[reader.start:reader.end])
+            client_socket.settimeout(None)
+            with self.handoff_locks[shard]:
+                send_handoff(self.handoffs[shard], client_socket.fileno(), framing, compression, initial)
+            handed_off = True
+        except (OSError, ValueError) as ex:
+            print("Error routing client:", ex)
+        finally:
+            client_socket.close()
+            if not handed_off:
+                with self.connection_lock:
+                    self.connection_count -= 1
 
 if __name__ == "__main__":
     host = input("Enter server IP (e.g., 0.0.0.0): ").strip() or "0.0.0.0"
     port_input = input("Enter server port (e.g., 12345): ").strip()
     port = int(port_input) if port_input else 12345
-    server = LegacyChatServer(host, port)
-    server.start()
+    mode = input("Enter server mode (threaded/async/cluster) [threaded]: ").strip() or "threaded"
+    data_dir = input("Enter data directory (blank keeps everything in memory): ").strip() or None
+    metrics_input = input("Enter metrics port for local scraping (blank for none): ").strip()
+    metrics_port = int(metrics_input) if metrics_input else None
+    admin_token = input("Enter admin token for stats/profile (blank disables them): ").strip() or None
+    capture_path = input("Enter file to capture traffic to for replay (blank for none): ").strip() or None
+    if mode == "cluster":
+        workers_input = input("Enter number of worker processes [{}]: ".format(os.cpu_count())).strip()
+        server = ClusterServer(host, port, int(workers_input) if workers_input else os.cpu_count(), data_dir=data_dir,
+                               metrics_port=metrics_port, admin_token=admin_token, capture_path=capture_path)
+        server.start()
+    else:
+        server = LegacyChatServer(host, port, data_dir=data_dir, metrics_port=metrics_port, admin_token=admin_token,
+                                  capture_path=capture_path)
+        server.start(mode)
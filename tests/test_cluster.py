@@ -0,0 +1,118 @@
+"""Cluster mode: requests and pushes for users on another shard."""
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import zlib
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+pytestmark = pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(),
+                                reason="cluster mode forks its workers")
+
+def user_on_shard(shard, workers=2):
+    for i in range(1000):
+        name = "user{}".format(i)
+        if zlib.crc32(name.encode("utf-8")) % workers == shard:
+            return name
+
+class Client:
+    def __init__(self, port):
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+        self.reader = self.sock.makefile("rb")
+        self.pushes = []
+
+    def request(self, request):
+        self.sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        while True:
+            reply = json.loads(self.reader.readline())
+            if "push" not in reply:
+                return reply
+            self.pushes.append(reply)
+
+    def next_push(self):
+        if self.pushes:
+            return self.pushes.pop(0)
+        return json.loads(self.reader.readline())
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+@pytest.fixture
+def cluster(tmp_path):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    code = "import serveropensource as s; s.ClusterServer('127.0.0.1', {}, 2, data_dir={!r}).start()".format(
+        port, str(tmp_path))
+    process = subprocess.Popen([sys.executable, "-c", code], cwd=ROOT, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.1)
+    yield port
+    process.send_signal(signal.SIGINT)
+    process.wait(timeout=30)
+
+def test_messages_cross_shards(cluster):
+    alice, bob = user_on_shard(0), user_on_shard(1)
+    alice_conn, bob_conn = Client(cluster), Client(cluster)
+    try:
+        assert alice_conn.request({"action": "signup", "username": alice, "password": "pw"})["status"] == "success"
+        assert bob_conn.request({"action": "signup", "username": bob, "password": "pw"})["status"] == "success"
+        sent = alice_conn.request({"action": "send_message", "sender": alice, "recipient": bob, "message": "hi"})
+        assert sent["status"] == "success"
+        # Asked on alice's shard, the request is forwarded to bob's.
+        reply = alice_conn.request({"action": "get_messages", "username": bob, "since": 0})
+        assert [msg["message"] for msg in reply["messages"]] == ["hi"]
+    finally:
+        alice_conn.close()
+        bob_conn.close()
+
+def test_subscribe_through_another_shard_relays_pushes(cluster):
+    alice, bob = user_on_shard(0), user_on_shard(1)
+    setup = Client(cluster)
+    relayed = Client(cluster)
+    try:
+        setup.request({"action": "signup", "username": alice, "password": "pw"})
+        setup.request({"action": "signup", "username": bob, "password": "pw"})
+        # Logging in as alice lands the connection on alice's shard, not bob's.
+        assert relayed.request({"action": "login", "username": alice, "password": "pw"})["status"] == "success"
+        assert relayed.request({"action": "subscribe", "username": bob})["status"] == "success"
+        setup.request({"action": "send_message", "sender": alice, "recipient": bob, "message": "pushed"})
+        assert relayed.next_push()["message"]["message"] == "pushed"
+    finally:
+        setup.close()
+        relayed.close()
+
+def test_batches_are_routed_by_their_first_user(cluster):
+    bob = user_on_shard(1)
+    conn = Client(cluster)
+    try:
+        reply = conn.request({"action": "batch", "requests": [
+            {"action": "signup", "username": bob, "password": "pw"},
+            {"action": "login", "username": bob, "password": "pw"},
+        ]})
+        assert [result["status"] for result in reply["results"]] == ["success", "success"]
+    finally:
+        conn.close()
+
+def test_restart_with_another_worker_count_is_refused(cluster, tmp_path):
+    code = "import serveropensource as s; s.ClusterServer('127.0.0.1', 0, 3, data_dir={!r}).start()".format(
+        str(tmp_path))
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, timeout=30)
+    assert result.returncode != 0
+    assert "start the cluster with 2 workers" in result.stderr
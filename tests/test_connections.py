@@ -0,0 +1,49 @@
+"""Pushes to subscribed connections: ordering and slow-consumer disconnects."""
+import json
+import socket
+import time
+
+import pytest
+
+from serveropensource import ClientConnection, LegacyChatServer
+
+@pytest.fixture
+def server():
+    server = LegacyChatServer("127.0.0.1", 0)
+    for username in ("alice", "bob"):
+        server.process_request({"action": "signup", "username": username, "password": "pw"})
+    yield server
+    server.close()
+
+def subscribe(server, max_pending=None):
+    ours, theirs = socket.socketpair()
+    conn = ClientConnection(ours, max_pending=max_pending)
+    reply = server.process_request({"action": "subscribe", "username": "bob"}, conn)
+    assert reply["status"] == "success"
+    return conn, theirs
+
+def send(server, text):
+    return server.process_request({"action": "send_message", "sender": "alice", "recipient": "bob", "message": text})
+
+def test_pushes_arrive_in_sequence_order(server):
+    conn, theirs = subscribe(server)
+    for i in range(50):
+        send(server, str(i))
+    reader = theirs.makefile("rb")
+    seqs = [json.loads(reader.readline())["message"]["seq"] for _ in range(50)]
+    assert seqs == sorted(seqs) and len(set(seqs)) == 50
+    conn.close()
+    theirs.close()
+
+def test_a_stalled_subscriber_is_dropped_without_blocking_senders(server):
+    conn, theirs = subscribe(server, max_pending=64 * 1024)
+    slowest = 0.0
+    for i in range(400):
+        started = time.monotonic()
+        send(server, "x" * 1000)
+        slowest = max(slowest, time.monotonic() - started)
+    assert slowest < 1.0
+    assert conn.slow_consumer and conn.closed
+    assert conn not in server.users["bob"].subscribers
+    conn.close()
+    theirs.close()
@@ -0,0 +1,49 @@
+"""Field validation and handler lookup in the action table."""
+import pytest
+
+from serveropensource import LegacyChatServer
+
+@pytest.fixture
+def server():
+    server = LegacyChatServer("127.0.0.1", 0)
+    server.process_request({"action": "signup", "username": "alice", "password": "pw"})
+    yield server
+    server.close()
+
+@pytest.mark.parametrize("request_, message", [
+    ({"action": "send_message", "sender": "alice", "recipient": "alice"}, "Missing fields for sending message"),
+    ({"action": "send_message", "sender": "alice", "recipient": "alice", "message": ""},
+     "Missing fields for sending message"),
+    ({"action": "ack", "username": "alice", "seq": True}, "Username and seq required"),
+    ({"action": "file_begin", "sender": "alice", "recipient": "alice", "filename": "f", "size": "10"},
+     "Missing fields for sending file"),
+    ({"action": "file_status", "upload_id": 5}, "Missing fields for file status"),
+    ({"action": "file_chunk", "upload_id": 5, "offset": 0, "data": "AA=="}, "Missing fields for file chunk"),
+    ({"action": "file_commit", "upload_id": ["x"]}, "Missing fields for file commit"),
+    ({"action": "group_join", "username": "alice", "group": ["g"]}, "Username and group required"),
+    ({"action": "group_leave", "username": "alice", "group": 1}, "Username and group required"),
+    ({"action": "group_post", "sender": "alice", "group": {}, "message": "x"}, "Missing fields for posting"),
+    ({"action": "group_info", "group": ["g"]}, "Group required"),
+    ({"action": "get_history", "username": ["alice"], "with": "bob"}, "Username and buddy or group required"),
+])
+def test_bad_fields_get_the_action_message(server, request_, message):
+    assert server.process_request(request_) == {"status": "error", "message": message}
+
+def test_unknown_and_peer_only_actions(server):
+    assert server.process_request({"action": "no_such_action"})["message"] == "Unknown action"
+    assert server.process_request({"action": "peer_user_exists", "username": "alice"})["message"] == "Unknown action"
+    assert server.process_request(["not", "an", "object"])["message"] == "Request must be a JSON object"
+
+def test_subclass_overrides_are_dispatched_to():
+    class Quiet(LegacyChatServer):
+        def heartbeat(self, request):
+            return {"status": "success", "overridden": True}
+    server = Quiet("127.0.0.1", 0)
+    try:
+        assert server.process_request({"action": "heartbeat"}) == {"status": "success", "overridden": True}
+    finally:
+        server.close()
+
+def test_errors_keep_the_request_id(server):
+    reply = server.codec.loads(server.handle_payload(b'{"action": "no_such_action", "id": 7}'))
+    assert reply == {"status": "error", "message": "Unknown action", "id": 7}
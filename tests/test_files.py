@@ -0,0 +1,60 @@
+"""Chunked uploads, blob references and who may release them."""
+import base64
+
+import pytest
+
+from serveropensource import LegacyChatServer
+
+@pytest.fixture
+def server():
+    server = LegacyChatServer("127.0.0.1", 0)
+    for username in ("alice", "bob", "carol"):
+        server.process_request({"action": "signup", "username": username, "password": "pw"})
+    yield server
+    server.close()
+
+def upload(server, data, recipient="bob"):
+    upload_id = server.process_request({"action": "file_begin", "sender": "alice", "recipient": recipient,
+                                        "filename": "notes.txt", "size": len(data)})["upload_id"]
+    reply = server.process_request({"action": "file_chunk", "upload_id": upload_id, "offset": 0,
+                                    "data": base64.b64encode(data).decode("ascii")})
+    assert reply["status"] == "success"
+    return server.process_request({"action": "file_commit", "upload_id": upload_id})["file_id"]
+
+def test_only_the_recipient_releases_a_file(server):
+    file_id = upload(server, b"hello")
+    refused = server.process_request({"action": "file_release", "username": "carol", "file_id": file_id})
+    assert refused == {"status": "error", "message": "Not the recipient of this file"}
+    assert server.process_request({"action": "file_fetch", "file_id": file_id})["data"] == "aGVsbG8="
+    released = server.process_request({"action": "file_release", "username": "bob", "file_id": file_id})
+    assert released["status"] == "success"
+    again = server.process_request({"action": "file_release", "username": "bob", "file_id": file_id})
+    assert again == {"status": "error", "message": "File not found"}
+
+def test_release_needs_a_username(server):
+    file_id = upload(server, b"hello")
+    reply = server.process_request({"action": "file_release", "file_id": file_id})
+    assert reply == {"status": "error", "message": "Missing fields for file release"}
+
+def test_identical_files_share_a_blob_until_the_last_release(server):
+    first = upload(server, b"same")
+    second = upload(server, b"same", recipient="carol")
+    server.process_request({"action": "file_release", "username": "bob", "file_id": first})
+    assert server.process_request({"action": "file_fetch", "file_id": second})["data"] == "c2FtZQ=="
+    server.process_request({"action": "file_release", "username": "carol", "file_id": second})
+    assert server.blobs.stats()["blobs"] == 0
+
+def test_inline_send_file_keeps_the_data_in_the_message(server):
+    reply = server.process_request({"action": "send_file", "sender": "alice", "recipient": "bob",
+                                    "filename": "a.txt", "filedata": "aGk="})
+    assert reply["status"] == "success"
+    message = server.users["bob"].messages[-1][1]
+    assert message["filedata"] == "aGk=" and "file_id" not in message
+
+def test_abandoned_uploads_expire(server):
+    upload_id = server.process_request({"action": "file_begin", "sender": "alice", "recipient": "bob",
+                                        "filename": "big", "size": 10})["upload_id"]
+    assert server.expire_uploads() == 0
+    assert server.expire_uploads(now=10 ** 12) == 1
+    reply = server.process_request({"action": "file_chunk", "upload_id": upload_id, "offset": 0, "data": "AA=="})
+    assert reply == {"status": "error", "message": "Upload not found"}
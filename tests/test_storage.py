@@ -0,0 +1,86 @@
+"""Write-ahead log replay, torn-record recovery and snapshot restore."""
+import os
+
+from serveropensource import LegacyChatServer, Storage
+
+def make_server(data_dir):
+    return LegacyChatServer("127.0.0.1", 0, data_dir=str(data_dir))
+
+def last_segment(data_dir):
+    return os.path.join(str(data_dir), sorted(name for name in os.listdir(str(data_dir)) if name.startswith("wal-"))[-1])
+
+def test_replay_restores_users_and_messages(tmp_path):
+    server = make_server(tmp_path)
+    server.process_request({"action": "signup", "username": "alice", "password": "pw"})
+    server.process_request({"action": "signup", "username": "bob", "password": "pw"})
+    server.process_request({"action": "send_message", "sender": "alice", "recipient": "bob", "message": "hi"})
+    server.close()
+
+    server = make_server(tmp_path)
+    try:
+        assert sorted(server.users) == ["alice", "bob"]
+        assert [msg["message"] for seq, msg in server.users["bob"].messages] == ["hi"]
+    finally:
+        server.close()
+
+def test_torn_record_is_cut_off_before_new_writes(tmp_path):
+    server = make_server(tmp_path)
+    server.process_request({"action": "signup", "username": "alice", "password": "pw"})
+    server.close()
+    with open(last_segment(tmp_path), "ab") as f:
+        f.write(b'{"op":"signup","usern')
+
+    server = make_server(tmp_path)
+    assert server.process_request({"action": "signup", "username": "bob", "password": "pw"})["status"] == "success"
+    server.process_request({"action": "send_message", "sender": "bob", "recipient": "alice", "message": "after"})
+    server.close()
+
+    server = make_server(tmp_path)
+    try:
+        assert sorted(server.users) == ["alice", "bob"]
+        assert [msg["message"] for seq, msg in server.users["alice"].messages] == ["after"]
+    finally:
+        server.close()
+
+def test_replay_treats_a_line_without_newline_as_torn(tmp_path):
+    storage = Storage(str(tmp_path))
+    storage.wait(storage.append({"op": "a"})[0])
+    storage.close()
+    with open(last_segment(tmp_path), "ab") as f:
+        f.write(b'{"op":"b"}')
+
+    storage = Storage(str(tmp_path))
+    snapshot, records = storage.load()
+    assert [record["op"] for record in records] == ["a"]
+    storage.wait(storage.append({"op": "c"})[0])
+    storage.close()
+
+    storage = Storage(str(tmp_path))
+    snapshot, records = storage.load()
+    assert [record["op"] for record in records] == ["a", "c"]
+    storage.close()
+
+def test_snapshot_restore_keeps_group_posts_shared(tmp_path):
+    server = make_server(tmp_path)
+    members = ["m{}".format(i) for i in range(5)]
+    for username in ["owner"] + members:
+        server.process_request({"action": "signup", "username": username, "password": "pw"})
+    server.process_request({"action": "group_create", "username": "owner", "group": "g"})
+    for username in members:
+        server.process_request({"action": "group_join", "username": username, "group": "g"})
+    server.process_request({"action": "group_post", "sender": "owner", "group": "g", "message": "x" * 10000})
+    server.process_request({"action": "send_message", "sender": "m0", "recipient": "m1", "message": "direct"})
+    server.snapshot()
+    server.close()
+    assert os.path.getsize(os.path.join(str(tmp_path), "snapshot.json")) < 2 * 10000
+
+    server = make_server(tmp_path)
+    try:
+        posts = [msg for username in members for seq, msg in server.users[username].messages
+                 if msg["message"].startswith("x")]
+        assert len(posts) == len(members)
+        assert len({id(msg) for msg in posts}) == 1
+        assert server.users["m1"].messages[-1][1]["message"] == "direct"
+        assert server.users["m1"].mailbox_bytes > 10000
+    finally:
+        server.close()